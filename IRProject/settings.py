@@ -126,4 +126,7 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # My variables
-# ASGI_APPLICATION = 'IRProject.asgi.application' 
\ No newline at end of file
+# ASGI_APPLICATION = 'IRProject.asgi.application' 
+
+# Where Phase3 writes the TREC qrels and run files of system evaluations
+EVALUATION_DIR = BASE_DIR / 'evaluation'
@@ -1,10 +1,98 @@
+import copy
+import multiprocessing
 import os
+import pickle
 import re
 import string
-from time import sleep
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter, sleep
+from typing import Callable, Iterable, Iterator
 
 import hazm
 
+from .manifest import Manifest
+from .token_cache import TokenCache
+
+
+class Pipeline:
+    """
+        Preprocessing stages chosen once by Phase1.build_pipeline. Calling it preprocesses a text, stream preprocesses
+        a document read in pieces into the same tokens.
+    """
+
+    # Words hazm separates می and نمی from, the pattern of hazm.Normalizer.seperate_mi
+    MI_WORD = re.compile(r"\bن?می[آابپتثجچحخدذرزژسشصضطظعغفقکگلمنوهی]+")
+
+    def __init__(self, normalize: Callable[[str], str], normalize_piece: Callable[[str], str],
+                 separate_mi: Callable[[str], str], split: Callable[[str], list], token_stages: list) -> None:
+        """
+            Holds the stages of a pipeline.
+
+            Args:
+                normalize (Callable): Normalizes a whole text, or None to skip normalizing.
+                normalize_piece (Callable): Normalizes a piece like normalize but without separating می.
+                separate_mi (Callable): Separates می from the words of a text, the last step of normalize.
+                split (Callable): Splits a normalized text into tokens.
+                token_stages (list): Functions from a list of tokens to a list of tokens, applied in order.
+        """
+
+        self.normalize = normalize
+        self.normalize_piece = normalize_piece
+        self.separate_mi = separate_mi
+        self.split = split
+        self.token_stages = token_stages
+
+    def __call__(self, text: str) -> str:
+        if self.normalize is not None:
+            text = self.normalize(text)
+        return self.tokens(text)
+
+    def tokens(self, text: str) -> str:
+        """Runs the token stages on a normalized text."""
+        tokens = self.split(text)
+        for stage in self.token_stages:
+            tokens = stage(tokens)
+        return " ".join(tokens)
+
+    def stream(self, pieces: Iterable[str]) -> Iterator[str]:
+        """
+            Preprocesses the pieces of one document, e.g. from Phase1.read_chunks.
+
+            Normalizing works line by line except for separating می: hazm replaces every word it separates it from
+            everywhere in the text, also inside other words. So the pieces are normalized without that step and
+            spilled to a temporary file, and the replacements of the whole document are applied as they are read
+            back, in the order hazm makes them.
+
+            Args:
+                pieces (Iterable[str]): Pieces of the document, in order.
+
+            Returns:
+                Iterator[str]: Preprocessed pieces.
+        """
+
+        if self.normalize is None:
+            yield from map(self, pieces)
+            return
+
+        words = {}
+        count = 0
+        with tempfile.TemporaryFile() as spill:
+            for piece in pieces:
+                text = self.normalize_piece(piece)
+                words.update(dict.fromkeys(self.MI_WORD.findall(text)))
+                pickle.dump(text, spill, pickle.HIGHEST_PROTOCOL)
+                count += 1
+
+            replacements = [(word, self.separate_mi(word)) for word in words]
+            replacements = [(word, separated) for word, separated in replacements if separated != word]
+            spill.seek(0)
+            for _ in range(count):
+                text = pickle.load(spill)
+                for word, separated in replacements:
+                    text = text.replace(word, separated)
+                yield self.tokens(text)
+
 
 class Phase1:
     """
@@ -12,23 +100,39 @@ class Phase1:
     """
 
     PERSIAN_PUNCTUATION = ''.join(['«', '»', '×', '،', '؛', '؟', 'ـ', '٪', '٫', '٬'])
+    SENTENCE_ENDINGS = ('.', '!', '?', '؟', ':', '؛')
 
-    def __init__(self) -> None:
+    def __init__(self, cache_size: int = 100_000, cache_file: str = None) -> None:
         """
             Initializes Phase1 object with necessary resources and parameters.
+
+            Args:
+                cache_size (int, optional): Number of lemmatized and stemmed tokens to remember. Defaults to 100000.
+                cache_file (str, optional): File the token cache is warm-started from and saved to. Defaults to None.
         """
         self.informal_normalizer = hazm.InformalNormalizer(seperation_flag=True)
         self.normalizer = hazm.Normalizer(correct_spacing=True, remove_diacritics=True, remove_specials_chars=True,
                                           decrease_repeated_chars=True, persian_style=True, persian_numbers=True,
                                           seperate_mi=True)
+        # Built when a document is first streamed
+        self.piece_normalizer = None
         self.tokenizer = hazm.WordTokenizer(join_verb_parts=True, replace_links=True, replace_emails=True,
                                             replace_ids=True, replace_numbers=True, replace_hashtags=True)
         self.lemmatizer = hazm.Lemmatizer()
         self.stemmer = hazm.Stemmer()
         self.stopwords = Phase1.read_stopwords("Phase1/Stopwords")
+        self.stopword_sets = {name: set(words) for name, words in self.stopwords.items()}
         self.state = [0, "Not Started Yet!", '']
         self.punctuation_pattern = re.compile(f'[{re.escape(string.punctuation)}{self.PERSIAN_PUNCTUATION}]+')
 
+        # Corpora are Zipfian, most token occurrences are a few thousand words already seen
+        self.cache_file = cache_file
+        self.token_cache = TokenCache(cache_size)
+        if cache_file:
+            self.token_cache.load(cache_file)
+        self.cached_lemmatize = self.token_cache.wrap('lemmatize', self.lemmatizer.lemmatize)
+        self.cached_stem = self.token_cache.wrap('stem', self.stemmer.stem)
+
     @staticmethod
     def read_stopwords(files_path) -> dict:
         """
@@ -75,6 +179,24 @@ class Phase1:
 
         return self.normalizer.normalize(input_text)
 
+    def normalize_piece(self, input_text: str) -> str:
+        """
+            Normalizes a piece of a streamed document, without separating می. See Pipeline.stream.
+
+            Args:
+                input_text (str): Input text to be normalized.
+
+            Returns:
+                str: Normalized text.
+        """
+
+        if self.piece_normalizer is None:
+            # hazm only loads the verbs correct_spacing also needs when seperate_mi is on, so the step is switched off
+            # on a copy, which shares the loaded words and verbs, rather than in a new Normalizer
+            self.piece_normalizer = copy.copy(self.normalizer)
+            self.piece_normalizer._seperate_mi = False
+        return self.piece_normalizer.normalize(input_text)
+
     def token_spacing(self, input_list: list) -> list:
         """
             Performs token spacing.
@@ -112,7 +234,7 @@ class Phase1:
                 str: Lemmatized text.
         """
 
-        return self.lemmatizer.lemmatize(input_text)
+        return self.cached_lemmatize(input_text)
 
     def stem(self, input_text: str) -> str:
         """
@@ -125,7 +247,7 @@ class Phase1:
                 str: Stemmed text.
         """
 
-        return self.stemmer.stem(input_text)
+        return self.cached_stem(input_text)
 
     def remove_string_stopwords(self, input_text: list, stopword_dict='Mazdak') -> list:
         """
@@ -139,7 +261,7 @@ class Phase1:
                 list: Input text with stopwords removed.
         """
 
-        stopwords = self.stopwords[stopword_dict]
+        stopwords = self.stopword_sets[stopword_dict]
         input_text = [i for i in input_text if i not in stopwords]
 
         return input_text
@@ -158,6 +280,14 @@ class Phase1:
         cleaned_string = self.punctuation_pattern.sub('', ' '.join(input_list))
         return cleaned_string.split()
 
+    def save_token_cache(self) -> None:
+        """
+            Saves the token cache to cache_file, if one was given.
+        """
+
+        if self.cache_file:
+            self.token_cache.save(self.cache_file)
+
     def state_updater(self, done: int, process_length: int, section: str, directory: str = ''):
         """
             Updates the state of the preprocessing process.
@@ -259,6 +389,61 @@ class Phase1:
 
         return results
 
+    def build_pipeline(self, normalize: bool = True, tokenize: bool = True, token_spacing: bool = False,
+                       remove_stopwords: bool = False, lemmatize: bool = False, stem: bool = False,
+                       remove_punctuations: bool = False) -> Pipeline:
+        """
+            Builds the configured preprocessing stages into one Pipeline, so they are chosen once per batch
+            instead of once per document.
+
+            Args:
+                normalize (bool, optional): Perform normalization. Defaults to True.
+                tokenize (bool, optional): Perform tokenization. Defaults to True.
+                token_spacing (bool, optional): Perform token spacing. Defaults to False.
+                remove_stopwords (bool, optional): Remove stopwords. Defaults to False.
+                lemmatize (bool, optional): Perform lemmatization. Defaults to False.
+                stem (bool, optional): Perform stemming, ignored when lemmatizing. Defaults to False.
+                remove_punctuations (bool, optional): Remove punctuations. Defaults to False.
+
+            Returns:
+                Pipeline: Callable from a raw text to the preprocessed text.
+        """
+
+        split = self.tokenize if tokenize else (lambda text: text.split(" "))
+
+        token_stages = []
+        if token_spacing:
+            token_stages.append(self.token_spacing)
+        if remove_stopwords:
+            token_stages.append(self.remove_string_stopwords)
+        if lemmatize:
+            lemmatize_token = self.cached_lemmatize
+            token_stages.append(lambda tokens: [lemmatize_token(token) for token in tokens])
+        elif stem:
+            stem_token = self.cached_stem
+            token_stages.append(lambda tokens: [stem_token(token) for token in tokens])
+        if remove_punctuations:
+            token_stages.append(self.remove_punctuations)
+
+        return Pipeline(self.normalize if normalize else None, self.normalize_piece, self.normalizer.seperate_mi,
+                        split, token_stages)
+
+    def preprocess_documents(self, documents: Iterable[str], **options) -> Iterator[str]:
+        """
+            Preprocesses many texts with the same options, without the delays of preprocess_text.
+
+            Args:
+                documents (Iterable[str]): Texts to be preprocessed.
+                **options: Preprocessing steps to perform, as for preprocess_text.
+
+            Returns:
+                Iterator[str]: Preprocessed texts, in the order of documents.
+        """
+
+        pipeline = self.build_pipeline(**options)
+        for text in documents:
+            yield pipeline(text)
+
     def internal_preprocess_text(self, input_text: str, normalize: bool = True, tokenize: bool = True,
                                  token_spacing: bool = False, remove_stopwords: bool = False,
                                  lemmatize: bool = False, stem: bool = False, remove_punctuations: bool = False) -> str:
@@ -279,49 +464,122 @@ class Phase1:
                 str: Preprocessed text.
         """
 
-        # Normalize section
-        if normalize:
-            result1 = self.normalize(input_text)
-        else:
-            result1 = input_text
-        sleep(0.3)
+        pipeline = self.build_pipeline(normalize=normalize, tokenize=tokenize, token_spacing=token_spacing,
+                                       remove_stopwords=remove_stopwords, lemmatize=lemmatize, stem=stem,
+                                       remove_punctuations=remove_punctuations)
+        return pipeline(input_text)
 
-        # Tokenize section
-        if tokenize:
-            result2 = self.tokenize(result1)
-        else:
-            result2 = result1.split(" ")
-        sleep(0.3)
+    @staticmethod
+    def read_document(path: str) -> str:
+        """
+            Reads an input file the way preprocess_files expects it, without line breaks inside lines and
+            without right-to-left marks.
 
-        # Token Spacing section
-        if token_spacing:
-            result2 = self.token_spacing(result2)
-        sleep(0.3)
+            Args:
+                path (str): Path of the file.
 
-        # Remove stopwords section
-        if remove_stopwords:
-            result2 = self.remove_string_stopwords(result2)
-        sleep(0.3)
+            Returns:
+                str: Content of the file.
+        """
 
-        # Lemmatize section
-        if lemmatize:
-            result2 = [self.lemmatize(i) for i in result2]
+        with open(path, 'r', encoding='utf-8') as f:
+            return "\n".join([i.replace("\n", "").replace('‏', '') for i in f.readlines()])
 
-        # Stemming section
-        elif stem:
-            result2 = [self.stem(i) for i in result2]
-        sleep(0.3)
+    @staticmethod
+    def read_chunks(path: str, chunk_size: int = 1 << 20) -> Iterator[str]:
+        """
+            Reads an input file like read_document, but in pieces of about chunk_size characters.
 
-        # Remove Punctuations section
-        if remove_punctuations:
-            result2 = self.remove_punctuations(result2)
-        sleep(0.3)
+            A piece only ends after a line that closes a sentence or paragraph, so no token or sentence is split
+            between two pieces. A run of lines without such an ending is cut anyway once it grows to four times
+            chunk_size, which keeps memory bounded, and only there can streaming change the output. Every piece but
+            the first starts with the line break before it, because the normalizer treats the start of a text
+            differently from the start of a line, and so joining the pieces gives read_document's text.
 
-        return " ".join(result2)
+            Args:
+                path (str): Path of the file.
+                chunk_size (int, optional): Target size of a piece, in characters. Defaults to 1 MiB.
+
+            Returns:
+                Iterator[str]: Pieces of the file, in order.
+        """
+
+        lines = []
+        size = 0
+        start = ''
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.replace("\n", "").replace('‏', '')
+                lines.append(line)
+                size += len(line) + 1
+
+                stripped = line.rstrip()
+                boundary = not stripped or stripped.endswith(Phase1.SENTENCE_ENDINGS)
+                if size >= chunk_size and boundary or size >= 4 * chunk_size:
+                    yield start + "\n".join(lines)
+                    lines = []
+                    size = 0
+                    start = "\n"
+
+        if lines:
+            yield start + "\n".join(lines)
+
+    @staticmethod
+    def write_output(path: str, text: str) -> None:
+        """
+            Writes an output file atomically, so an interrupted run never leaves a half-written file behind.
+
+            Args:
+                path (str): Path of the file.
+                text (str): Content of the file.
+        """
+
+        Phase1.write_output_pieces(path, [text])
+
+    @staticmethod
+    def write_output_pieces(path: str, pieces: Iterable[str]) -> None:
+        """
+            Writes preprocessed pieces of a document to an output file atomically, separated by spaces like the
+            tokens inside them. Empty pieces are left out.
+
+            Args:
+                path (str): Path of the file.
+                pieces (Iterable[str]): Preprocessed pieces, e.g. from Pipeline.stream over read_chunks.
+        """
+
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            separator = ''
+            for piece in pieces:
+                if piece:
+                    f.write(separator)
+                    f.write(piece)
+                    separator = ' '
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def preprocess_file(pipeline: Pipeline, input_path: str, output_path: str, chunk_size: int = None) -> None:
+        """
+            Preprocesses one input file into one output file.
+
+            Args:
+                pipeline (Pipeline): Pipeline from build_pipeline.
+                input_path (str): Path of the input file.
+                output_path (str): Path of the output file.
+                chunk_size (int, optional): Stream the file in pieces of about this many characters instead of
+                    reading it whole. Only valid for pipelines that tokenize. Defaults to None.
+        """
+
+        if chunk_size:
+            Phase1.write_output_pieces(output_path, pipeline.stream(Phase1.read_chunks(input_path, chunk_size)))
+        else:
+            Phase1.write_output(output_path, pipeline(Phase1.read_document(input_path)))
 
     def preprocess_files(self, input_directory: str, output_directory: str, normalize: bool = True,
                          tokenize: bool = True, token_spacing: bool = False, remove_stopwords: bool = False,
-                         lemmatize: bool = False, stem: bool = False, remove_punctuations: bool = False) -> None:
+                         lemmatize: bool = False, stem: bool = False, remove_punctuations: bool = False,
+                         parallel: bool = False, workers: int = None, incremental: bool = True,
+                         streaming: bool = False, chunk_size: int = 1 << 20) -> float:
         """
             Preprocesses text files in a directory and writes the preprocessed files to another directory.
 
@@ -335,31 +593,114 @@ class Phase1:
                 lemmatize (bool, optional): Perform lemmatization. Defaults to False.
                 stem (bool, optional): Perform stemming. Defaults to False.
                 remove_punctuations (bool, optional): Remove punctuations. Defaults to False.
+                parallel (bool, optional): Spread the files over a pool of worker processes. Defaults to False.
+                workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+                incremental (bool, optional): Skip files whose input and options are the same as in the last run,
+                    according to the manifest in output_directory. Defaults to True.
+                streaming (bool, optional): Read, preprocess and write every file in pieces, so memory does not grow
+                    with the size of a file. Needs tokenize, files are read whole without it. Defaults to False.
+                chunk_size (int, optional): Size of a piece in streaming mode, in characters. Defaults to 1 MiB.
+
+            Returns:
+                float: Throughput in preprocessed documents per second.
         """
 
+        options = dict(normalize=normalize, tokenize=tokenize, token_spacing=token_spacing,
+                       remove_stopwords=remove_stopwords, lemmatize=lemmatize, stem=stem,
+                       remove_punctuations=remove_punctuations)
+
         directories = os.listdir(input_directory)
         directories_files = {directory: os.listdir(f'{input_directory}/{directory}') for directory in directories}
+        for directory in directories_files:
+            os.makedirs(os.path.dirname(f'{output_directory}/{directory}/'), exist_ok=True)
 
         done = 0
         process_length = sum([len(files) for directory, files in directories_files.items()])
+        start = perf_counter()
 
+        # Find the files that changed since the last run
+        manifest = Manifest(output_directory, options)
+        jobs = []
         for directory, files in directories_files.items():
-            for index, file in enumerate(files):
-                os.makedirs(os.path.dirname(f'{output_directory}/{directory}/'), exist_ok=True)
-
-                with open(f'{input_directory}/{directory}/{file}', 'r', encoding='utf-8') as f:
-                    self.state_updater(done, process_length, f"{file}...", directory)
-                    result = self.internal_preprocess_text(
-                        "\n".join([i.replace("\n", "").replace('‏', '') for i in f.readlines()]),
-                        normalize=normalize, tokenize=tokenize, token_spacing=token_spacing,
-                        remove_stopwords=remove_stopwords, lemmatize=lemmatize, stem=stem,
-                        remove_punctuations=remove_punctuations)
+            for file in files:
+                name = f'{directory}/{file}'
+                input_path, output_path = f'{input_directory}/{name}', f'{output_directory}/{name}'
+                unchanged, entry = manifest.check(name, input_path, output_path)
+                if incremental and unchanged:
+                    manifest.record(name, entry)
                     done += 1
+                else:
+                    jobs.append((directory, file, input_path, output_path, entry))
+        skipped = done
+        self.state_updater(done, process_length, "Preprocessing...")
+
+        # Without the tokenizer, words are split on spaces only and line breaks stay inside them
+        chunk_size = chunk_size if streaming and tokenize else None
+
+        if parallel and jobs:
+            workers = workers or os.cpu_count() or 1
+            # Small chunks keep the progress moving, a few per worker keeps every process busy
+            jobs_per_chunk = max(1, min(64, -(-len(jobs) // (workers * 4))))
+
+            # Runs on a job runner thread, a forked worker would copy the locks other threads hold
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=init_worker, initargs=(options, self.cache_file)) as executor:
+                futures = {executor.submit(preprocess_chunk, [job[2:4] for job in jobs[i:i + jobs_per_chunk]],
+                                           chunk_size): jobs[i:i + jobs_per_chunk]
+                           for i in range(0, len(jobs), jobs_per_chunk)}
+                for future in as_completed(futures):
+                    done += future.result()
+                    for directory, file, _, _, entry in futures[future]:
+                        manifest.record(f'{directory}/{file}', entry)
+                    self.state_updater(done, process_length, "Preprocessing...")
+        else:
+            pipeline = self.build_pipeline(**options)
+            for directory, file, input_path, output_path, entry in jobs:
+                self.state_updater(done, process_length, f"{file}...", directory)
+                self.preprocess_file(pipeline, input_path, output_path, chunk_size)
+                manifest.record(f'{directory}/{file}', entry)
+                done += 1
 
-                with open(f'{output_directory}/{directory}/{file}', 'w', encoding='utf-8') as f:
-                    f.write(result)
+        manifest.save()
+        documents_per_second = (done - skipped) / max(perf_counter() - start, 1e-9)
+        self.save_token_cache()
+        self.state_updater(done, process_length, f"Done! ({documents_per_second:.1f} docs/sec, {skipped} unchanged)")
+        return documents_per_second
 
-        self.state_updater(done, process_length, "Done!")
+
+# Pipeline of the current worker process, built once by init_worker
+_worker_pipeline = None
+
+
+def init_worker(options: dict, cache_file: str = None) -> None:
+    """
+        Builds the hazm objects and the preprocessing pipeline of a worker process of Phase1.preprocess_files.
+
+        Args:
+            options (dict): Preprocessing steps to perform, as for Phase1.build_pipeline.
+            cache_file (str, optional): Token cache to warm-start from, workers never write it. Defaults to None.
+    """
+
+    global _worker_pipeline
+    _worker_pipeline = Phase1(cache_file=cache_file).build_pipeline(**options)
+
+
+def preprocess_chunk(jobs: list, chunk_size: int = None) -> int:
+    """
+        Preprocesses a chunk of files in a worker process.
+
+        Args:
+            jobs (list): (input path, output path) pairs.
+            chunk_size (int, optional): Streaming piece size, as for Phase1.preprocess_file. Defaults to None.
+
+        Returns:
+            int: Number of files written.
+    """
+
+    for input_path, output_path in jobs:
+        Phase1.preprocess_file(_worker_pipeline, input_path, output_path, chunk_size)
+
+    return len(jobs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,92 @@
+"""
+    Manifest of the files written by Phase1.preprocess_files, used to skip inputs that have not changed.
+
+    For every output file, relative to the output directory, it records the size, modification time and SHA-256 of
+    the input it was made from and the preprocessing options used. An input is unchanged when its size and
+    modification time match, or failing that when its hash matches.
+"""
+
+import hashlib
+import json
+import os
+
+MANIFEST_FILE = '.manifest.json'
+
+
+def file_hash(path: str) -> str:
+    """Returns the SHA-256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    VERSION = 1
+
+    def __init__(self, output_directory: str, options: dict) -> None:
+        """
+            Loads the manifest of an output directory, or starts an empty one.
+
+            Args:
+                output_directory (str): Output directory of preprocess_files, the manifest is kept inside it.
+                options (dict): Preprocessing options of the current run.
+        """
+
+        self.path = os.path.join(output_directory, MANIFEST_FILE)
+        self.options = json.dumps(options, sort_keys=True)
+        self.previous = {}
+        self.files = {}
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self.previous = data['files']
+        except FileNotFoundError:
+            pass
+        except (IOError, ValueError) as e:
+            print(f"Error loading manifest '{self.path}': {e}")
+
+    def check(self, name: str, input_path: str, output_path: str) -> tuple:
+        """
+            Checks whether an output file is up to date with its input.
+
+            Args:
+                name (str): Path of the file relative to the input and output directories.
+                input_path (str): Path of the input file.
+                output_path (str): Path of the output file.
+
+            Returns:
+                tuple: (unchanged, entry), entry is what to record once the output is written.
+        """
+
+        stat = os.stat(input_path)
+        previous = self.previous.get(name)
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'options': self.options}
+
+        if not previous or previous['options'] != self.options or not os.path.exists(output_path):
+            entry['sha256'] = file_hash(input_path)
+            return False, entry
+        if previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+            entry['sha256'] = previous['sha256']
+            return True, entry
+
+        # Touched but maybe not modified
+        entry['sha256'] = file_hash(input_path)
+        return entry['sha256'] == previous['sha256'], entry
+
+    def record(self, name: str, entry: dict) -> None:
+        """Records an up to date output file."""
+        self.files[name] = entry
+
+    def save(self) -> None:
+        """Writes the files recorded in this run, replacing the manifest atomically."""
+        temp_path = f'{self.path}.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': self.VERSION, 'files': self.files}, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+        except IOError as e:
+            print(f"Error saving manifest '{self.path}': {e}")
@@ -0,0 +1,208 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from .Phases import Phase1
+from .manifest import MANIFEST_FILE, Manifest
+from .token_cache import TokenCache
+
+OPTIONS = {'normalize': True, 'stem': False}
+
+
+class ManifestTests(TestCase):
+    """Checks which inputs the preprocessing manifest skips and which it sends back to be preprocessed."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_path = os.path.join(self.directory, 'input.txt')
+        self.output_path = os.path.join(self.directory, 'output.txt')
+        self.write(self.input_path, 'first text')
+        self.write(self.output_path, 'first')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    @staticmethod
+    def write(path, text, mtime_ns=None):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        if mtime_ns is not None:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def run_once(self, options=OPTIONS, name='input.txt'):
+        """Checks the input with a freshly loaded manifest, records it and saves, like one preprocess_files run."""
+        manifest = Manifest(self.directory, options)
+        unchanged, entry = manifest.check(name, self.input_path, self.output_path)
+        manifest.record(name, entry)
+        manifest.save()
+        return unchanged
+
+    def test_first_run(self):
+        self.assertFalse(self.run_once())
+        self.assertTrue(os.path.exists(os.path.join(self.directory, MANIFEST_FILE)))
+
+    def test_unchanged_is_skipped(self):
+        self.run_once()
+        self.assertTrue(self.run_once())
+
+    def test_changed_options(self):
+        self.run_once()
+        self.assertFalse(self.run_once({**OPTIONS, 'stem': True}))
+
+    def test_changed_content(self):
+        self.run_once()
+        mtime_ns = os.stat(self.input_path).st_mtime_ns
+        self.write(self.input_path, 'other text', mtime_ns + 10 ** 9)
+        self.assertFalse(self.run_once())
+
+    def test_touched_but_identical(self):
+        self.run_once()
+        mtime_ns = os.stat(self.input_path).st_mtime_ns
+        self.write(self.input_path, 'first text', mtime_ns + 10 ** 9)
+        self.assertTrue(self.run_once())
+
+    def test_missing_output(self):
+        self.run_once()
+        os.remove(self.output_path)
+        self.assertFalse(self.run_once())
+
+    def test_unrecorded_files_are_dropped(self):
+        self.run_once(name='a.txt')
+        self.run_once(name='b.txt')
+        self.assertFalse(self.run_once(name='a.txt'))
+        self.assertEqual(set(Manifest(self.directory, OPTIONS).previous), {'a.txt'})
+
+    def test_corrupt_manifest(self):
+        self.write(os.path.join(self.directory, MANIFEST_FILE), '{not json')
+        self.assertFalse(self.run_once())
+        self.assertTrue(self.run_once())
+
+
+class TokenCacheTests(TestCase):
+    """Checks eviction, counters and warm starts of the token cache."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'token_cache.json')
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def upper(self, token):
+        self.calls.append(token)
+        return token.upper()
+
+    def filled(self, tokens, maxsize):
+        """A cache of the given size that looked up tokens in order."""
+        cache = TokenCache(maxsize)
+        lookup = cache.wrap('lemma', self.upper)
+        for token in tokens:
+            lookup(token)
+        return cache
+
+    def test_eviction_order(self):
+        cache = TokenCache(3)
+        lookup = cache.wrap('lemma', self.upper)
+        for token in ['a', 'b', 'c', 'a', 'd']:
+            self.assertEqual(lookup(token), token.upper())
+        # a was used after b, so b is the least recently used when d comes in
+        self.assertEqual(list(cache.entries), [('lemma', 'c'), ('lemma', 'a'), ('lemma', 'd')])
+        self.assertEqual(self.calls, ['a', 'b', 'c', 'd'])
+        lookup('b')
+        self.assertEqual(self.calls[-1], 'b')
+        self.assertEqual(list(cache.entries), [('lemma', 'a'), ('lemma', 'd'), ('lemma', 'b')])
+
+    def test_stages(self):
+        cache = TokenCache(10)
+        lemma, stem = cache.wrap('lemma', self.upper), cache.wrap('stem', str.lower)
+        self.assertEqual((lemma('Ab'), stem('Ab')), ('AB', 'ab'))
+        self.assertEqual(len(cache), 2)
+
+    def test_counters(self):
+        cache = self.filled(['a', 'b', 'a', 'a', 'c'], 10)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 3, 'hit_rate': 0.4, 'size': 3, 'maxsize': 10})
+        cache.clear()
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 0, 'hit_rate': 0, 'size': 0, 'maxsize': 10})
+
+    def test_warm_start(self):
+        self.filled(['a', 'b', 'c', 'a'], 10).save(self.path)
+        cache = TokenCache(10)
+        self.assertEqual(cache.load(self.path), 3)
+        # The least recently used entries stay first, so they are still evicted first
+        self.assertEqual(list(cache.entries), [('lemma', 'b'), ('lemma', 'c'), ('lemma', 'a')])
+
+        self.calls = []
+        lookup = cache.wrap('lemma', self.upper)
+        self.assertEqual([lookup(token) for token in ['a', 'b', 'c']], ['A', 'B', 'C'])
+        self.assertEqual(self.calls, [])
+        self.assertEqual((cache.hits, cache.misses), (3, 0))
+
+    def test_load_larger_file(self):
+        self.filled(['a', 'b', 'c', 'd', 'e'], 5).save(self.path)
+        cache = self.filled(['x', 'y'], 3)
+        self.assertEqual(cache.load(self.path), 3)
+        self.assertEqual(list(cache.entries), [('lemma', 'c'), ('lemma', 'd'), ('lemma', 'e')])
+        self.assertEqual(TokenCache(0).load(self.path), 0)
+
+    def test_load_missing_or_corrupt(self):
+        cache = self.filled(['a'], 10)
+        self.assertEqual(cache.load(os.path.join(self.directory, 'missing.json')), 0)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('{not json')
+        self.assertEqual(cache.load(self.path), 0)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('{"version": 0, "entries": [["lemma", "b", "B"]]}')
+        self.assertEqual(cache.load(self.path), 0)
+        self.assertEqual(list(cache.entries), [('lemma', 'a')])
+
+
+class StreamingTests(TestCase):
+    """Compares preprocessing input files in pieces with preprocessing them whole."""
+
+    INPUTS = 'Phase1/Inputs'
+    # Small enough to cut most inputs into several pieces
+    CHUNK_SIZE = 512
+    # Files whose pieces start with a line the normalizer changes at the start of a text, or hold words hazm
+    # separates می from in other pieces
+    REGRESSIONS = ['2003/HAM2-811011-023.ham', '2003/HAM2-820719-132.ham', '2005/HAM2-840401-156.ham']
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.phase1 = Phase1()
+        files = sorted(os.path.relpath(os.path.join(directory, name), cls.INPUTS)
+                       for directory, _, names in os.walk(cls.INPUTS) for name in names)
+        cls.files = sorted(set(files[::100]) | set(cls.REGRESSIONS))
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def assert_same_output(self, **options):
+        pipeline = self.phase1.build_pipeline(**options)
+        whole, streamed = os.path.join(self.directory, 'whole'), os.path.join(self.directory, 'streamed')
+        split = 0
+        for name in self.files:
+            path = os.path.join(self.INPUTS, name)
+            split += len(list(Phase1.read_chunks(path, self.CHUNK_SIZE))) > 1
+            Phase1.preprocess_file(pipeline, path, whole)
+            Phase1.preprocess_file(pipeline, path, streamed, self.CHUNK_SIZE)
+            with open(whole, 'rb') as f, open(streamed, 'rb') as g:
+                self.assertEqual(f.read(), g.read(), name)
+        self.assertGreater(split, len(self.files) // 2)
+
+    def test_default_pipeline(self):
+        self.assert_same_output()
+
+    def test_token_stages(self):
+        self.assert_same_output(remove_stopwords=True, lemmatize=True, remove_punctuations=True)
+
+    def test_pieces_join_into_document(self):
+        for name in self.files:
+            path = os.path.join(self.INPUTS, name)
+            self.assertEqual(''.join(Phase1.read_chunks(path, self.CHUNK_SIZE)), Phase1.read_document(path))
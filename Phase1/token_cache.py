@@ -0,0 +1,140 @@
+"""
+    Bounded least-recently-used cache for per-token morphology (lemmatization and stemming).
+
+    Entries are keyed by (stage, token), so one cache serves every stage. It can be saved to and warm-started from a
+    JSON file, which keeps the most recently used entries last so their order survives a reload.
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+
+class TokenCache:
+    VERSION = 1
+
+    def __init__(self, maxsize: int = 100_000) -> None:
+        """
+            Initializes an empty cache.
+
+            Args:
+                maxsize (int, optional): Maximum number of entries, the least recently used ones are evicted first.
+                    Defaults to 100000.
+        """
+
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def wrap(self, stage: str, function: Callable[[str], str]) -> Callable[[str], str]:
+        """
+            Puts the cache in front of a per-token function.
+
+            Args:
+                stage (str): Name of the stage, part of the key.
+                function (Callable): Function from a token to its result, e.g. hazm.Lemmatizer().lemmatize.
+
+            Returns:
+                Callable: Function with the same results that only calls function on a miss.
+        """
+
+        entries = self.entries
+        lock = self.lock
+
+        def cached(token: str) -> str:
+            key = (stage, token)
+            with lock:
+                if key in entries:
+                    self.hits += 1
+                    entries.move_to_end(key)
+                    return entries[key]
+                self.misses += 1
+
+            value = function(token)
+            with lock:
+                entries[key] = value
+                if len(entries) > self.maxsize:
+                    entries.popitem(last=False)
+            return value
+
+        return cached
+
+    def stats(self) -> dict:
+        """
+            Returns the counters of the cache.
+
+            Returns:
+                dict: hits, misses, hit_rate, size and maxsize.
+        """
+
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'size': len(self.entries), 'maxsize': self.maxsize}
+
+    def clear(self) -> None:
+        """Removes every entry and resets the counters."""
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    def save(self, path: str) -> None:
+        """
+            Writes the entries to a JSON file, replacing it atomically.
+
+            Args:
+                path (str): Path of the file.
+        """
+
+        with self.lock:
+            entries = [[stage, token, value] for (stage, token), value in self.entries.items()]
+
+        temp_path = f'{path}.tmp'
+        try:
+            # Jobs that finish together must not write the same temp file
+            with self.save_lock:
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'version': self.VERSION, 'entries': entries}, f, ensure_ascii=False)
+                os.replace(temp_path, path)
+        except IOError as e:
+            print(f"Error saving token cache to '{path}': {e}")
+
+    def load(self, path: str) -> int:
+        """
+            Adds the entries of a file written by save. A missing or unreadable file leaves the cache as it is.
+
+            Args:
+                path (str): Path of the file.
+
+            Returns:
+                int: Number of entries loaded.
+        """
+
+        if not os.path.exists(path):
+            return 0
+
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            print(f"Error loading token cache from '{path}': {e}")
+            return 0
+
+        if data.get('version') != self.VERSION:
+            return 0
+
+        # Only the most recent entries fit when the file was written with a larger maxsize
+        entries = data['entries'][-self.maxsize:] if self.maxsize else []
+        with self.lock:
+            for stage, token, value in entries:
+                self.entries[(stage, token)] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return len(entries)
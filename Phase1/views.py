@@ -1,12 +1,15 @@
 from .Phases import Phase1
 
+import copy
 import os.path
 from django.shortcuts import render
 from django.http import JsonResponse
 from rest_framework.decorators import api_view
 
+from core.jobs import job_runner
+
 # Creating an instance of Phase1 class
-phase_object = Phase1()
+phase_object = Phase1(cache_file='token_cache.json')
 
 
 def index(request):
@@ -48,14 +51,28 @@ def preprocess_file_api(request):
     if not validate:
         return JsonResponse({'status': 'failed', 'message': text})
 
-    set_initial_state()
-    phase_object.preprocess_files(input_directory=input_dir, output_directory=output_dir, **preprocess_params)
-    return JsonResponse({'status': 'success'})
+    # The job gets its own progress, the hazm objects and the token cache are shared
+    job_id = job_runner.submit('preprocess_files', copy.copy(phase_object), preprocess_files_job, input_dir,
+                               output_dir, request.data.get('parallel', False), preprocess_params)
+    return JsonResponse({'status': 'success', 'job_id': job_id})
+
+
+def preprocess_files_job(phase, input_dir, output_dir, parallel, preprocess_params):
+    """Runs preprocess_files as a background job."""
+    documents_per_second = phase.preprocess_files(input_directory=input_dir, output_directory=output_dir,
+                                                  parallel=parallel, **preprocess_params)
+    return {'documents_per_second': round(documents_per_second, 3), 'token_cache': phase.token_cache.stats()}
 
 
 @api_view(['GET'])
 def progress(request):
-    """API endpoint for progress."""
+    """API endpoint for progress, of a job if its id is given."""
+    job_id = request.GET.get('job')
+    if job_id:
+        job = job_runner.progress(job_id)
+        if job is None:
+            return JsonResponse({'status': 'error', 'message': 'Can\'t find this job!'}, status=404)
+        return JsonResponse(job)
     return JsonResponse({'progress': phase_object.state[0], 'state': get_progress_state()})
 
 
@@ -1,24 +1,34 @@
+import gc
+import multiprocessing
 import os
 import pickle
 import sys
-import json
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from .compression import CODECS
+from .index_log import INDEX_MANIFEST, get_index_log
+from .segment import INDEX_SEGMENT, Segment, kgrams, write_segment
 
-class Phase2:
-    doc_id = 0
 
+class Phase2:
     def __init__(self):
+        # Last doc id given out, every index counts its own
+        self.doc_id = 0
         self.file_name = dict()
         self.non_positional_index = defaultdict(set)
         self.positional_index = defaultdict(lambda: defaultdict(list))
         self.wildcard_index = defaultdict(set)
+        # Documents deleted since the last full save, still in the in-memory index
+        self.deleted = set()
+        # Whether the dicts hold the index, load_index leaves them empty until _materialize decodes the one on disk
+        self.loaded = True
+        self.generation = 0
         self.state = [0, "Not Started Yet!", '']
 
-    @staticmethod
-    def next_doc_id():
-        Phase2.doc_id += 1
-        return Phase2.doc_id
+    def next_doc_id(self):
+        self.doc_id += 1
+        return self.doc_id
 
     def state_updater(self, done: int, process_length: int, section: str, directory: str = ''):
         """
@@ -40,26 +50,61 @@ class Phase2:
         process_length = len(words)
 
         for pos, word in enumerate(words):
-            self.non_positional_index[word].add(doc_id)
-            self.positional_index[word][doc_id].append(pos)
-            self._add_to_wildcard_index(word, doc_id)
+            # Until the index is decoded the document only goes to the delta segment written by save_document
+            if self.loaded:
+                self.non_positional_index[word].add(doc_id)
+                self.positional_index[word][doc_id].append(pos)
+                self._add_to_wildcard_index(word)
             self.state_updater(done, process_length, "Adding...")
             done += 1
 
         self.state_updater(done, process_length, "Done!")
 
-    def remove_document_single(self, doc_id, text):
-        words = text.split()
+    def save_document(self, doc_id, text):
+        """
+            Writes one added document as a delta segment of the index, so saving it costs the size of the document
+            rather than of the index.
 
-        done = 0
-        process_length = len(words)
+            Args:
+                doc_id (int): Id of the document.
+                text (str): Preprocessed text of the document.
+        """
 
-        for pos, word in enumerate(words):
-            self._remove_from_index(word, doc_id, pos)
-            self.state_updater(done, process_length, "Removing...")
-            done += 1
+        positional_index = defaultdict(lambda: defaultdict(list))
+        for pos, word in enumerate(text.split()):
+            positional_index[word][doc_id].append(pos)
+        non_positional_index = {word: set(postings) for word, postings in positional_index.items()}
 
-        self.state_updater(done, process_length, "Done!")
+        try:
+            self.generation = get_index_log().add_segment(non_positional_index, positional_index,
+                                                          {doc_id: self.file_name.get(doc_id)})
+        except IOError as e:
+            print(f"Error saving document {doc_id}: {e}")
+
+    def remove_document_single(self, doc_id):
+        """
+            Marks a document deleted in the live-docs bitmap of the index. Queries skip it from then on, its postings
+            are purged by the next merge of its segment or full save, so neither its file nor its words are needed.
+
+            Args:
+                doc_id (int): Id of the document.
+        """
+
+        self.state_updater(0, 1, "Removing...")
+        self.deleted.add(doc_id)
+        try:
+            self.generation = get_index_log().delete(doc_id)
+        except IOError as e:
+            print(f"Error saving deletion of document {doc_id}: {e}")
+        self.state_updater(1, 1, "Done!")
+
+    def has_document(self, doc_id):
+        """Whether a document is indexed and not deleted."""
+        if doc_id in self.deleted or doc_id in get_index_log().deleted:
+            return False
+        if self.loaded:
+            return doc_id in self.file_name
+        return doc_id in get_index_log().open().file_names
 
     def add_document(self, doc_id, text, **kwargs):
         words = text.split()
@@ -68,80 +113,181 @@ class Phase2:
                 self.non_positional_index[word].add(doc_id)
             if kwargs['positional']:
                 self.positional_index[word][doc_id].append(pos)
-            if kwargs['wildcard']:
-                self._add_to_wildcard_index(word, doc_id)
+        if kwargs['wildcard']:
+            for word in set(words):
+                self._add_to_wildcard_index(word)
+
+    def build_index(self, documents, workers=None, **kwargs):
+        """
+            Indexes many files at once with a pool of worker processes.
 
-    def _remove_from_index(self, word, doc_id, pos):
-        if doc_id in self.non_positional_index[word]:
-            self.non_positional_index[word].remove(doc_id)
+            The documents are split into shards of consecutive doc ids. Every worker builds partial non-positional,
+            positional and wildcard indexes for its shards, and those are merged into this object as they finish.
+            Doc ids are assigned before sharding, so they stay the same as in a sequential build.
+
+            Args:
+                documents (list): (doc_id, path) pairs to index.
+                workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+                **kwargs: 'non-positional', 'positional' and 'wildcard' flags, as for add_document.
+        """
+
+        workers = workers or os.cpu_count() or 1
+        # A few shards per worker keeps the pool busy when files differ in size
+        shard_size = max(1, -(-len(documents) // (workers * 4)))
+        shards = [documents[i:i + shard_size] for i in range(0, len(documents), shard_size)]
+
+        done = 0
+        process_length = len(documents)
+        self.state_updater(done, process_length, "Adding...")
+
+        # Builds run on a job runner thread, a forked worker would copy the locks other threads hold
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(index_shard, shard, kwargs) for shard in shards]
+            for future in as_completed(futures):
+                self._merge_partial_index(*self._load_partial_index(future.result()))
+                done += shard_size
+                self.state_updater(min(done, process_length), process_length, "Adding...")
+
+        self.state_updater(process_length, process_length, "Done!")
+
+    @staticmethod
+    def _load_partial_index(data):
+        # Unpickling millions of small lists sets off the cyclic GC over and over, pause it meanwhile
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return pickle.loads(data)
+        finally:
+            if enabled:
+                gc.enable()
+
+    def _merge_partial_index(self, non_positional_index, positional_index, wildcard_index):
+        for word, doc_ids in non_positional_index.items():
+            self.non_positional_index[word].update(doc_ids)
+        for word, postings in positional_index.items():
+            self.positional_index[word].update(postings)
+        for gram, words in wildcard_index.items():
+            self.wildcard_index[gram].update(words)
+
+    def purge_deleted(self):
+        """Drops the deleted documents from the in-memory index, before a full save clears the marks."""
+        # Merges clear the marks of the documents they purge from disk, so those are only known here
+        deleted = get_index_log().deleted
+        doc_ids = {doc_id for doc_id in self.file_name if doc_id in self.deleted or doc_id in deleted}
+        self.deleted = set()
+        if not doc_ids:
+            return
+
+        emptied = set()
+        for word in list(self.non_positional_index):
+            self.non_positional_index[word] -= doc_ids
             if not self.non_positional_index[word]:
                 del self.non_positional_index[word]
-        if doc_id in self.positional_index[word]:
-            self.positional_index[word][doc_id].remove(pos)
-            if not self.positional_index[word][doc_id]:
-                del self.positional_index[word][doc_id]
-            if not self.positional_index[word]:
+                emptied.add(word)
+        for word in list(self.positional_index):
+            postings = self.positional_index[word]
+            for doc_id in doc_ids & postings.keys():
+                del postings[doc_id]
+            if not postings:
                 del self.positional_index[word]
-        self._remove_from_wildcard_index(word, doc_id)
+                emptied.add(word)
+        for word in emptied:
+            if word not in self.non_positional_index and word not in self.positional_index:
+                self._remove_from_wildcard_index(word)
+        for doc_id in doc_ids:
+            del self.file_name[doc_id]
+
+    def _add_to_wildcard_index(self, word):
+        for gram in kgrams(word):
+            self.wildcard_index[gram].add(word)
+
+    def _remove_from_wildcard_index(self, word):
+        for gram in kgrams(word):
+            if word in self.wildcard_index.get(gram, ()):
+                self.wildcard_index[gram].remove(word)
+                if not self.wildcard_index[gram]:
+                    del self.wildcard_index[gram]
 
-    def _add_to_wildcard_index(self, word, doc_id):
-        for i in range(len(word)):
-            for j in range(i + 1, len(word) + 1):
-                self.wildcard_index[word[i:j]].add(doc_id)
+    def _build_wildcard_index(self):
+        self.wildcard_index = defaultdict(set)
+        for word in set(self.non_positional_index) | set(self.positional_index):
+            self._add_to_wildcard_index(word)
 
-    def _remove_from_wildcard_index(self, word, doc_id):
-        for i in range(len(word)):
-            for j in range(i + 1, len(word) + 1):
-                if doc_id in self.wildcard_index[word[i:j]]:
-                    self.wildcard_index[word[i:j]].remove(doc_id)
-                    if not self.wildcard_index[word[i:j]]:
-                        del self.wildcard_index[word[i:j]]
+    def clear_index(self):
+        """Empties the index, file names and deletion marks, before a rebuild."""
+        self.file_name = dict()
+        self.non_positional_index = defaultdict(set)
+        self.positional_index = defaultdict(lambda: defaultdict(list))
+        self.wildcard_index = defaultdict(set)
+        self.deleted = set()
+        self.loaded = True
 
     def save_index(self):
-        with open("index.file", "wb") as file:
-            pickle.dump({
-                "file_names": {str(k): v for k, v in self.file_name.items()},
-                "non_positional_index": {str(k): list(v) for k, v in self.non_positional_index.items()},
-                "positional_index": {str(k): {str(dk): dv for dk, dv in v.items()} for k, v in
-                                     self.positional_index.items()},
-                "wildcard_index": {str(k): list(v) for k, v in self.wildcard_index.items()}
-            }, file)
         try:
-            with open('index.json', 'w', encoding='utf8') as file:
-                json.dump(
-                    #     {
-                    #     "file_names": {str(k): v for k, v in self.file_name.items()},
-                    #     "non_positional_index": {k: list(v) for k, v in self.non_positional_index.items()},
-                    #     "positional_index": {k: {dk: dv for dk, dv in v.items()} for k, v in self.positional_index.items()},
-                    #     "wildcard_index": {k: list(v) for k, v in self.wildcard_index.items()}
-                    # }
-                    {
-                        "file_names": {str(k): v for k, v in self.file_name.items()},
-                        "non_positional_index": {str(k): list(v) for k, v in self.non_positional_index.items()},
-                        "positional_index": {str(k): {str(dk): dv for dk, dv in v.items()} for k, v in
-                                             self.positional_index.items()},
-                        "wildcard_index": {str(k): list(v) for k, v in self.wildcard_index.items()}
-                    }, file, ensure_ascii=False)
+            self._materialize()
+            self.purge_deleted()
+            self.generation += 1
+            write_segment(INDEX_SEGMENT, self.non_positional_index, self.positional_index, self.file_name,
+                          generation=self.generation)
+            get_index_log().reset(self.generation)
         except IOError as e:
-            print(f"Error saving index to 'index.json': {e}")
+            print(f"Error saving index to '{INDEX_SEGMENT}': {e}")
 
     def load_index(self):
-        # with open("index.file", "rb") as file:
-        #     data = pickle.load(file)
+        """
+            Opens the index on disk. Decoding it into the dicts takes seconds for a large index and only full saves and
+            the compression report need them, so that waits for _materialize. Until then file names and deletions are
+            read from the segments.
+        """
+
         try:
-            # with open('index.json', 'r', encoding="utf8") as file:
-            #     data = json.load(file)
-            with open("index.file", "rb") as file:
-                data = pickle.load(file)
-                self.file_name = {str(k): v for k, v in data["file_names"].items()}
-                self.non_positional_index = defaultdict(set,
-                                                        {str(k): set(v) for k, v in
-                                                         data["non_positional_index"].items()})
-                self.positional_index = defaultdict(lambda: defaultdict(list), {str(k): defaultdict(list, v) for k, v in
-                                                                                data["positional_index"].items()})
-                self.wildcard_index = defaultdict(set, {str(k): set(v) for k, v in data["wildcard_index"].items()})
+            if os.path.exists(INDEX_MANIFEST) or os.path.exists(INDEX_SEGMENT):
+                segment = get_index_log().open()
+                self.generation = segment.generation
+                self.clear_index()
+                self.loaded = False
+                last_doc_id = max(segment.file_names, default=0)
+            else:
+                # Fall back to the pickled index written by earlier versions
+                with open("index.file", "rb") as file:
+                    self._load_data(pickle.load(file))
+                last_doc_id = max(self.file_name, default=0)
+
+            # Ids of documents added after a restart must not collide with the loaded ones
+            self.doc_id = max(self.doc_id, last_doc_id, max(get_index_log().deleted, default=0))
         except IOError as e:
-            print(f"Error loading index from 'index.json': {e}")
+            print(f"Error loading index: {e}")
+
+    def _materialize(self):
+        """
+            Decodes the index on disk into the dicts, if load_index left them empty. The log is reopened rather than
+            kept from load_index, so documents added and deleted since then are included.
+
+            Raises:
+                IOError: If the index can't be read, the dicts are left empty.
+        """
+
+        if not self.loaded:
+            self._load_data(get_index_log().open().to_dict())
+
+    def _load_data(self, data):
+        # Doc ids are ints, pickled indexes stored them as strings
+        self.file_name = {int(k): v for k, v in data["file_names"].items()}
+        self.deleted = set()
+        self.non_positional_index = defaultdict(set,
+                                                {str(k): set(map(int, v)) for k, v in
+                                                 data["non_positional_index"].items()})
+        self.positional_index = defaultdict(lambda: defaultdict(list),
+                                            {str(k): defaultdict(list, {int(doc_id): list(positions)
+                                                                        for doc_id, positions in v.items()})
+                                             for k, v in data["positional_index"].items()})
+
+        # Older indexes stored every substring of every word instead of k-grams, rebuild those
+        if "kgram_index" in data:
+            self.wildcard_index = defaultdict(set, {str(k): set(v) for k, v in data["kgram_index"].items()})
+        else:
+            self._build_wildcard_index()
+        self.loaded = True
 
     def get_memory_size(self, obj):
         """Recursively finds the size of objects in bytes."""
@@ -153,70 +299,52 @@ class Phase2:
             return sys.getsizeof(obj) + sum(self.get_memory_size(i) for i in obj)
         return sys.getsizeof(obj)
 
-    def variable_byte_encode(self, numbers, length):
-        """Encodes a list of numbers using Variable Byte Encoding."""
-        bytes_stream = []
-        for number in numbers:
-            byte_segments = []
-            while True:
-                byte_segments.insert(0, number % 128)  # Get 7 least significant bits
-                if number < 128:
-                    break
-                number //= 128
-            byte_segments[-1] += 128  # Set the continuation bit
-            bytes_stream.extend(byte_segments)
-        return bytes_stream
-
-    def gamma_encode(self, number):
-        """Encodes a single number using Gamma Encoding."""
-        if number == 0:
-            return '0'
-        binary = bin(number)[2:]
-        offset = binary[1:]  # Remove the leading 1
-        length = len(offset)
-        unary = '1' * length + '0'
-        return unary + offset
-
-    def gamma_encode_list(self, numbers):
-        """Encodes a list of numbers using Gamma Encoding."""
-        return ''.join(self.gamma_encode(number) for number in numbers)
+    def index_size(self):
+        """Returns the in-memory size of the non-positional, positional and wildcard indexes in bytes."""
+        self._materialize()
+        return sum(self.get_memory_size(index) for index in (self.non_positional_index, self.positional_index,
+                                                             self.wildcard_index))
 
     def compress_index(self, method='variable_byte'):
-        """Compresses the index using the specified method ('variable_byte' or 'gamma')."""
+        """
+            Compresses the index using the specified method ('variable_byte', 'gamma' or 'delta').
 
-        done = 0
-        process_length = 3
-
-        if method == 'variable_byte':
-            self.state_updater(done, process_length, "Compressing Non-Positional Index...")
-            non_positional_index = {
-                k: self.variable_byte_encode(list(v), len(self.non_positional_index)) for k, v
-                in self.non_positional_index.items()
-            }
-            done += 1
-            self.state_updater(done, process_length, "Compressing Positional Index...")
-            positional_index = {
-                k: {dk: self.variable_byte_encode(dv, len(self.positional_index)) for dk, dv in v.items()} for k, v
-                in self.positional_index.items()
-            }
-            done += 1
-            self.state_updater(done, process_length, "Compressing Wildcard Index...")
-            wildcard_index = {
-                k: self.variable_byte_encode(list(v), len(self.wildcard_index)) for k, v in
-                self.wildcard_index.items()
-            }
-            done += 1
-            self.state_updater(done, process_length, "Done!")
-            return {
-                "non_positional_index": non_positional_index,
-                "positional_index": positional_index,
-                "wildcard_index": wildcard_index
-            }
-        elif method == 'gamma':
-            return {
-                "non_positional_index": {k: self.gamma_encode_list(list(v)) for k, v in
-                                         self.non_positional_index.items()},
-                "positional_index": {k: {dk: self.gamma_encode_list(dv) for dk, dv in v.items()} for k, v in
-                                     self.positional_index.items()},
-                "wildcard_index": {k: self.gamma_encode_list(list(v)) for k, v in self.wildcard_index.items()}
-            }
+            The result is an in-memory segment with gap-encoded postings, built to report compressed sizes. The index
+            queries run on is the Variable Byte segment written by save_index, so nothing is kept here.
+        """
+
+        if method not in CODECS:
+            raise ValueError(f"Unknown compression method '{method}'")
+
+        self._materialize()
+        self.state_updater(0, 1, "Compressing Index...")
+        compressed_index = Segment(buffer=write_segment(None, self.non_positional_index, self.positional_index,
+                                                        self.file_name, generation=self.generation, codec=method))
+        self.state_updater(1, 1, "Done!")
+        return compressed_index
+
+
+def index_shard(documents, options):
+    """
+        Builds the partial indexes of one shard of documents, run in a worker process by Phase2.build_index.
+
+        Args:
+            documents (list): (doc_id, path) pairs.
+            options (dict): Flags passed on to Phase2.add_document.
+
+        Returns:
+            bytes: Pickled non-positional, positional and wildcard indexes of the shard, as plain dicts.
+    """
+
+    partial = Phase2()
+    for doc_id, path in documents:
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                data = file.read()
+            partial.add_document(doc_id, data, **options)
+        except IOError as e:
+            print(f"Error reading file '{path}': {e}")
+
+    return pickle.dumps((dict(partial.non_positional_index),
+                         {word: dict(postings) for word, postings in partial.positional_index.items()},
+                         dict(partial.wildcard_index)), pickle.HIGHEST_PROTOCOL)
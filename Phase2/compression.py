@@ -0,0 +1,314 @@
+"""
+    Integer codecs for postings: Variable Byte, Elias Gamma and Elias Delta.
+
+    Every codec works on whole lists at once. encode() takes any iterable of non-negative integers (a list, an
+    array('I'), a NumPy array, ...) and returns bytes; decode() returns an array('I'). With gaps=True sorted lists are
+    turned into d-gaps before encoding and summed back after decoding.
+
+    Gamma and Delta cannot encode 0, so they store number + 1. Their last byte is padded with zeros, which is why
+    decoding them needs the count of encoded numbers.
+"""
+
+import re
+from array import array
+from itertools import accumulate
+
+# Precomputed codes for the small numbers that make up nearly all gaps and positions
+SMALL_LIMIT = 1 << 14
+
+HIGH_BYTES = bytes(range(128, 256))
+LOW_BITS = bytes(range(128)) * 2
+VB_NUMBER = re.compile(rb'[\x00-\x7f]*[\x80-\xff]')
+
+
+def to_gaps(numbers):
+    """Turns a sorted list of numbers into the first number followed by the differences between neighbours."""
+    return [number - previous for previous, number in zip([0] + list(numbers[:-1]), numbers)]
+
+
+def from_gaps(gaps):
+    """Inverse of to_gaps."""
+    return list(accumulate(gaps))
+
+
+#### Variable Byte
+def _vb_number(number):
+    groups = bytearray()
+    while True:
+        groups.append(number & 127)
+        if number < 128:
+            break
+        number >>= 7
+    groups.reverse()
+    groups[-1] |= 128
+    return bytes(groups)
+
+
+def _vb_value(code):
+    number = 0
+    for byte in code:
+        number = (number << 7) | (byte & 127)
+    return number
+
+
+VB_CODES = [_vb_number(number) for number in range(SMALL_LIMIT)]
+VB_VALUES = {code: number for number, code in enumerate(VB_CODES)}
+
+
+def vb_encode(numbers):
+    """
+        Encodes non-negative integers with Variable Byte Encoding.
+
+        Every number is split into 7-bit groups, most significant first, and the last group of a number has its
+        high bit set.
+
+        Args:
+            numbers (iterable): Integers to encode.
+
+        Returns:
+            bytes: Encoded stream.
+    """
+
+    try:
+        return b''.join([VB_CODES[number] for number in numbers])
+    except IndexError:
+        return b''.join([VB_CODES[number] if number < SMALL_LIMIT else _vb_number(number) for number in numbers])
+
+
+def vb_decode(data, start=0, end=None, count=None):
+    """
+        Decodes a Variable Byte stream.
+
+        Args:
+            data (bytes-like): Buffer holding the stream, e.g. an mmap.
+            start (int, optional): Offset of the first byte. Defaults to 0.
+            end (int, optional): Offset after the last byte. Defaults to the end of the buffer.
+            count (int, optional): Not needed by this codec, accepted so every decoder has the same signature.
+
+        Returns:
+            array: Decoded integers.
+    """
+
+    chunk = bytes(data[start:end])
+
+    # Every number below 128 is a single byte with its high bit set
+    if not chunk.translate(None, HIGH_BYTES):
+        return array('I', array('B', chunk.translate(LOW_BITS)))
+
+    # The regex splits the stream into codes in C, small codes are then looked up instead of decoded bit by bit
+    codes = VB_NUMBER.findall(chunk)
+    try:
+        return array('I', [VB_VALUES[code] for code in codes])
+    except KeyError:
+        numbers = array('Q', [VB_VALUES[code] if code in VB_VALUES else _vb_value(code) for code in codes])
+    return numbers if max(numbers) >= 1 << 32 else array('I', numbers)
+
+
+#### Elias Gamma
+def _gamma_code(number):
+    offset = bin(number + 1)[3:]
+    return '1' * len(offset) + '0' + offset
+
+
+GAMMA_CODES = [_gamma_code(number) for number in range(SMALL_LIMIT)]
+GAMMA_VALUES = {code: number for number, code in enumerate(GAMMA_CODES)}
+# Matches one code of a number below SMALL_LIMIT, which Gamma codes as a unary length and that many offset bits
+GAMMA_CODE = re.compile('|'.join(f'1{{{length}}}0[01]{{{length}}}' for length in range(SMALL_LIMIT.bit_length())))
+
+
+def _pack_bits(codes):
+    bits = ''.join(codes)
+    if not bits:
+        return b''
+    bits += '0' * (-len(bits) % 8)
+    return int(bits, 2).to_bytes(len(bits) // 8, 'big')
+
+
+def _unpack_bits(data, start, end):
+    chunk = bytes(data[start:end])
+    if not chunk:
+        return ''
+    return bin(int.from_bytes(chunk, 'big'))[2:].zfill(len(chunk) * 8)
+
+
+def _match_codes(pattern, values, bits, count):
+    """
+        Decodes a bit string made only of the codes of small numbers, with the regex of those codes splitting it in C.
+        Returns None when it holds other codes, which are decoded one by one instead.
+    """
+
+    codes = pattern.findall(bits)
+    if count is not None:
+        if len(codes) < count:
+            return None
+        codes = codes[:count]
+    matched = ''.join(codes)
+    # findall skips what it cannot match, so the codes only decode the stream if they make it up exactly
+    if not bits.startswith(matched) or count is None and len(matched) != len(bits):
+        return None
+    try:
+        return array('I', [values[code] for code in codes])
+    except KeyError:
+        # The longest codes the regex matches go past the table
+        return None
+
+
+def gamma_encode(numbers):
+    """
+        Encodes non-negative integers with Elias Gamma Encoding, packed into bytes.
+
+        Every number is stored as number + 1: the length of its offset in unary (ones closed by a zero), then the
+        offset, which is its binary form without the leading 1.
+
+        Args:
+            numbers (iterable): Integers to encode.
+
+        Returns:
+            bytes: Encoded stream.
+    """
+
+    return _pack_bits([GAMMA_CODES[number] if number < SMALL_LIMIT else _gamma_code(number) for number in numbers])
+
+
+def gamma_decode(data, start=0, end=None, count=None):
+    """
+        Decodes an Elias Gamma stream.
+
+        Args:
+            data (bytes-like): Buffer holding the stream.
+            start (int, optional): Offset of the first byte. Defaults to 0.
+            end (int, optional): Offset after the last byte. Defaults to the end of the buffer.
+            count (int, optional): Number of integers to read. The zero padding of the last byte decodes as extra
+                zeros, so it is needed unless the stream is known to end on a full code. Defaults to reading all bytes.
+
+        Returns:
+            array: Decoded integers.
+    """
+
+    bits = _unpack_bits(data, start, end)
+    numbers = _match_codes(GAMMA_CODE, GAMMA_VALUES, bits, count)
+    if numbers is not None:
+        return numbers
+
+    limit = len(bits) if count is None else count
+    numbers = array('Q')
+    i = 0
+    while len(numbers) < limit and i < len(bits):
+        zero = bits.index('0', i)
+        length = zero - i
+        numbers.append(int('1' + bits[zero + 1:zero + 1 + length], 2) - 1)
+        i = zero + 1 + length
+    return numbers if numbers and max(numbers) >= 1 << 32 else array('I', numbers)
+
+
+#### Elias Delta
+def _delta_code(number):
+    binary = bin(number + 1)[2:]
+    return GAMMA_CODES[len(binary) - 1] + binary[1:]
+
+
+DELTA_CODES = [_delta_code(number) for number in range(SMALL_LIMIT)]
+DELTA_VALUES = {code: number for number, code in enumerate(DELTA_CODES)}
+# Matches one code of a number below SMALL_LIMIT: the Gamma code of its bit length, then that many bits but one
+DELTA_CODE = re.compile('|'.join(f'{GAMMA_CODES[bit_length - 1]}[01]{{{bit_length - 1}}}'
+                                 for bit_length in range(1, SMALL_LIMIT.bit_length() + 1)))
+
+
+def delta_encode(numbers):
+    """
+        Encodes non-negative integers with Elias Delta Encoding, packed into bytes.
+
+        Every number is stored as number + 1: the bit length of its binary form, Gamma-coded, then the binary form
+        without the leading 1. Shorter than Gamma for large numbers.
+
+        Args:
+            numbers (iterable): Integers to encode.
+
+        Returns:
+            bytes: Encoded stream.
+    """
+
+    return _pack_bits([DELTA_CODES[number] if number < SMALL_LIMIT else _delta_code(number) for number in numbers])
+
+
+def delta_decode(data, start=0, end=None, count=None):
+    """
+        Decodes an Elias Delta stream.
+
+        Args:
+            data (bytes-like): Buffer holding the stream.
+            start (int, optional): Offset of the first byte. Defaults to 0.
+            end (int, optional): Offset after the last byte. Defaults to the end of the buffer.
+            count (int, optional): Number of integers to read, see gamma_decode. Defaults to reading all bytes.
+
+        Returns:
+            array: Decoded integers.
+    """
+
+    bits = _unpack_bits(data, start, end)
+    numbers = _match_codes(DELTA_CODE, DELTA_VALUES, bits, count)
+    if numbers is not None:
+        return numbers
+
+    limit = len(bits) if count is None else count
+    numbers = array('Q')
+    i = 0
+    while len(numbers) < limit and i < len(bits):
+        zero = bits.index('0', i)
+        length = zero - i
+        bit_length = int('1' + bits[zero + 1:zero + 1 + length], 2)
+        i = zero + 1 + length
+        numbers.append(int('1' + bits[i:i + bit_length - 1], 2) - 1)
+        i += bit_length - 1
+    return numbers if numbers and max(numbers) >= 1 << 32 else array('I', numbers)
+
+
+# method -> (encode, decode)
+CODECS = {
+    'variable_byte': (vb_encode, vb_decode),
+    'gamma': (gamma_encode, gamma_decode),
+    'delta': (delta_encode, delta_decode),
+}
+
+
+def encode(numbers, method='variable_byte', gaps=False):
+    """
+        Encodes a list of non-negative integers.
+
+        Args:
+            numbers (iterable): Integers to encode, sorted if gaps is set.
+            method (str, optional): 'variable_byte', 'gamma' or 'delta'. Defaults to 'variable_byte'.
+            gaps (bool, optional): Store the differences between neighbours instead of the numbers. Defaults to False.
+
+        Returns:
+            bytes: Encoded stream.
+    """
+
+    if method not in CODECS:
+        raise ValueError(f"Unknown compression method '{method}'")
+    numbers = array('Q', numbers)
+    if gaps:
+        numbers = array('Q', to_gaps(numbers))
+    return CODECS[method][0](numbers)
+
+
+def decode(data, method='variable_byte', count=None, gaps=False):
+    """
+        Decodes a stream written by encode.
+
+        Args:
+            data (bytes-like): Encoded stream.
+            method (str, optional): 'variable_byte', 'gamma' or 'delta'. Defaults to 'variable_byte'.
+            count (int, optional): Number of integers, needed for 'gamma' and 'delta'. Defaults to None.
+            gaps (bool, optional): The stream holds d-gaps, return their running sums. Defaults to False.
+
+        Returns:
+            array: Decoded integers.
+    """
+
+    if method not in CODECS:
+        raise ValueError(f"Unknown compression method '{method}'")
+    numbers = CODECS[method][1](data, 0, None, count)
+    if gaps:
+        numbers = array(numbers.typecode, accumulate(numbers))
+    return numbers
@@ -0,0 +1,651 @@
+"""
+    Log-structured index: an immutable base segment plus small delta segments, and tombstones for deleted documents.
+
+    Adding a document writes a delta segment holding only that document, deleting one records its id as a
+    tombstone, so both cost the size of the document rather than of the index. The manifest lists the live segments
+    and the tombstones and is replaced atomically on every change, which also makes it the file readers watch.
+
+    Segments are merged in the background with a size-tiered policy: segments are grouped into tiers of sizes that
+    differ by less than MERGE_FACTOR times, and as soon as a tier holds MERGE_FACTOR segments they are merged into
+    one, dropping the deleted documents.
+
+    Other processes may change the index too, e.g. a SPIMI rebuild from the command line, so the log rereads the
+    manifest whenever it was replaced since it was last read or written.
+
+    Deleted documents are kept in a LiveDocs bitmap that every view of a SegmentSet filters through, so deleting
+    needs neither the document's file nor its words. A merge that purges a document clears its bit.
+
+    Manifest (JSON):
+        version, generation, next_segment, segments: [{name, docs, size}], deleted: base64 of the LiveDocs bitmap
+"""
+
+import base64
+import heapq
+import json
+import math
+import os
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from functools import lru_cache
+from itertools import groupby
+
+from .segment import INDEX_SEGMENT, Segment, SegmentWriter, write_segment
+
+INDEX_MANIFEST = 'index.manifest'
+MERGE_FACTOR = 4
+
+# Segments below this size all share the lowest tier
+MIN_TIER_SIZE = 64 << 10
+
+# Times open() rereads the manifest when a segment it lists was removed while opening
+OPEN_ATTEMPTS = 5
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+
+class LiveDocs:
+    """Bitmap of deleted doc ids, bit doc_id set when the document is deleted. Doc ids may be ints or strings."""
+
+    def __init__(self, bits=b''):
+        self.bits = bytearray(bits)
+        self.count = sum(bin(byte).count('1') for byte in self.bits)
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    def __contains__(self, doc_id):
+        try:
+            doc_id = int(doc_id)
+        except ValueError:
+            return False
+        return doc_id >> 3 < len(self.bits) and self.bits[doc_id >> 3] >> (doc_id & 7) & 1 == 1
+
+    def __iter__(self):
+        return (i << 3 | bit for i, byte in enumerate(self.bits) if byte for bit in range(8) if byte >> bit & 1)
+
+    def add(self, doc_id):
+        doc_id = int(doc_id)
+        if doc_id in self:
+            return
+        if doc_id >> 3 >= len(self.bits):
+            self.bits.extend(bytes((doc_id >> 3) - len(self.bits) + 1))
+        self.bits[doc_id >> 3] |= 1 << (doc_id & 7)
+        self.count += 1
+
+    def discard(self, doc_id):
+        doc_id = int(doc_id)
+        if doc_id in self:
+            self.bits[doc_id >> 3] &= ~(1 << (doc_id & 7))
+            self.count -= 1
+
+    def copy(self):
+        return LiveDocs(self.bits)
+
+    def encode(self):
+        return base64.b64encode(bytes(self.bits.rstrip(b'\x00'))).decode('ascii')
+
+    @classmethod
+    def decode(cls, data):
+        return cls(base64.b64decode(data))
+
+
+def get_index_log(directory='.'):
+    """Returns the IndexLog of a directory, shared by the whole process so writes, merges and rebuilds share a lock."""
+    directory = os.path.abspath(directory)
+    with _logs_lock:
+        if directory not in _logs:
+            _logs[directory] = IndexLog(directory)
+        return _logs[directory]
+
+
+class IndexLog:
+    VERSION = 1
+
+    def __init__(self, directory='.', merge_factor=MERGE_FACTOR, background=True):
+        """
+            Opens the log of an index directory.
+
+            Args:
+                directory (str, optional): Directory of the manifest and segments. Defaults to '.'.
+                merge_factor (int, optional): Segments per tier that trigger a merge. Defaults to MERGE_FACTOR.
+                background (bool, optional): Merge on a background thread instead of in the caller. Defaults to True.
+        """
+
+        self.directory = directory
+        self.path = os.path.join(directory, INDEX_MANIFEST)
+        self.merge_factor = merge_factor
+        self.background = background
+        self.lock = threading.RLock()
+        self.merge_thread = None
+        # Bumped by reset and when a changed manifest is reread, so a merge started on an older index is thrown away
+        self.epoch = 0
+        self.manifest_stat = None
+        self.load()
+
+    def _manifest_stat(self):
+        """Identifies the manifest on disk. It is always replaced, never rewritten, so any change shows here."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        """Reads the manifest, or describes a lone base segment written before manifests existed."""
+        with self.lock:
+            self.generation, self.next_segment, self.segments, self.deleted = 0, 1, [], LiveDocs()
+            # Taken before reading, so a manifest replaced in between is read again next time
+            self.manifest_stat = self._manifest_stat()
+            try:
+                with open(self.path, 'r', encoding='utf-8') as file:
+                    data = json.load(file)
+                if data.get('version') == self.VERSION:
+                    self.generation = data['generation']
+                    self.next_segment = data['next_segment']
+                    self.segments = data['segments']
+                    self.deleted = LiveDocs.decode(data['deleted'])
+                    return
+            except FileNotFoundError:
+                pass
+            except (IOError, ValueError) as e:
+                print(f"Error loading manifest '{self.path}': {e}")
+
+            base = os.path.join(self.directory, INDEX_SEGMENT)
+            if os.path.exists(base):
+                segment = Segment(base)
+                self.generation = segment.generation
+                self.segments = [{'name': INDEX_SEGMENT, 'docs': segment.doc_count, 'size': segment.size}]
+
+    def refresh(self):
+        """Rereads the manifest if another process replaced it, throwing away merges started on the old one."""
+        with self.lock:
+            if self._manifest_stat() != self.manifest_stat:
+                self.epoch += 1
+                self.load()
+
+    def _save(self):
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({'version': self.VERSION, 'generation': self.generation, 'next_segment': self.next_segment,
+                       'segments': self.segments, 'deleted': self.deleted.encode()}, file)
+        os.replace(temp_path, self.path)
+        self.manifest_stat = self._manifest_stat()
+
+    def _segment_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _new_segment_name(self):
+        name = f'segment-{self.next_segment:06d}.seg'
+        self.next_segment += 1
+        return name
+
+    def reset(self, generation):
+        """
+            Makes a freshly written base segment the whole index, removing every delta segment and tombstone.
+
+            Args:
+                generation (int): Generation of the base segment.
+        """
+
+        with self.lock:
+            old = [entry['name'] for entry in self.segments if entry['name'] != INDEX_SEGMENT]
+            base = Segment(self._segment_path(INDEX_SEGMENT))
+            self.segments = [{'name': INDEX_SEGMENT, 'docs': base.doc_count, 'size': base.size}]
+            self.deleted = LiveDocs()
+            self.generation = generation
+            self.epoch += 1
+            self._save()
+        self._remove(old)
+
+    def add_segment(self, non_positional_index, positional_index, file_names, doc_lengths=None):
+        """
+            Writes new documents as a delta segment and adds it to the index.
+
+            Args:
+                non_positional_index (dict): term -> doc ids of the new documents.
+                positional_index (dict): term -> {doc_id: positions} of the new documents.
+                file_names (dict): doc_id -> file path of the new documents.
+                doc_lengths (dict, optional): doc_id -> number of words. Derived from the positions when missing.
+
+            Returns:
+                int: Generation of the index with the segment.
+        """
+
+        with self.lock:
+            self.refresh()
+            name = self._new_segment_name()
+
+        write_segment(self._segment_path(name), non_positional_index, positional_index, file_names, doc_lengths,
+                      self.generation + 1)
+        segment = Segment(self._segment_path(name))
+
+        with self.lock:
+            self.refresh()
+            self.segments.append({'name': name, 'docs': segment.doc_count, 'size': segment.size})
+            self.generation += 1
+            self._save()
+            generation = self.generation
+
+        self.maybe_merge()
+        return generation
+
+    def delete(self, doc_id):
+        """
+            Marks a document deleted. Its postings stay in their segment until it is merged.
+
+            Args:
+                doc_id (int): Id of the document.
+
+            Returns:
+                int: Generation of the index without the document.
+        """
+
+        with self.lock:
+            self.refresh()
+            self.deleted.add(doc_id)
+            self.generation += 1
+            self._save()
+            return self.generation
+
+    def open(self):
+        """
+            Opens the live segments for reading, rereading the manifest first if it changed on disk.
+
+            Returns:
+                Segment or SegmentSet: The index, a plain Segment when there is one segment and nothing deleted.
+        """
+
+        for attempt in range(OPEN_ATTEMPTS):
+            with self.lock:
+                self.refresh()
+                names = [entry['name'] for entry in self.segments]
+                deleted, generation = self.deleted.copy(), self.generation
+            try:
+                segments = [Segment(self._segment_path(name)) for name in names]
+                break
+            except FileNotFoundError:
+                # A merge or rebuild in another process removed a segment after replacing the manifest
+                if attempt == OPEN_ATTEMPTS - 1:
+                    raise
+                with self.lock:
+                    self.epoch += 1
+                    self.load()
+
+        if len(segments) == 1 and not deleted:
+            segments[0].generation = generation
+            return segments[0]
+        return SegmentSet(segments, deleted, generation)
+
+    def tier(self, size):
+        """Returns the tier of a segment size, segments in a tier differ in size by less than merge_factor times."""
+        return 0 if size <= MIN_TIER_SIZE else int(math.log(size / MIN_TIER_SIZE, self.merge_factor)) + 1
+
+    def pick_merge(self):
+        """Returns the names of the segments of the lowest full tier, or an empty list."""
+        with self.lock:
+            tiers = {}
+            for entry in self.segments:
+                tiers.setdefault(self.tier(entry['size']), []).append(entry['name'])
+            for tier in sorted(tiers):
+                if len(tiers[tier]) >= self.merge_factor:
+                    return tiers[tier][:self.merge_factor]
+        return []
+
+    def maybe_merge(self):
+        """Starts merging if a tier is full, on a background thread unless the log was opened without one."""
+        if not self.background:
+            while self.merge(self.pick_merge()):
+                pass
+            return
+
+        with self.lock:
+            if self.merge_thread is not None and self.merge_thread.is_alive() or not self.pick_merge():
+                return
+            self.merge_thread = threading.Thread(target=self._merge_loop, name='index-merge', daemon=True)
+            self.merge_thread.start()
+
+    def _merge_loop(self):
+        try:
+            while self.merge(self.pick_merge()):
+                pass
+        except Exception as e:
+            print(f"Error merging index segments: {e}")
+
+    def wait(self):
+        """Waits for a background merge to finish."""
+        thread = self.merge_thread
+        if thread is not None:
+            thread.join()
+
+    def merge(self, names):
+        """
+            Merges segments into one, leaving out deleted documents.
+
+            Args:
+                names (list): Names of live segments.
+
+            Returns:
+                bool: Whether a merge happened.
+        """
+
+        if not names:
+            return False
+
+        with self.lock:
+            epoch = self.epoch
+            deleted = self.deleted.copy()
+            name = self._new_segment_name()
+            generation = self.generation
+
+        segments = [Segment(self._segment_path(segment_name), cache_size=0) for segment_name in names]
+        doc_lengths, file_names, purged = {}, {}, []
+        for segment in segments:
+            for doc_id, length in segment.doc_lengths.items():
+                if doc_id in deleted:
+                    purged.append(doc_id)
+                else:
+                    doc_lengths[doc_id] = length
+                    file_names[doc_id] = segment.file_names.get(doc_id)
+
+        writer = SegmentWriter(self._segment_path(name), doc_lengths, file_names, generation, segments[0].codec)
+        for term, _ in groupby(heapq.merge(*(segment.terms for segment in segments))):
+            postings = []
+            for segment in segments:
+                if segment.terms.find(term) < 0:
+                    continue
+                term_postings = segment.postings(term)
+                postings.extend((doc_id, term_postings[doc_id]) for doc_id in term_postings
+                                if doc_id not in deleted)
+            if postings:
+                postings.sort(key=lambda item: item[0])
+                writer.add_term(term, postings)
+        writer.close()
+        merged = Segment(self._segment_path(name))
+
+        with self.lock:
+            self.refresh()
+            if epoch != self.epoch:
+                self._remove([name])
+                return False
+            position = min(i for i, entry in enumerate(self.segments) if entry['name'] in names)
+            self.segments = [entry for entry in self.segments if entry['name'] not in names]
+            self.segments.insert(position, {'name': name, 'docs': merged.doc_count, 'size': merged.size})
+            # The purged documents are gone from every segment, so their bits are no longer needed. Once no bit is
+            # left, a lone segment opens as a plain Segment again.
+            others = [Segment(self._segment_path(entry['name']), cache_size=0) for entry in self.segments
+                      if entry['name'] != name]
+            for doc_id in purged:
+                if not any(doc_id in segment.doc_lengths for segment in others):
+                    self.deleted.discard(doc_id)
+            self.generation += 1
+            self._save()
+
+        self._remove(names)
+        return True
+
+    def _remove(self, names):
+        for name in names:
+            try:
+                os.remove(self._segment_path(name))
+            except OSError as e:
+                # Readers may still have the file mapped on platforms that forbid removing it
+                print(f"Error removing segment '{name}': {e}")
+
+
+class SegmentSet:
+    """Several segments and the LiveDocs of their deleted documents, exposing the same mappings as a single Segment."""
+
+    def __init__(self, segments, deleted=None, generation=0, cache_size=4096):
+        self.segments = segments
+        self.deleted = deleted if deleted is not None else LiveDocs()
+        self.postings = lru_cache(maxsize=cache_size)(self._postings)
+        self.generation = generation
+        self.codec = segments[0].codec if segments else 'variable_byte'
+
+        self.file_names = SetFileNames(self)
+        # Merged lazily, so opening the set costs the same as opening its segments
+        self.terms = MergedTerms([segment.terms for segment in segments])
+        self.reversed_terms = MergedTerms([segment.reversed_terms for segment in segments])
+
+        self.doc_lengths = SetDocLengths(self)
+        self.non_positional_index = SetView(self, lambda term: self.postings(term))
+        self.positional_index = SetView(self, lambda term: self.postings(term, positional=True),
+                                        lambda term: self.postings(term, positional=True) is not None)
+        self.doc_freq = SetView(self, self._doc_freq)
+        self.max_tf = SetView(self, lambda term: max(segment.max_tf.get(term, 0) for segment in self.segments))
+        self.wildcard_index = SetKgramView(self)
+
+    def __reduce__(self):
+        # The lru_cache and views are rebuilt, the segments are reopened by their paths
+        return SegmentSet, (self.segments, self.deleted, self.generation)
+
+    @property
+    def size(self):
+        return sum(segment.size for segment in self.segments)
+
+    def _postings(self, term, positional=False):
+        parts = []
+        for segment in self.segments:
+            ordinal = segment.terms.find(term)
+            # Terms indexed without positions are left out of the positional view, as in Segment
+            if ordinal >= 0 and (not positional or segment.entry(ordinal)[4]):
+                parts.append(segment.postings(term))
+        return SetPostings(parts, self.deleted) if parts else None
+
+    def _doc_freq(self, term):
+        if not self.deleted:
+            return sum(segment.doc_freq.get(term, 0) for segment in self.segments)
+        postings = self.postings(term)
+        return len(postings) if postings else None
+
+    def to_dict(self):
+        """Decodes every live document into the dictionary layout Phase2 and Phase3 keep in memory."""
+        positional_index = {}
+        non_positional_index = {}
+        for term in self.terms:
+            postings = self.postings(term)
+            if not postings:
+                continue
+            non_positional_index[term] = list(postings)
+            positional = self.postings(term, positional=True)
+            if positional:
+                positional_index[term] = {doc_id: list(positional[doc_id]) for doc_id in positional}
+        return {
+            "file_names": dict(self.file_names),
+            "non_positional_index": non_positional_index,
+            "positional_index": positional_index,
+            "kgram_index": {gram: list(self.wildcard_index[gram]) for gram in self.wildcard_index},
+            "doc_lengths": dict(self.doc_lengths),
+            "doc_freq": {term: len(postings) for term, postings in non_positional_index.items()},
+            "max_tf": dict(self.max_tf)
+        }
+
+
+class MergedTerms:
+    """Sorted union of the sorted term tables of several segments, merged while it is read instead of copied."""
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.count = None
+
+    def __len__(self):
+        if self.count is None:
+            self.count = sum(1 for _ in self)
+        return self.count
+
+    def __iter__(self):
+        if len(self.tables) == 1:
+            return iter(self.tables[0])
+        return (term for term, _ in groupby(heapq.merge(*self.tables)))
+
+    def __contains__(self, term):
+        return bool(self.prefix_range(term, exact=True))
+
+    def prefix_range(self, prefix, exact=False):
+        """
+            Returns the sorted terms that start with a prefix, bisecting every table and merging the slices.
+
+            Args:
+                prefix (str): Prefix of the terms.
+                exact (bool, optional): Only return the prefix itself, if it is a term. Defaults to False.
+
+            Returns:
+                list: Matching terms, without duplicates.
+        """
+
+        end = prefix + '\x00' if exact else prefix + chr(sys.maxunicode)
+        slices = []
+        for table in self.tables:
+            start = bisect_left(table, prefix)
+            slices.append(table[start:bisect_left(table, end, start)])
+        return [term for term, _ in groupby(heapq.merge(*slices))]
+
+
+class SetPostings(Mapping):
+    """doc_id -> positions of one term across segments, without deleted documents."""
+
+    def __init__(self, parts, deleted):
+        self.parts = parts
+        self.deleted = deleted
+        doc_ids = heapq.merge(*(part.doc_ids for part in parts))
+        self.doc_ids = array('I', (doc_id for doc_id in doc_ids if doc_id not in deleted) if deleted else doc_ids)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        return iter(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        return doc_id not in self.deleted and any(doc_id in part for part in self.parts)
+
+    def __getitem__(self, doc_id):
+        if doc_id not in self.deleted:
+            for part in self.parts:
+                if doc_id in part:
+                    return part[doc_id]
+        raise KeyError(doc_id)
+
+    def frequency(self, doc_id):
+        return len(self[doc_id]) if doc_id in self else 0
+
+
+class SetView(Mapping):
+    """
+        Read-only mapping over the merged term list, with values produced by a per-term function. A view that leaves
+        some terms out is given a function telling which terms it keeps.
+    """
+
+    def __init__(self, segment_set, value, keeps=None):
+        self.segment_set = segment_set
+        self.value = value
+        self.keeps = keeps
+
+    def __len__(self):
+        if self.keeps is None:
+            return len(self.segment_set.terms)
+        return sum(1 for _ in self)
+
+    def __iter__(self):
+        if self.keeps is None:
+            return iter(self.segment_set.terms)
+        return (term for term in self.segment_set.terms if self.keeps(term))
+
+    def __getitem__(self, term):
+        if not any(segment.terms.find(term) >= 0 for segment in self.segment_set.segments):
+            raise KeyError(term)
+        result = self.value(term)
+        if result is None:
+            raise KeyError(term)
+        return result
+
+    def __contains__(self, term):
+        if not any(segment.terms.find(term) >= 0 for segment in self.segment_set.segments):
+            return False
+        return self.keeps is None or self.keeps(term)
+
+
+class SetDocLengths(Mapping):
+    """doc_id -> number of words of every live document."""
+
+    def __init__(self, segment_set):
+        self.segment_set = segment_set
+        self.count = sum(segment.doc_count for segment in segment_set.segments) - \
+            sum(1 for doc_id in segment_set.deleted if any(doc_id in segment.doc_lengths
+                                                           for segment in segment_set.segments))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for segment in self.segment_set.segments:
+            for doc_id in segment.doc_lengths:
+                if doc_id not in self.segment_set.deleted:
+                    yield doc_id
+
+    def __getitem__(self, doc_id):
+        if doc_id not in self.segment_set.deleted:
+            for segment in self.segment_set.segments:
+                try:
+                    return segment.doc_lengths[doc_id]
+                except KeyError:
+                    continue
+        raise KeyError(doc_id)
+
+
+class SetFileNames(Mapping):
+    """doc_id -> file path of every live document that has one."""
+
+    def __init__(self, segment_set):
+        self.segment_set = segment_set
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __iter__(self):
+        for segment in self.segment_set.segments:
+            for doc_id in segment.file_names:
+                if doc_id not in self.segment_set.deleted:
+                    yield doc_id
+
+    def __getitem__(self, doc_id):
+        if doc_id not in self.segment_set.deleted:
+            for segment in self.segment_set.segments:
+                try:
+                    return segment.file_names[doc_id]
+                except KeyError:
+                    continue
+        raise KeyError(doc_id)
+
+
+class SetKgramView(Mapping):
+    """k-gram -> set of terms, across segments."""
+
+    def __init__(self, segment_set):
+        self.segment_set = segment_set
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __iter__(self):
+        return (gram for gram, _ in groupby(heapq.merge(*(segment.grams for segment in self.segment_set.segments))))
+
+    def __getitem__(self, gram):
+        terms = set()
+        found = False
+        for segment in self.segment_set.segments:
+            try:
+                terms |= segment.wildcard_index[gram]
+                found = True
+            except KeyError:
+                continue
+        if not found:
+            raise KeyError(gram)
+        return terms
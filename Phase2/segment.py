@@ -0,0 +1,707 @@
+"""
+    Binary on-disk index segments.
+
+    A segment holds a sorted term dictionary and, for every term, a contiguous block with its delta-encoded doc ids,
+    term frequencies and position blocks. The file is opened with mmap, so a query only reads the pages of the terms
+    it touches and opening a segment costs the same whatever the size of the index. A segment can also be built in
+    memory, which makes it a compressed index that queries run on directly.
+
+    Layout (little endian):
+        header          magic, version, codec, generation, term count, doc count, then (offset, length) per section
+        postings        per term: code(doc gaps, term frequencies, position block lengths) + code(position gaps) per doc,
+                        where code is Variable Byte, Gamma or Delta depending on the codec
+        docs            (doc_id u32, length u32) pairs sorted by doc_id
+        name_docs       u32 doc ids that have a file name, sorted
+        name_offsets    u64 offsets of every file name in name_bytes, plus the end offset
+        name_bytes      UTF-8 file names in the order of name_docs
+        term_offsets    u64 offsets of every term in term_bytes, plus the end offset
+        term_bytes      UTF-8 terms in sorted order
+        term_entries    (doc_freq u32, max_tf f64, offset u64, doc block length u32, position block length u64)
+        reversed        u32 term ordinals sorted by reversed term
+        gram_offsets    u64 offsets of every k-gram in gram_bytes, plus the end offset
+        gram_bytes      UTF-8 k-grams in sorted order
+        gram_entries    (offset u64, length u32) of the VB gap-encoded term ordinals of every k-gram
+        gram_postings   VB term ordinal blocks
+"""
+
+import heapq
+import io
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
+from itertools import accumulate, groupby
+
+from .compression import CODECS, from_gaps, to_gaps, vb_decode, vb_encode
+
+INDEX_SEGMENT = 'index.seg'
+
+MAGIC = b'IRSEG\x00\x00\x00'
+VERSION = 3
+CODEC_NAMES = list(CODECS)
+SECTIONS = ['postings', 'docs', 'name_docs', 'name_offsets', 'name_bytes', 'term_offsets', 'term_bytes',
+            'term_entries', 'reversed', 'gram_offsets', 'gram_bytes', 'gram_entries', 'gram_postings']
+
+HEADER = struct.Struct('<8sIIQII' + 'QQ' * len(SECTIONS))
+OFFSET = struct.Struct('<Q')
+ORDINAL = struct.Struct('<I')
+DOC = struct.Struct('<II')
+TERM_ENTRY = struct.Struct('<IdQIQ')
+GRAM_ENTRY = struct.Struct('<QI')
+
+KGRAM_SIZE = 2
+KGRAM_MARKER = '$'
+
+# Bytes a SegmentWriter buffer keeps in memory before it moves to a temporary file
+SPILL_LIMIT = 1 << 20
+# (key, value) pairs a SegmentWriter sorts in memory before it spills them
+SORT_LIMIT = 1 << 16
+
+
+def kgrams(word):
+    """Returns the k-grams of a word, with the start and end of the word marked."""
+    marked = f'{KGRAM_MARKER}{word}{KGRAM_MARKER}'
+    return {marked[i:i + KGRAM_SIZE] for i in range(len(marked) - KGRAM_SIZE + 1)}
+
+
+def pattern_kgrams(pattern):
+    """Returns the k-grams every match of a wildcard pattern has, those of its pieces with the outer ones marked."""
+    grams = set()
+    for piece in f'{KGRAM_MARKER}{pattern}{KGRAM_MARKER}'.split('*'):
+        grams.update(piece[i:i + KGRAM_SIZE] for i in range(len(piece) - KGRAM_SIZE + 1))
+    return grams
+
+
+class SpillBuffer:
+    """Bytes written in memory until they pass a limit, then to an anonymous temporary file."""
+
+    def __init__(self, limit=SPILL_LIMIT, directory=None):
+        self.limit = limit
+        self.directory = directory
+        self.data = bytearray()
+        self.file = None
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.file is None:
+            self.data += data
+            if len(self.data) <= self.limit:
+                return
+            self.file = tempfile.TemporaryFile(dir=self.directory)
+            data, self.data = self.data, bytearray()
+        self.file.write(data)
+
+    def copy_to(self, file):
+        """Writes the buffered bytes to a file."""
+        if self.file is None:
+            file.write(self.data)
+            return
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, file, SPILL_LIMIT)
+        self.file.seek(0, os.SEEK_END)
+
+    def clear(self):
+        self.data = bytearray()
+        self.size = 0
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ExternalSorter:
+    """
+        Sorts (key, value) pairs that may not fit in memory: every limit pairs are sorted and pickled to a temporary
+        file, and the files are merged when the pairs are read back.
+    """
+
+    BATCH = 4096
+
+    def __init__(self, limit=SORT_LIMIT, directory=None):
+        self.limit = limit
+        self.directory = directory
+        self.pairs = []
+        self.runs = []
+
+    def add(self, key, value):
+        self.pairs.append((key, value))
+        if len(self.pairs) >= self.limit:
+            self._spill()
+
+    def _spill(self):
+        self.pairs.sort()
+        run = tempfile.TemporaryFile(dir=self.directory)
+        for i in range(0, len(self.pairs), self.BATCH):
+            pickle.dump(self.pairs[i:i + self.BATCH], run, pickle.HIGHEST_PROTOCOL)
+        self.runs.append(run)
+        self.pairs = []
+
+    @staticmethod
+    def _read(run):
+        run.seek(0)
+        while True:
+            try:
+                yield from pickle.load(run)
+            except EOFError:
+                run.close()
+                return
+
+    def __iter__(self):
+        """Yields the pairs in sorted order, once."""
+        if not self.runs:
+            self.pairs.sort()
+            pairs, self.pairs = self.pairs, []
+            return iter(pairs)
+        if self.pairs:
+            self._spill()
+        return heapq.merge(*(self._read(run) for run in self.runs))
+
+
+class SegmentWriter:
+    """
+        Writes a segment term by term, streaming postings, the term dictionary and the k-grams through bounded
+        buffers, so memory use does not grow with the index.
+
+        Terms must be added in sorted order. The file is written next to its destination and moved into place on
+        close, so readers never see a half-written segment. Without a path the segment is built in memory.
+    """
+
+    def __init__(self, path, doc_lengths, file_names, generation=0, codec='variable_byte', sort_limit=SORT_LIMIT,
+                 spill_directory=None):
+        """
+            Starts a segment.
+
+            Args:
+                path (str): Destination file, or None to build the segment in memory.
+                doc_lengths (Mapping): doc_id -> number of words. A dict is sorted here, other mappings must iterate
+                    their int doc ids in order.
+                file_names (Mapping): doc_id -> file path, or None for documents without one. A dict is sorted here,
+                    other mappings must give their items in doc_id order.
+                generation (int, optional): Generation number stored in the header. Defaults to 0.
+                codec (str, optional): 'variable_byte', 'gamma' or 'delta'. Defaults to 'variable_byte'.
+                sort_limit (int, optional): Pairs sorted in memory for the reversed terms and the k-grams before
+                    they are spilled. Defaults to SORT_LIMIT.
+                spill_directory (str, optional): Where spilled buffers go. Defaults to the system temporary directory.
+        """
+
+        self.path = path
+        self.temp_path = f'{path}.tmp'
+        if isinstance(doc_lengths, dict):
+            doc_lengths = {int(k): v for k, v in sorted(doc_lengths.items(), key=lambda item: int(item[0]))}
+        self.doc_lengths = doc_lengths
+        if isinstance(file_names, dict):
+            file_names = {int(k): v for k, v in sorted(file_names.items(), key=lambda item: int(item[0]))}
+        self.file_names = file_names
+        self.generation = generation
+        self.codec = codec
+        self.encode = CODECS[codec][0]
+        # Variable Byte codes end on byte boundaries, so a doc block can be encoded piece by piece
+        self.chunked = codec == 'variable_byte'
+        self.file = open(self.temp_path, 'wb') if path else io.BytesIO()
+        self.file.write(bytes(HEADER.size))
+
+        spill = spill_directory if path else None
+        self.buffer = lambda: SpillBuffer(directory=spill) if path else SpillBuffer(limit=float('inf'))
+        self.term_offsets, self.term_bytes, self.term_entries = self.buffer(), self.buffer(), self.buffer()
+        self.term_offsets.write(OFFSET.pack(0))
+        self.reversed = ExternalSorter(sort_limit, spill)
+        self.grams = ExternalSorter(sort_limit, spill)
+        self.gram_strings = {}
+        self.term_count = 0
+        self.last_term = None
+
+        self.gaps, self.frequencies, self.lengths, self.positions = (self.buffer(), self.buffer(), self.buffer(),
+                                                                     self.buffer())
+        self.term = None
+
+    def add_term(self, term, postings):
+        """
+            Appends a term's postings.
+
+            Args:
+                term (str): Term, greater than every term added before.
+                postings (list): (doc_id, positions) pairs sorted by doc_id, positions sorted and possibly empty.
+        """
+
+        doc_ids = [doc_id for doc_id, _ in postings]
+        frequencies = [len(positions) for _, positions in postings]
+        position_blocks = [self.encode(to_gaps(positions)) for _, positions in postings]
+        self.add_encoded_term(term, doc_ids, frequencies, position_blocks)
+
+    def add_encoded_term(self, term, doc_ids, frequencies, position_blocks):
+        """
+            Appends a term's postings whose position gaps are already encoded with the segment's codec, so callers
+            streaming large postings lists never hold their positions as Python lists.
+
+            Args:
+                term (str): Term, greater than every term added before.
+                doc_ids (sequence): Sorted doc ids.
+                frequencies (sequence): Number of positions in every doc.
+                position_blocks (list): Encoded position gaps of every doc, as bytes.
+        """
+
+        self.start_term(term)
+        self.add_postings(doc_ids, frequencies, position_blocks)
+        self.finish_term()
+
+    def start_term(self, term):
+        """Starts a term whose postings are then added by add_postings, in pieces, and closed by finish_term."""
+        if self.last_term is not None and term <= self.last_term:
+            raise ValueError(f"Terms must be added in sorted order, got '{term}' after '{self.last_term}'")
+        self.term = term
+        self.term_doc_count = 0
+        self.term_max_tf = 0
+        self.previous_doc = 0
+        self.doc_ids, self.term_frequencies, self.block_lengths = array('I'), array('I'), array('I')
+
+    def add_postings(self, doc_ids, frequencies, position_blocks):
+        """
+            Adds the next postings of the current term.
+
+            Args:
+                doc_ids (sequence): Sorted doc ids, greater than the ones added before for the term.
+                frequencies (sequence): Number of positions in every doc.
+                position_blocks (list): Encoded position gaps of every doc, as bytes.
+        """
+
+        for doc_id, frequency in zip(doc_ids, frequencies):
+            length = self.doc_lengths.get(doc_id)
+            if length:
+                self.term_max_tf = max(self.term_max_tf, frequency / length)
+        for block in position_blocks:
+            self.positions.write(block)
+        self.term_doc_count += len(doc_ids)
+
+        if not self.chunked:
+            self.doc_ids.extend(doc_ids)
+            self.term_frequencies.extend(frequencies)
+            self.block_lengths.extend(len(block) for block in position_blocks)
+            return
+        if len(doc_ids):
+            self.gaps.write(self.encode([doc_ids[0] - self.previous_doc] + to_gaps(doc_ids)[1:]))
+            self.previous_doc = doc_ids[-1]
+        self.frequencies.write(self.encode(frequencies))
+        self.lengths.write(self.encode([len(block) for block in position_blocks]))
+
+    def finish_term(self):
+        """Writes the current term's postings and adds it to the dictionary."""
+        if not self.chunked:
+            self.gaps.write(self.encode(to_gaps(self.doc_ids) + list(self.term_frequencies) +
+                                        list(self.block_lengths)))
+
+        offset = self.file.tell() - HEADER.size
+        doc_block_length = self.gaps.size + self.frequencies.size + self.lengths.size
+        position_block_length = self.positions.size
+        for buffer in (self.gaps, self.frequencies, self.lengths, self.positions):
+            buffer.copy_to(self.file)
+            buffer.clear()
+
+        ordinal = self.term_count
+        term_bytes = self.term.encode('utf-8')
+        self.term_bytes.write(term_bytes)
+        self.term_offsets.write(OFFSET.pack(self.term_bytes.size))
+        self.term_entries.write(TERM_ENTRY.pack(self.term_doc_count, self.term_max_tf, offset, doc_block_length,
+                                                position_block_length))
+        self.reversed.add(self.term[::-1], ordinal)
+        for gram in kgrams(self.term):
+            # Grams repeat across terms, share one string per gram
+            self.grams.add(self.gram_strings.setdefault(gram, gram), ordinal)
+
+        self.term_count += 1
+        self.last_term = self.term
+        self.term = None
+
+    def close(self):
+        """Finishes the segment. Returns its bytes when it was built in memory."""
+        sections = {'postings': (HEADER.size, self.file.tell() - HEADER.size)}
+
+        def start_section(name):
+            sections[name] = self.file.tell()
+
+        def end_section(name):
+            sections[name] = (sections[name], self.file.tell() - sections[name])
+
+        def write_section(name, buffer):
+            start_section(name)
+            buffer.copy_to(self.file)
+            buffer.clear()
+            end_section(name)
+
+        start_section('docs')
+        for doc_id, length in self.doc_lengths.items():
+            self.file.write(DOC.pack(doc_id, length))
+        end_section('docs')
+
+        name_offsets, name_bytes = self.buffer(), self.buffer()
+        name_offsets.write(OFFSET.pack(0))
+        start_section('name_docs')
+        for doc_id, name in self.file_names.items():
+            if name is not None:
+                self.file.write(ORDINAL.pack(doc_id))
+                name_bytes.write(name.encode('utf-8'))
+                name_offsets.write(OFFSET.pack(name_bytes.size))
+        end_section('name_docs')
+        write_section('name_offsets', name_offsets)
+        write_section('name_bytes', name_bytes)
+
+        write_section('term_offsets', self.term_offsets)
+        write_section('term_bytes', self.term_bytes)
+        write_section('term_entries', self.term_entries)
+
+        start_section('reversed')
+        for _, ordinal in self.reversed:
+            self.file.write(ORDINAL.pack(ordinal))
+        end_section('reversed')
+
+        gram_offsets, gram_bytes, gram_entries, gram_postings = (self.buffer(), self.buffer(), self.buffer(),
+                                                                 self.buffer())
+        gram_offsets.write(OFFSET.pack(0))
+        for gram, pairs in groupby(self.grams, key=lambda pair: pair[0]):
+            block = vb_encode(to_gaps([ordinal for _, ordinal in pairs]))
+            gram_bytes.write(gram.encode('utf-8'))
+            gram_offsets.write(OFFSET.pack(gram_bytes.size))
+            gram_entries.write(GRAM_ENTRY.pack(gram_postings.size, len(block)))
+            gram_postings.write(block)
+        write_section('gram_offsets', gram_offsets)
+        write_section('gram_bytes', gram_bytes)
+        write_section('gram_entries', gram_entries)
+        write_section('gram_postings', gram_postings)
+
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, CODEC_NAMES.index(self.codec), self.generation, self.term_count,
+                                    len(self.doc_lengths), *[value for name in SECTIONS for value in sections[name]]))
+        if not self.path:
+            return self.file.getvalue()
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+
+def write_segment(path, non_positional_index, positional_index, file_names, doc_lengths=None, generation=0,
+                  codec='variable_byte'):
+    """
+        Writes in-memory indexes as a segment.
+
+        Args:
+            path (str): Destination file, or None to build the segment in memory.
+            non_positional_index (dict): term -> doc ids.
+            positional_index (dict): term -> {doc_id: positions}.
+            file_names (dict): doc_id -> file path.
+            doc_lengths (dict, optional): doc_id -> number of words. Derived from the positional index when missing.
+            generation (int, optional): Generation number stored in the header. Defaults to 0.
+            codec (str, optional): 'variable_byte', 'gamma' or 'delta'. Defaults to 'variable_byte'.
+
+        Returns:
+            bytes: The segment, when it was built in memory.
+    """
+
+    if doc_lengths is None:
+        doc_lengths = defaultdict(int)
+        for postings in positional_index.values():
+            for doc_id, positions in postings.items():
+                doc_lengths[int(doc_id)] += len(positions)
+
+    writer = SegmentWriter(path, doc_lengths, file_names, generation, codec)
+    for term in sorted(set(non_positional_index) | set(positional_index)):
+        positions = {int(doc_id): v for doc_id, v in positional_index.get(term, {}).items()}
+        doc_ids = set(positions) | {int(doc_id) for doc_id in non_positional_index.get(term, ())}
+        writer.add_term(term, [(doc_id, positions.get(doc_id, [])) for doc_id in sorted(doc_ids)])
+    return writer.close()
+
+
+class StringTable(Sequence):
+    """Strings stored as an offsets array and their concatenated UTF-8 bytes. find needs them sorted."""
+
+    def __init__(self, buffer, offsets, data, count):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.data = data
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        start, end = struct.unpack_from('<QQ', self.buffer, self.offsets + index * OFFSET.size)
+        return self.buffer[self.data + start:self.data + end].decode('utf-8')
+
+    def find(self, string):
+        """Returns the index of the string, or -1."""
+        index = bisect_left(self, string)
+        return index if index < self.count and self[index] == string else -1
+
+
+class ReversedTerms(Sequence):
+    """Every term spelled backwards, in sorted order, for suffix lookups."""
+
+    def __init__(self, segment):
+        self.segment = segment
+
+    def __len__(self):
+        return self.segment.term_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        ordinal = ORDINAL.unpack_from(self.segment.buffer, self.segment.sections['reversed'][0] +
+                                      index * ORDINAL.size)[0]
+        return self.segment.terms[ordinal][::-1]
+
+
+class TermPostings(Mapping):
+    """
+        doc_id -> positions of one term. Doc ids are decoded up front into a sorted array, positions every time a doc
+        is read, so a cached TermPostings does not keep them.
+    """
+
+    def __init__(self, segment, entry):
+        doc_freq, _, offset, doc_length, _ = entry
+        start = segment.sections['postings'][0] + offset
+        numbers = segment.decode(segment.buffer, start, start + doc_length, 3 * doc_freq)
+
+        self.buffer = segment.buffer
+        self.decode = segment.decode
+        self.doc_ids = array('I', accumulate(numbers[:doc_freq]))
+        self.frequencies = numbers[doc_freq:2 * doc_freq]
+        self.position_starts = list(accumulate([start + doc_length] + list(numbers[2 * doc_freq:])))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        return iter(self.doc_ids)
+
+    def _slot(self, doc_id):
+        i = bisect_left(self.doc_ids, doc_id)
+        return i if i < len(self.doc_ids) and self.doc_ids[i] == doc_id else -1
+
+    def __contains__(self, doc_id):
+        return self._slot(doc_id) >= 0
+
+    def __getitem__(self, doc_id):
+        i = self._slot(doc_id)
+        if i < 0:
+            raise KeyError(doc_id)
+        return array('I', accumulate(self.decode(self.buffer, self.position_starts[i], self.position_starts[i + 1],
+                                                 self.frequencies[i])))
+
+    def frequency(self, doc_id):
+        i = self._slot(doc_id)
+        return 0 if i < 0 else self.frequencies[i]
+
+
+class SegmentView(Mapping):
+    """
+        Read-only mapping over the segment's term dictionary, with values produced by a per-term function. A view
+        that leaves some terms out is given a function telling, from a term's ordinal, whether it keeps it.
+    """
+
+    def __init__(self, segment, value, keeps=None):
+        self.segment = segment
+        self.value = value
+        self.keeps = keeps
+
+    def __len__(self):
+        if self.keeps is None:
+            return self.segment.term_count
+        return sum(1 for ordinal in range(self.segment.term_count) if self.keeps(ordinal))
+
+    def __iter__(self):
+        if self.keeps is None:
+            return iter(self.segment.terms)
+        return (term for ordinal, term in enumerate(self.segment.terms) if self.keeps(ordinal))
+
+    def __getitem__(self, term):
+        ordinal = self.segment.terms.find(term)
+        if ordinal < 0:
+            raise KeyError(term)
+        result = self.value(term, ordinal)
+        if result is None:
+            raise KeyError(term)
+        return result
+
+    def __contains__(self, term):
+        ordinal = self.segment.terms.find(term)
+        return ordinal >= 0 and (self.keeps is None or self.keeps(ordinal))
+
+
+class FileNames(Mapping):
+    """doc_id -> file path, read from the name sections."""
+
+    def __init__(self, segment):
+        self.segment = segment
+        self.start = segment.sections['name_docs'][0]
+        self.count = segment.sections['name_docs'][1] // ORDINAL.size
+        self.names = StringTable(segment.buffer, segment.sections['name_offsets'][0],
+                                 segment.sections['name_bytes'][0], self.count)
+
+    def __len__(self):
+        return self.count
+
+    def _doc_id(self, index):
+        return ORDINAL.unpack_from(self.segment.buffer, self.start + index * ORDINAL.size)[0]
+
+    def __iter__(self):
+        return (self._doc_id(i) for i in range(self.count))
+
+    def __getitem__(self, doc_id):
+        try:
+            doc_id = int(doc_id)
+        except ValueError:
+            raise KeyError(doc_id)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._doc_id(mid) < doc_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._doc_id(lo) == doc_id:
+            return self.names[lo]
+        raise KeyError(doc_id)
+
+
+class DocLengths(Mapping):
+    """doc_id -> number of words, read from the sorted docs section."""
+
+    def __init__(self, segment):
+        self.segment = segment
+        self.start = segment.sections['docs'][0]
+
+    def __len__(self):
+        return self.segment.doc_count
+
+    def _doc(self, index):
+        return DOC.unpack_from(self.segment.buffer, self.start + index * DOC.size)
+
+    def __iter__(self):
+        return (self._doc(i)[0] for i in range(self.segment.doc_count))
+
+    def __getitem__(self, doc_id):
+        try:
+            doc_id = int(doc_id)
+        except ValueError:
+            raise KeyError(doc_id)
+        lo, hi = 0, self.segment.doc_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._doc(mid)[0] < doc_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.segment.doc_count and self._doc(lo)[0] == doc_id:
+            return self._doc(lo)[1]
+        raise KeyError(doc_id)
+
+
+class Segment:
+    """A memory-mapped or in-memory segment, exposing the same mappings Phase3 keeps in memory."""
+
+    def __init__(self, path=None, buffer=None, cache_size=4096):
+        if buffer is None:
+            with open(path, 'rb') as file:
+                buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.path = path
+        self.buffer = buffer
+
+        if len(self.buffer) < HEADER.size:
+            raise IOError(f"'{path or 'buffer'}' is too short to be an index segment")
+        header = HEADER.unpack_from(self.buffer, 0)
+        magic, version, codec, self.generation, self.term_count, self.doc_count = header[:6]
+        if magic != MAGIC or version != VERSION:
+            raise IOError(f"'{path or 'buffer'}' is not a version {VERSION} index segment")
+        self.codec = CODEC_NAMES[codec]
+        self.decode = CODECS[self.codec][1]
+        self.sections = {name: header[6 + 2 * i:8 + 2 * i] for i, name in enumerate(SECTIONS)}
+
+        self.file_names = FileNames(self)
+        self.terms = StringTable(self.buffer, self.sections['term_offsets'][0], self.sections['term_bytes'][0],
+                                 self.term_count)
+        self.reversed_terms = ReversedTerms(self)
+        self.grams = StringTable(self.buffer, self.sections['gram_offsets'][0], self.sections['gram_bytes'][0],
+                                 self.sections['gram_entries'][1] // GRAM_ENTRY.size)
+        self.postings = lru_cache(maxsize=cache_size)(self._postings)
+
+        self.doc_lengths = DocLengths(self)
+        self.non_positional_index = SegmentView(self, lambda term, ordinal: self.postings(term))
+        self.positional_index = SegmentView(self, self._positional, lambda ordinal: self.entry(ordinal)[4] > 0)
+        self.doc_freq = SegmentView(self, lambda term, ordinal: self.entry(ordinal)[0])
+        self.max_tf = SegmentView(self, lambda term, ordinal: self.entry(ordinal)[1])
+        self.wildcard_index = KgramView(self)
+
+    def __reduce__(self):
+        # Another process maps a file segment again by its path, an in-memory one gets a copy of its bytes
+        arguments = (self.path,) if self.path is not None else (None, bytes(self.buffer))
+        return Segment, arguments, {'generation': self.generation}
+
+    @property
+    def size(self):
+        return len(self.buffer)
+
+    def entry(self, ordinal):
+        return TERM_ENTRY.unpack_from(self.buffer, self.sections['term_entries'][0] + ordinal * TERM_ENTRY.size)
+
+    def _postings(self, term):
+        return TermPostings(self, self.entry(self.terms.find(term)))
+
+    def _positional(self, term, ordinal):
+        # Terms indexed without positions have empty position blocks and are left out of the positional view
+        return self.postings(term) if self.entry(ordinal)[4] else None
+
+    def to_dict(self):
+        """Decodes the whole segment into the dictionary layout Phase2 and Phase3 keep in memory."""
+        positional_index = {}
+        non_positional_index = {}
+        for term in self.terms:
+            postings = self.postings(term)
+            non_positional_index[term] = list(postings)
+            if term in self.positional_index:
+                positional_index[term] = {doc_id: list(postings[doc_id]) for doc_id in postings}
+        return {
+            "file_names": dict(self.file_names),
+            "non_positional_index": non_positional_index,
+            "positional_index": positional_index,
+            "kgram_index": {gram: list(self.wildcard_index[gram]) for gram in self.grams},
+            "doc_lengths": dict(self.doc_lengths),
+            "doc_freq": dict(self.doc_freq),
+            "max_tf": dict(self.max_tf)
+        }
+
+
+class KgramView(Mapping):
+    """k-gram -> set of terms."""
+
+    def __init__(self, segment):
+        self.segment = segment
+
+    def __len__(self):
+        return len(self.segment.grams)
+
+    def __iter__(self):
+        return iter(self.segment.grams)
+
+    def __getitem__(self, gram):
+        index = self.segment.grams.find(gram)
+        if index < 0:
+            raise KeyError(gram)
+        offset, length = GRAM_ENTRY.unpack_from(self.segment.buffer, self.segment.sections['gram_entries'][0] +
+                                                index * GRAM_ENTRY.size)
+        start = self.segment.sections['gram_postings'][0] + offset
+        return {self.segment.terms[ordinal] for ordinal in from_gaps(vb_decode(self.segment.buffer, start,
+                                                                               start + length))}
@@ -0,0 +1,369 @@
+"""
+    Single-pass in-memory indexing (SPIMI) for corpora larger than memory.
+
+    Documents are inverted into a block of term -> postings kept in compact arrays. When the block's estimated size
+    reaches the memory budget it is written to disk as a sorted run and dropped. Document lengths and file names go
+    to disk next to the runs as they come. At the end the runs are merged with a k-way merge straight into a segment
+    (see Phase2.segment), one run record at a time, so neither the full index nor a full postings list ever exists in
+    memory.
+
+    Written as the base segment of an index directory, the segment replaces the whole log-structured index (see
+    Phase2.index_log): the delta segments and tombstones of the previous index are dropped, as by Phase2.save_index.
+
+    Run file, one record per term in sorted order:
+        '<II' term length in bytes, payload length in bytes
+        term            UTF-8
+        payload         Variable Byte: doc id gap, number of positions, position gaps, ... for every doc
+
+    Run from the project root:
+        python -m Phase2.spimi Phase1/Outputs --budget 64M
+"""
+
+import argparse
+import heapq
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+from collections import defaultdict
+from collections.abc import Mapping
+from itertools import groupby
+from time import perf_counter
+
+from .compression import vb_decode, vb_encode
+from .index_log import get_index_log
+from .segment import INDEX_SEGMENT, SegmentWriter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+RECORD = struct.Struct('<II')
+LENGTH = struct.Struct('<I')
+
+# Estimated bytes a new term costs in a block: the key string, its dict slot and an empty array
+TERM_OVERHEAD = 160
+
+
+def peak_rss(children=False):
+    """Peak resident set size in bytes of this process, and of its finished children if asked. None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        peak += resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak * (1 if os.uname().sysname == 'Darwin' else 1024)
+
+
+def parse_size(size):
+    """Parses a size such as '512M', '2G' or '1048576' into bytes."""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+class DocLengthTable(Mapping):
+    """
+        doc_id -> length written to a file as documents are added, one u32 slot per doc id holding length + 1, so an
+        empty slot is 0. Once closed the file is mapped and looked up in place.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.next_id = 0
+        self.count = 0
+        self.map = None
+        self.view = memoryview(b'').cast('I')
+
+    def add(self, doc_id, length):
+        if doc_id < self.next_id:
+            raise ValueError(f"Doc ids must increase, got {doc_id} after {self.next_id - 1}")
+        self.file.write(bytes(LENGTH.size * (doc_id - self.next_id)))
+        self.file.write(LENGTH.pack(length + 1))
+        self.next_id = doc_id + 1
+        self.count += 1
+
+    def open(self):
+        """Stops adding and maps the file for lookups."""
+        self.file.close()
+        if self.next_id:
+            with open(self.path, 'rb') as file:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map).cast('I')
+
+    def close(self):
+        self.file.close()
+        self.view.release()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def __getitem__(self, doc_id):
+        if 0 <= doc_id < len(self.view) and self.view[doc_id]:
+            return self.view[doc_id] - 1
+        raise KeyError(doc_id)
+
+    def __iter__(self):
+        return (doc_id for doc_id, slot in enumerate(self.view) if slot)
+
+    def __len__(self):
+        return self.count
+
+
+class FileNameTable:
+    """doc_id -> file name written to a file as JSON lines as documents are added, read back in order by items()."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w', encoding='utf-8')
+        self.count = 0
+
+    def add(self, doc_id, file_name):
+        self.file.write(json.dumps([doc_id, file_name], ensure_ascii=False) + '\n')
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+    def items(self):
+        if not self.file.closed:
+            self.file.flush()
+        with open(self.path, 'r', encoding='utf-8') as file:
+            for line in file:
+                yield tuple(json.loads(line))
+
+    def __len__(self):
+        return self.count
+
+
+class SpimiBuilder:
+    def __init__(self, path=INDEX_SEGMENT, memory_budget=256 << 20, run_directory=None, generation=0,
+                 codec='variable_byte'):
+        """
+            Initializes a builder.
+
+            Args:
+                path (str, optional): Segment to write. Defaults to INDEX_SEGMENT.
+                memory_budget (int, optional): Bytes the process may use. What it already uses when the builder
+                    starts is taken off the budget of a block. Defaults to 256 MiB.
+                run_directory (str, optional): Where runs, document tables and the buffers of the segment writer
+                    are written. Defaults to a temporary directory.
+                generation (int, optional): Generation number of the segment. Defaults to 0.
+                codec (str, optional): Codec of the segment. Defaults to 'variable_byte'.
+        """
+
+        self.path = path
+        self.generation = generation
+        self.codec = codec
+        self.memory_budget = memory_budget
+        # Growing arrays fragment the heap, so a block takes about three times its size. What is left after that
+        # covers merging.
+        self.block_budget = max(1 << 20, (memory_budget - (peak_rss() or 0)) // 4)
+
+        self.own_run_directory = run_directory is None
+        self.run_directory = run_directory or tempfile.mkdtemp(prefix='spimi-')
+        self.runs = []
+        self.run_count = 0
+
+        self.block = defaultdict(lambda: array('I'))
+        self.block_size = 0
+        self.doc_lengths = DocLengthTable(os.path.join(self.run_directory, 'doc_lengths'))
+        self.file_names = FileNameTable(os.path.join(self.run_directory, 'file_names'))
+
+    def add_document(self, doc_id, text, file_name=None):
+        """
+            Inverts a document into the current block, flushing the block first if it is full.
+
+            Args:
+                doc_id (int): Id of the document, greater than the ids added before.
+                text (str): Preprocessed text of the document.
+                file_name (str, optional): Path of the document. Defaults to None.
+        """
+
+        positions = defaultdict(list)
+        words = text.split()
+        for pos, word in enumerate(words):
+            positions[word].append(pos)
+
+        self.doc_lengths.add(doc_id, len(words))
+        self.file_names.add(doc_id, file_name)
+
+        for word, word_positions in positions.items():
+            if word not in self.block:
+                self.block_size += TERM_OVERHEAD + len(word)
+            postings = self.block[word]
+            postings.append(doc_id)
+            postings.append(len(word_positions))
+            postings.extend(word_positions)
+            self.block_size += postings.itemsize * (2 + len(word_positions))
+
+        if self.block_size >= self.block_budget:
+            self.flush()
+
+    def flush(self):
+        """Writes the current block as a sorted run and empties it."""
+        if not self.block:
+            return
+
+        path = os.path.join(self.run_directory, f'run{len(self.runs):05d}')
+        with open(path, 'wb') as file:
+            for term in sorted(self.block):
+                payload = vb_encode(self._gaps(self.block[term]))
+                term_bytes = term.encode('utf-8')
+                file.write(RECORD.pack(len(term_bytes), len(payload)))
+                file.write(term_bytes)
+                file.write(payload)
+
+        self.runs.append(path)
+        self.run_count += 1
+        self.block = defaultdict(lambda: array('I'))
+        self.block_size = 0
+
+    @staticmethod
+    def _gaps(postings):
+        # doc id, count, positions... -> doc id gap, count, position gaps...
+        numbers = []
+        previous_doc = i = 0
+        while i < len(postings):
+            doc_id, count = postings[i], postings[i + 1]
+            numbers.append(doc_id - previous_doc)
+            numbers.append(count)
+            previous_position = 0
+            for position in postings[i + 2:i + 2 + count]:
+                numbers.append(position - previous_position)
+                previous_position = position
+            previous_doc = doc_id
+            i += 2 + count
+        return numbers
+
+    @staticmethod
+    def read_run(path):
+        """Yields (term, payload) of a run in term order, the payload still encoded."""
+        with open(path, 'rb') as file:
+            while True:
+                header = file.read(RECORD.size)
+                if not header:
+                    return
+                term_length, payload_length = RECORD.unpack(header)
+                yield file.read(term_length).decode('utf-8'), file.read(payload_length)
+
+    def finish(self):
+        """
+            Flushes the last block and merges every run into the segment.
+
+            Returns:
+                str: Path of the segment.
+        """
+
+        self.flush()
+
+        # A new base segment replaces the whole log-structured index, so it must outrank its generation
+        log = self._index_log()
+        if log is not None:
+            self.generation = max(self.generation, log.generation + 1)
+        self.doc_lengths.open()
+        self.file_names.close()
+        # A pair to sort takes about a hundred bytes
+        writer = SegmentWriter(self.path, self.doc_lengths, self.file_names, self.generation, self.codec,
+                               sort_limit=max(1024, self.block_budget // 128), spill_directory=self.run_directory)
+
+        # Runs hold increasing doc ids and merge is stable, so postings of a term arrive in doc id order, and go
+        # to the writer one run record at a time
+        merged = heapq.merge(*(self.read_run(path) for path in self.runs), key=lambda record: record[0])
+        for term, records in groupby(merged, key=lambda record: record[0]):
+            writer.start_term(term)
+            for _, payload in records:
+                numbers = vb_decode(payload)
+                doc_ids, frequencies, position_blocks = array('I'), array('I'), []
+                doc_id = i = 0
+                while i < len(numbers):
+                    doc_id += numbers[i]
+                    count = numbers[i + 1]
+                    doc_ids.append(doc_id)
+                    frequencies.append(count)
+                    # Positions are stored as gaps in runs too, they go to the segment as they are
+                    position_blocks.append(writer.encode(numbers[i + 2:i + 2 + count]))
+                    i += 2 + count
+                writer.add_postings(doc_ids, frequencies, position_blocks)
+            writer.finish_term()
+        writer.close()
+        if log is not None:
+            # Drops the delta segments and tombstones of the index the segment replaces
+            log.reset(self.generation)
+
+        self.cleanup()
+        return self.path
+
+    def _index_log(self):
+        """Returns the IndexLog the segment is the base of, None when it is written anywhere else."""
+        if os.path.basename(self.path) != INDEX_SEGMENT:
+            return None
+        return get_index_log(os.path.dirname(self.path) or '.')
+
+    def cleanup(self):
+        """Removes the runs and the document tables."""
+        self.doc_lengths.close()
+        self.file_names.close()
+        for path in self.runs + [self.doc_lengths.path, self.file_names.path]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.runs = []
+        if self.own_run_directory:
+            shutil.rmtree(self.run_directory, ignore_errors=True)
+
+
+def build_directory(input_directory, path=INDEX_SEGMENT, memory_budget=256 << 20, **kwargs):
+    """
+        Indexes every file under a directory with a SpimiBuilder, numbering them from 1 in sorted path order.
+
+        Args:
+            input_directory (str): Directory of text files, searched recursively.
+            path (str, optional): Segment to write. Defaults to INDEX_SEGMENT.
+            memory_budget (int, optional): See SpimiBuilder. Defaults to 256 MiB.
+            **kwargs: Other SpimiBuilder arguments.
+
+        Returns:
+            SpimiBuilder: The builder, with its runs merged and removed.
+    """
+
+    builder = SpimiBuilder(path, memory_budget, **kwargs)
+    paths = sorted(os.path.join(root, name) for root, _, names in os.walk(input_directory) for name in names)
+
+    for doc_id, file_path in enumerate(paths, start=1):
+        try:
+            with open(file_path, 'r', encoding='utf-8') as file:
+                builder.add_document(doc_id, file.read(), file_path)
+        except IOError as e:
+            print(f"Error reading file '{file_path}': {e}")
+
+    builder.finish()
+    return builder
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='Directory of preprocessed text files.')
+    parser.add_argument('--output', default=INDEX_SEGMENT, help=f'Segment to write. Defaults to {INDEX_SEGMENT}.')
+    parser.add_argument('--budget', default='256M', help='Memory budget, e.g. 64M or 2G. Defaults to 256M.')
+    parser.add_argument('--codec', default='variable_byte', help='Codec of the segment.')
+    args = parser.parse_args()
+
+    budget = parse_size(args.budget)
+    start = perf_counter()
+    builder = build_directory(args.input, args.output, budget, codec=args.codec)
+
+    print(f"{len(builder.doc_lengths)} documents in {perf_counter() - start:.2f} s, {builder.run_count} runs")
+    rss = peak_rss()
+    print(f"budget {budget / (1 << 20):.1f} MiB, peak RSS {f'{rss / (1 << 20):.1f} MiB' if rss else 'unknown'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,435 @@
+import os
+import random
+import shutil
+import tempfile
+from array import array
+
 from django.test import TestCase
 
-# Create your tests here.
+from .compression import CODECS, decode, encode, from_gaps, to_gaps
+from . import segment as segment_module
+from .Phases import Phase2
+from .index_log import INDEX_MANIFEST, IndexLog, LiveDocs, SegmentSet, get_index_log
+from .segment import INDEX_SEGMENT, Segment, SegmentWriter, kgrams, write_segment
+from .spimi import SpimiBuilder, build_directory
+
+
+class CompressionTests(TestCase):
+    """Round trips every codec over edge cases and random postings."""
+
+    CASES = [
+        [],
+        [0],
+        [1],
+        [127, 128, 129],
+        [16383, 16384, 16385],
+        [2 ** 32 - 1],
+        [2 ** 40 + 3, 0, 5],
+        list(range(300)),
+    ]
+
+    def test_round_trip(self):
+        for method in CODECS:
+            for numbers in self.CASES:
+                with self.subTest(method=method, numbers=numbers[:5]):
+                    self.assertEqual(list(decode(encode(numbers, method), method, count=len(numbers))), numbers)
+
+    def test_round_trip_random(self):
+        rng = random.Random(0)
+        for method in CODECS:
+            for _ in range(200):
+                numbers = [rng.randint(0, rng.choice([1, 127, 20000, 10 ** 6])) for _ in range(rng.randint(0, 50))]
+                self.assertEqual(list(decode(encode(numbers, method), method, count=len(numbers))), numbers)
+
+    def test_round_trip_gaps(self):
+        rng = random.Random(1)
+        for method in CODECS:
+            for _ in range(100):
+                numbers = sorted(rng.sample(range(1, 10 ** 5), rng.randint(0, 50)))
+                data = encode(numbers, method, gaps=True)
+                self.assertEqual(list(decode(data, method, count=len(numbers), gaps=True)), numbers)
+
+    def test_array_input(self):
+        numbers = array('I', [3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5, 200000])
+        for method in CODECS:
+            decoded = decode(encode(numbers, method), method, count=len(numbers))
+            self.assertEqual(decoded, numbers)
+
+    def test_known_codes(self):
+        self.assertEqual(encode([5, 300]), bytes([0x85, 0x02, 0xac]))
+        # gamma of 1, 2, 3, 4 -> 0 100 101 11000, zero padded
+        self.assertEqual(encode([0, 1, 2, 3], 'gamma'), bytes([0b01001011, 0b10000000]))
+
+    def test_gaps(self):
+        self.assertEqual(to_gaps([3, 7, 8, 20]), [3, 4, 1, 12])
+        self.assertEqual(from_gaps([3, 4, 1, 12]), [3, 7, 8, 20])
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            encode([1], 'unary')
+
+
+def random_index(seed=0, documents=60, vocabulary=80):
+    """Returns (non_positional_index, positional_index, file_names) of random documents, some without positions."""
+    rng = random.Random(seed)
+    words = sorted({''.join(rng.choices('abcdefgh', k=rng.randint(1, 6))) for _ in range(vocabulary)})
+    non_positional_index, positional_index = {}, {}
+    for doc_id in range(1, documents + 1):
+        for position in range(rng.randint(1, 40)):
+            word = rng.choice(words)
+            non_positional_index.setdefault(word, set()).add(doc_id)
+            positional_index.setdefault(word, {}).setdefault(doc_id, []).append(position)
+    # Terms indexed without positions
+    for word in rng.sample(words, 5):
+        non_positional_index.setdefault(f'{word}-np', set()).update(rng.sample(range(1, documents + 1), 3))
+    file_names = {doc_id: f'docs/{doc_id}.txt' for doc_id in range(1, documents + 1)}
+    return non_positional_index, positional_index, file_names
+
+
+class SegmentTests(TestCase):
+    """Writes segments and reads them back."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='segment-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def assert_segment(self, segment, non_positional_index, positional_index, file_names):
+        self.assertEqual(list(segment.terms), sorted(non_positional_index))
+        self.assertEqual(list(segment.reversed_terms), sorted(term[::-1] for term in non_positional_index))
+        self.assertEqual(segment.file_names, file_names)
+        doc_lengths = {}
+        for postings in positional_index.values():
+            for doc_id, positions in postings.items():
+                doc_lengths[doc_id] = doc_lengths.get(doc_id, 0) + len(positions)
+        self.assertEqual(dict(segment.doc_lengths), doc_lengths)
+
+        for term, doc_ids in non_positional_index.items():
+            self.assertEqual(list(segment.non_positional_index[term]), sorted(doc_ids))
+            self.assertEqual(segment.doc_freq[term], len(doc_ids))
+            if term in positional_index:
+                postings = positional_index[term]
+                read = segment.positional_index[term]
+                self.assertEqual({doc_id: list(read[doc_id]) for doc_id in read}, postings)
+                max_tf = max(len(positions) / doc_lengths[doc_id] for doc_id, positions in postings.items())
+                self.assertAlmostEqual(segment.max_tf[term], max_tf)
+            else:
+                self.assertNotIn(term, segment.positional_index)
+        self.assertNotIn('missing', segment.non_positional_index)
+        self.assertEqual(list(segment.positional_index), sorted(positional_index))
+        self.assertEqual(len(segment.positional_index), len(positional_index))
+
+        grams = {}
+        for term in non_positional_index:
+            for gram in kgrams(term):
+                grams.setdefault(gram, set()).add(term)
+        self.assertEqual({gram: segment.wildcard_index[gram] for gram in segment.wildcard_index}, grams)
+
+    def test_round_trip(self):
+        index = random_index()
+        for codec in CODECS:
+            with self.subTest(codec=codec):
+                path = os.path.join(self.directory, f'{codec}.seg')
+                write_segment(path, *index, generation=7, codec=codec)
+                segment = Segment(path)
+                self.assertEqual((segment.codec, segment.generation), (codec, 7))
+                self.assert_segment(segment, *index)
+                self.assert_segment(Segment(buffer=write_segment(None, *index, codec=codec)), *index)
+
+    def test_spilled_writer(self):
+        # Buffers and sorts small enough to go through temporary files write the same segment
+        index = random_index(seed=1)
+        expected = write_segment(None, *index)
+        path = os.path.join(self.directory, 'spilled.seg')
+        limit = segment_module.SPILL_LIMIT
+        segment_module.SPILL_LIMIT = 16
+        try:
+            writer = SegmentWriter(path, dict(Segment(buffer=expected).doc_lengths), index[2], sort_limit=10,
+                                   spill_directory=self.directory)
+            for term in sorted(index[0]):
+                postings = index[1].get(term, {})
+                writer.add_term(term, [(doc_id, postings.get(doc_id, [])) for doc_id in sorted(index[0][term])])
+            writer.close()
+        finally:
+            segment_module.SPILL_LIMIT = limit
+        with open(path, 'rb') as file:
+            self.assertEqual(file.read(), expected)
+
+    def test_file_names(self):
+        # Documents without words still have a name, documents without a name are left out
+        file_names = {3: 'Inputs/2003/سند.txt', 1: 'a.txt', 7: None, 12: 'empty.txt'}
+        segment = Segment(buffer=write_segment(None, {'x': {1, 3}}, {'x': {1: [0], 3: [0, 1]}}, file_names))
+        self.assertEqual(dict(segment.file_names), {1: 'a.txt', 3: 'Inputs/2003/سند.txt', 12: 'empty.txt'})
+        self.assertEqual(list(segment.file_names), [1, 3, 12])
+        self.assertEqual(segment.file_names['3'], 'Inputs/2003/سند.txt')
+        for doc_id in [0, 2, 7, 13, 'x']:
+            self.assertNotIn(doc_id, segment.file_names)
+
+    def test_positions_are_not_kept(self):
+        segment = Segment(buffer=write_segment(None, *random_index(seed=3)))
+        postings = segment.positional_index[segment.terms[0]]
+        doc_id = next(iter(postings))
+        self.assertEqual(postings[doc_id], postings[doc_id])
+        self.assertIsNot(postings[doc_id], postings[doc_id])
+
+    def test_unsorted_terms(self):
+        writer = SegmentWriter(None, {1: 1}, {1: 'a'})
+        writer.add_term('b', [(1, [0])])
+        with self.assertRaises(ValueError):
+            writer.add_term('a', [(1, [0])])
+
+
+class IndexLogTests(TestCase):
+    """Adds, deletes and merges documents through an IndexLog and reopens it from its manifest."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='index-log-test-')
+        self.non_positional_index, self.positional_index, self.file_names = random_index(seed=2, documents=40)
+        write_segment(os.path.join(self.directory, INDEX_SEGMENT), *self.documents(range(1, 21)), generation=1)
+        self.log = IndexLog(self.directory, merge_factor=3, background=False)
+        self.log.reset(1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def documents(self, doc_ids):
+        """The indexes and file names of some of the random documents."""
+        doc_ids = set(doc_ids)
+        non_positional_index = {term: ids & doc_ids for term, ids in self.non_positional_index.items() if ids & doc_ids}
+        positional_index = {term: {doc_id: positions for doc_id, positions in postings.items() if doc_id in doc_ids}
+                            for term, postings in self.positional_index.items() if postings.keys() & doc_ids}
+        return non_positional_index, positional_index, {doc_id: self.file_names[doc_id] for doc_id in doc_ids}
+
+    def assert_index(self, index, doc_ids):
+        non_positional_index, positional_index, file_names = self.documents(doc_ids)
+        self.assertEqual(sorted(index.doc_lengths), sorted(doc_ids))
+        self.assertEqual(index.file_names, file_names)
+        for term in self.non_positional_index:
+            postings = index.non_positional_index.get(term)
+            self.assertEqual(sorted(postings) if postings else [], sorted(non_positional_index.get(term, ())))
+            if term in positional_index:
+                read = index.positional_index[term]
+                self.assertEqual({doc_id: list(read[doc_id]) for doc_id in read}, positional_index[term])
+
+    def test_live_docs(self):
+        live = LiveDocs()
+        for doc_id in [3, 0, 17, 200]:
+            live.add(doc_id)
+        live.discard(17)
+        decoded = LiveDocs.decode(live.encode())
+        self.assertEqual(sorted(decoded), [0, 3, 200])
+        self.assertNotIn(17, decoded)
+        self.assertNotIn(10 ** 6, decoded)
+
+    def test_manifest_round_trip(self):
+        self.log.add_segment(*self.documents(range(21, 26)))
+        self.log.add_segment(*self.documents(range(26, 31)))
+        self.log.delete(4)
+        self.log.delete(23)
+
+        reopened = IndexLog(self.directory, merge_factor=3, background=False)
+        self.assertEqual(reopened.generation, self.log.generation)
+        self.assertEqual(reopened.segments, self.log.segments)
+        self.assertEqual(sorted(reopened.deleted), [4, 23])
+
+        index = reopened.open()
+        self.assertIsInstance(index, SegmentSet)
+        self.assertEqual(index.generation, self.log.generation)
+        self.assert_index(index, set(range(1, 31)) - {4, 23})
+
+    def test_merge_purges_deleted_documents(self):
+        # Hold merges back until the deletes are in
+        self.log.merge_factor = 10
+        for start in range(21, 41, 5):
+            self.log.add_segment(*self.documents(range(start, start + 5)))
+        for doc_id in [2, 22, 27, 33, 38]:
+            self.log.delete(doc_id)
+        self.assertEqual(len(self.log.segments), 5)
+        self.log.merge_factor = 3
+        self.log.maybe_merge()
+        self.assertEqual(len(self.log.segments), 1)
+
+        live = set(range(1, 41)) - {2, 22, 27, 33, 38}
+        self.assert_index(self.log.open(), live)
+        merged = [doc_id for entry in self.log.segments
+                  for doc_id in Segment(os.path.join(self.directory, entry['name'])).doc_lengths]
+        self.assertEqual(sorted(merged), sorted(live))
+        self.assertEqual(len(self.log.deleted), 0)
+
+    def test_merge_into_one_segment(self):
+        self.log.delete(5)
+        self.log.merge([entry['name'] for entry in self.log.segments])
+        index = self.log.open()
+        self.assertIsInstance(index, Segment)
+        self.assertEqual(index.generation, self.log.generation)
+        self.assert_index(index, set(range(1, 21)) - {5})
+
+    def test_reset(self):
+        self.log.add_segment(*self.documents(range(21, 26)))
+        self.log.delete(2)
+        write_segment(os.path.join(self.directory, INDEX_SEGMENT), *self.documents(range(1, 11)), generation=9)
+        self.log.reset(9)
+
+        reopened = IndexLog(self.directory)
+        self.assertEqual((reopened.generation, len(reopened.deleted)), (9, 0))
+        self.assertEqual([entry['name'] for entry in reopened.segments], [INDEX_SEGMENT])
+        self.assertEqual(sorted(os.listdir(self.directory)), [INDEX_MANIFEST, INDEX_SEGMENT])
+        self.assert_index(reopened.open(), range(1, 11))
+
+    def test_changes_from_another_process(self):
+        self.log.add_segment(*self.documents(range(21, 26)))
+        self.log.delete(2)
+        self.assert_index(self.log.open(), set(range(1, 26)) - {2})
+
+        # A second log on the same directory stands in for another process, e.g. a rebuild from the command line
+        other = IndexLog(self.directory, merge_factor=3, background=False)
+        write_segment(os.path.join(self.directory, INDEX_SEGMENT), *self.documents(range(1, 11)), generation=9)
+        other.reset(9)
+        index = self.log.open()
+        self.assertIsInstance(index, Segment)
+        self.assertEqual(index.generation, 9)
+        self.assert_index(index, range(1, 11))
+
+        other.add_segment(*self.documents(range(11, 16)))
+        self.log.delete(3)
+        self.log.add_segment(*self.documents(range(16, 21)))
+        self.assert_index(other.open(), set(range(1, 21)) - {3})
+        self.assert_index(self.log.open(), set(range(1, 21)) - {3})
+
+
+class SpimiTests(TestCase):
+    """Builds indexes with SpimiBuilder in a temporary directory."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='spimi-test-')
+        self.inputs = os.path.join(self.directory, 'inputs')
+        os.makedirs(self.inputs)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write_inputs(self, texts):
+        for i, text in enumerate(texts, start=1):
+            with open(os.path.join(self.inputs, f'{i:03d}.txt'), 'w', encoding='utf-8') as file:
+                file.write(text)
+
+    def test_rebuild_replaces_index_log(self):
+        path = os.path.join(self.directory, INDEX_SEGMENT)
+        log = get_index_log(self.directory)
+        write_segment(path, {'a': {1, 2, 3}}, {'a': {1: [0], 2: [0], 3: [0]}}, {1: 'x', 2: 'y', 3: 'z'},
+                      generation=1)
+        log.reset(1)
+        log.add_segment({'old4': {4}}, {'old4': {4: [0]}}, {4: 'w'})
+        log.delete(1)
+        log.wait()
+
+        self.write_inputs(['a b', 'b c', 'c d', 'new4'])
+        build_directory(self.inputs, path, memory_budget=1 << 20)
+
+        index = log.open()
+        self.assertIsInstance(index, Segment)
+        self.assertGreater(index.generation, 2)
+        self.assertEqual(sorted(index.doc_lengths), [1, 2, 3, 4])
+        self.assertNotIn('old4', index.non_positional_index)
+        self.assertEqual(list(index.non_positional_index['new4']), [4])
+        self.assertEqual(len(log.deleted), 0)
+        self.assertEqual([name for name in os.listdir(self.directory) if name.startswith('segment-')], [])
+
+    def in_memory_segment(self, texts, codec='variable_byte'):
+        """The segment of texts written from in-memory indexes, doc ids counting from 1."""
+        non_positional_index, positional_index = {}, {}
+        for doc_id, text in enumerate(texts, start=1):
+            for position, word in enumerate(text.split()):
+                non_positional_index.setdefault(word, set()).add(doc_id)
+                positional_index.setdefault(word, {}).setdefault(doc_id, []).append(position)
+        file_names = {doc_id: os.path.join(self.inputs, f'{doc_id:03d}.txt') for doc_id in range(1, len(texts) + 1)}
+        return write_segment(None, non_positional_index, positional_index, file_names, codec=codec)
+
+    def test_matches_in_memory_build(self):
+        rng = random.Random(3)
+        words = [''.join(rng.choices('abcdefgh', k=rng.randint(1, 6))) for _ in range(300)]
+        texts = [' '.join(rng.choices(words, k=rng.randint(1, 200))) for _ in range(120)]
+        self.write_inputs(texts)
+
+        for codec in CODECS:
+            with self.subTest(codec=codec):
+                path = os.path.join(self.directory, f'{codec}.seg')
+                builder = build_directory(self.inputs, path, codec=codec)
+                self.assertEqual(builder.run_count, 1)
+                with open(path, 'rb') as file:
+                    self.assertEqual(file.read(), self.in_memory_segment(texts, codec))
+
+    def test_many_runs(self):
+        rng = random.Random(4)
+        words = [''.join(rng.choices('abcdefgh', k=rng.randint(1, 6))) for _ in range(300)]
+        texts = [' '.join(rng.choices(words, k=rng.randint(1, 200))) for _ in range(120)]
+        self.write_inputs(texts)
+
+        path = os.path.join(self.directory, 'runs.seg')
+        run_directory = os.path.join(self.directory, 'runs')
+        os.makedirs(run_directory)
+        builder = SpimiBuilder(path, run_directory=run_directory)
+        # Blocks of a few documents, so terms are spread over many runs
+        builder.block_budget = 4096
+        for doc_id, text in enumerate(texts, start=1):
+            builder.add_document(doc_id, text, os.path.join(self.inputs, f'{doc_id:03d}.txt'))
+        builder.finish()
+
+        self.assertGreater(builder.run_count, 10)
+        self.assertEqual(os.listdir(builder.run_directory), [])
+        with open(path, 'rb') as file:
+            self.assertEqual(file.read(), self.in_memory_segment(texts))
+
+
+class Phase2Tests(TestCase):
+    """Loads, changes and saves an index through Phase2 in a temporary working directory."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='phase2-test-')
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        write_segment(INDEX_SEGMENT, {'a': {1, 3}, 'b': {1, 2}, 'c': {3}},
+                      {'a': {1: [0], 3: [0]}, 'b': {1: [1], 2: [0]}, 'c': {3: [1]}},
+                      {1: 'a.txt', 2: 'b.txt', 3: 'c.txt'}, generation=1)
+
+    def tearDown(self):
+        get_index_log().wait()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def assert_loaded(self, phase):
+        self.assertEqual(phase.file_name, {2: 'b.txt', 3: 'c.txt', 4: 'd.txt'})
+        self.assertEqual(dict(phase.non_positional_index), {'a': {3}, 'b': {2, 4}, 'c': {3, 4}})
+        self.assertEqual({word: dict(postings) for word, postings in phase.positional_index.items()},
+                         {'a': {3: [0]}, 'b': {2: [0], 4: [0]}, 'c': {3: [1], 4: [1]}})
+        self.assertEqual(phase.wildcard_index['$b'], {'b'})
+
+    def test_load_is_lazy(self):
+        phase = Phase2()
+        phase.load_index()
+        self.assertFalse(phase.loaded)
+        self.assertEqual(dict(phase.non_positional_index), {})
+        self.assertEqual(phase.doc_id, 3)
+        self.assertTrue(phase.has_document(1))
+        self.assertFalse(phase.has_document(4))
+
+        # Documents added and deleted before the dicts are decoded only go to the index log
+        doc_id = phase.next_doc_id()
+        phase.file_name[doc_id] = 'd.txt'
+        phase.add_document_single(doc_id, 'b c')
+        phase.save_document(doc_id, 'b c')
+        phase.remove_document_single(1)
+        self.assertTrue(phase.has_document(4))
+        self.assertFalse(phase.has_document(1))
+        self.assertFalse(phase.loaded)
+        self.assertEqual(dict(phase.non_positional_index), {})
+
+        phase.save_index()
+        self.assertTrue(phase.loaded)
+        self.assert_loaded(phase)
+
+        reloaded = Phase2()
+        reloaded.load_index()
+        self.assertEqual(reloaded.index_size(), phase.index_size())
+        self.assert_loaded(reloaded)
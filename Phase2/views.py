@@ -1,5 +1,6 @@
+import copy
 import os
-from collections import defaultdict
+import threading
 from time import sleep
 
 from .Phases import Phase2
@@ -8,10 +9,15 @@ from django.http import JsonResponse
 from django.shortcuts import render
 from rest_framework.decorators import api_view
 
+from core.jobs import job_runner
+
 # Creating an instance of Phase1 class
 phase_object = Phase2()
 phase_object.load_index()
 
+# Index builds and single document changes take turns, so a change is never made to an index a build is replacing
+build_lock = threading.Lock()
+
 
 # Create your views here.
 def index(request):
@@ -47,37 +53,37 @@ def set_initial_state():
 @api_view(['POST'])
 def add_document_single_api(request):
     input_dir = request.data.get('inputDirPath')
-    doc_id = Phase2.next_doc_id()
-    phase_object.file_name[doc_id] = input_dir
-    set_initial_state()
 
-    try:
-        with open(input_dir, 'r', encoding='utf-8') as file:
-            data = file.read()
-        phase_object.add_document_single(doc_id, data)
-    except IOError as e:
-        print(f"Error reading file '{input_dir}': {e}")
+    with build_lock:
+        doc_id = phase_object.next_doc_id()
+        phase_object.file_name[doc_id] = input_dir
+        set_initial_state()
+
+        try:
+            with open(input_dir, 'r', encoding='utf-8') as file:
+                data = file.read()
+            phase_object.add_document_single(doc_id, data)
+            phase_object.save_document(doc_id, data)
+        except IOError as e:
+            print(f"Error reading file '{input_dir}': {e}")
 
-    phase_object.save_index()
     return JsonResponse({'status': 'success'})
 
 
 @api_view(['POST'])
 def remove_document_single_api(request):
-    doc_id = int(request.data.get('inputDirPath'))
-    set_initial_state()
-
     try:
-        with open(phase_object.file_name[doc_id], 'r', encoding='utf-8') as file:
-            data = file.read()
-        phase_object.remove_document_single(doc_id, data)
-    except IOError as e:
-        print(f"Error reading file '{phase_object.file_name[doc_id]}': {e}")
+        doc_id = int(request.data.get('inputDirPath'))
+    except (TypeError, ValueError):
+        return JsonResponse({'status': 'error', 'message': 'Document id must be a number !'})
+
+    with build_lock:
+        set_initial_state()
 
-    except KeyError as e:
-        return JsonResponse({'status': 'error', 'message': f'Can\'t find this document !'})
+        if not phase_object.has_document(doc_id):
+            return JsonResponse({'status': 'error', 'message': f'Can\'t find this document !'})
 
-    phase_object.save_index()
+        phase_object.remove_document_single(doc_id)
     return JsonResponse({'status': 'success'})
 
 
@@ -86,7 +92,7 @@ def index_document_api(request):
     input_dir = request.data.get('inputDirPath')
 
     params = {key: request.data.get(key, False) for key in ['non-positional', 'positional', 'wildcard']}
-    set_initial_state()
+    parallel = request.data.get('parallel', False)
 
     try:
         inputs = [i for i in os.listdir(input_dir)]
@@ -94,65 +100,92 @@ def index_document_api(request):
         print(f"Error reading directory {input_dir}: {e}")
         return JsonResponse({'status': 'error', 'message': f'Can\'t find this directory!'})
 
-    done = 0
-    process_length = len(inputs)
+    # The job builds into its own copy, searches keep using the current index until it is done
+    job_id = job_runner.submit('index_documents', copy.copy(phase_object), index_documents_job, input_dir, inputs,
+                               params, parallel)
+    return JsonResponse({'status': 'success', 'job_id': job_id})
 
-    # clear previous files
-    Phase2.doc_id = 0
-    phase_object.file_name = dict()
-    phase_object.non_positional_index = defaultdict(set)
-    phase_object.positional_index = defaultdict(lambda: defaultdict(list))
-    phase_object.wildcard_index = defaultdict(set)
 
-    for x, filename in enumerate(inputs, start=1):
-        doc_id = Phase2.next_doc_id()
-        phase_object.file_name[doc_id] = os.path.join(input_dir, filename)
+def index_documents_job(phase, input_dir, inputs, params, parallel):
+    """Builds the index of a directory as a background job and makes it the current one."""
+    global phase_object
 
-        try:
-            with open(phase_object.file_name[doc_id], 'r', encoding='utf-8') as file:
-                data = file.read()
-            phase_object.add_document(doc_id, data, **params)
-            phase_object.state_updater(done, process_length, "Adding...")
-            done += 1
-        except IOError as e:
-            print(f"Error reading file '{phase_object.file_name[doc_id]}': {e}")
+    with build_lock:
+        done = 0
+        process_length = len(inputs)
 
-    phase_object.state_updater(done, process_length, "Done!")
-    phase_object.save_index()
-    return JsonResponse({'status': 'success'})
+        # clear previous files
+        phase.doc_id = 0
+        phase.clear_index()
+
+        for filename in inputs:
+            phase.file_name[phase.next_doc_id()] = os.path.join(input_dir, filename)
+
+        if parallel:
+            # Build partial indexes in worker processes and merge them
+            phase.build_index(list(phase.file_name.items()), **params)
+        else:
+            for doc_id, path in phase.file_name.items():
+                try:
+                    with open(path, 'r', encoding='utf-8') as file:
+                        data = file.read()
+                    phase.add_document(doc_id, data, **params)
+                    phase.state_updater(done, process_length, "Adding...")
+                    done += 1
+                except IOError as e:
+                    print(f"Error reading file '{path}': {e}")
+
+            phase.state_updater(done, process_length, "Done!")
+
+        phase.save_index()
+        phase_object = phase
+
+    return {'documents': len(phase.file_name), 'terms': len(phase.non_positional_index)}
 
 
 @api_view(['POST'])
 def index_compression_api(request):
-    params = {key: request.data.get(key, False) for key in ['variable_byte', 'gamma']}
+    params = {key: request.data.get(key, False) for key in ['variable_byte', 'gamma', 'delta']}
     message = []
 
-    # Calculate memory size before compression
-    original_size = (
-            phase_object.get_memory_size(phase_object.non_positional_index) +
-            phase_object.get_memory_size(phase_object.positional_index) +
-            phase_object.get_memory_size(phase_object.wildcard_index)
-    )
+    # Calculate memory size before compression, the index is decoded from disk the first time
+    try:
+        original_size = phase_object.index_size()
+    except IOError as e:
+        print(f"Error loading index: {e}")
+        return JsonResponse({'status': 'error', 'message': 'Can\'t load the index!'})
     message.append(f"Original Size: {original_size} bytes")
 
     if params['variable_byte']:
         # Compress using Variable Byte Encoding
         compressed_index_vb = phase_object.compress_index(method='variable_byte')
-        compressed_size_vb = phase_object.get_memory_size(compressed_index_vb)
+        compressed_size_vb = compressed_index_vb.size
         message.append(f"Variable Byte Compressed Size: {compressed_size_vb} bytes")
 
     if params['gamma']:
         # Compress using Gamma Encoding
         compressed_index_gamma = phase_object.compress_index(method='gamma')
-        compressed_size_gamma = phase_object.get_memory_size(compressed_index_gamma)
+        compressed_size_gamma = compressed_index_gamma.size
         message.append(f"Gamma Compressed Size: {compressed_size_gamma} bytes")
 
+    if params['delta']:
+        # Compress using Delta Encoding
+        compressed_index_delta = phase_object.compress_index(method='delta')
+        compressed_size_delta = compressed_index_delta.size
+        message.append(f"Delta Compressed Size: {compressed_size_delta} bytes")
+
     return JsonResponse({'status': 'success', 'message': "<br/><br/>".join(message)})
 
 
 @api_view(['GET'])
 def progress(request):
-    """API endpoint for progress."""
+    """API endpoint for progress, of a job if its id is given."""
+    job_id = request.GET.get('job')
+    if job_id:
+        job = job_runner.progress(job_id)
+        if job is None:
+            return JsonResponse({'status': 'error', 'message': 'Can\'t find this job!'}, status=404)
+        return JsonResponse(job)
     return JsonResponse({'progress': phase_object.state[0], 'state': get_progress_state()})
 
 
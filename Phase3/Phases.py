@@ -1,91 +1,277 @@
-import json
+import heapq
 import math
+import os
 import pickle
-from collections import defaultdict
+import re
+import sys
+import threading
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from itertools import groupby
+
+from Phase2.index_log import INDEX_MANIFEST, MergedTerms, get_index_log
+from Phase2.segment import INDEX_SEGMENT, kgrams, pattern_kgrams, write_segment
+from .evaluation import evaluate
+from .postings import CompactIndex, PostingsList
+from .result_cache import ResultCache
 
 
 #### tf-idf
-def compute_tf(term, document):
-    return document.count(term) / len(document)
+def compute_tf(term_count, doc_length):
+    return term_count / doc_length
 
 
-def compute_idf(term, documents):
-    num_docs_containing_term = sum(1 for doc in documents if term in doc)
-    if num_docs_containing_term > 0:
-        return math.log(len(documents) / num_docs_containing_term)
+def compute_idf(doc_freq, num_docs):
+    if doc_freq > 0:
+        return math.log(num_docs / doc_freq)
     else:
         return 0
 
 
-def compute_tf_idf(term, document, documents):
-    return compute_tf(term, document) * compute_idf(term, documents)
+def compute_tf_idf(term_count, doc_length, doc_freq, num_docs):
+    return compute_tf(term_count, doc_length) * compute_idf(doc_freq, num_docs)
+
+
+#### positional intersection
+def gallop(values, target, lo=0):
+    """Returns the first index at or after lo whose value is >= target, probing 1, 2, 4, ... steps ahead."""
+    step = 1
+    hi = lo
+    while hi < len(values) and values[hi] < target:
+        lo = hi + 1
+        hi = lo + step
+        step *= 2
+    return bisect_left(values, target, lo, min(hi, len(values)))
+
+
+def intersect_positions(starts, positions, offset):
+    """Keeps the sorted start positions p for which p + offset is in the sorted positions list."""
+    result = []
+    i = 0
+    for start in starts:
+        i = gallop(positions, start + offset, i)
+        if i == len(positions):
+            break
+        if positions[i] == start + offset:
+            result.append(start)
+    return result
+
+
+def intersect_doc_ids(doc_id_lists):
+    """Intersects sorted doc id arrays, walking the shortest and galloping through the others."""
+    if not doc_id_lists:
+        return []
+    doc_id_lists = sorted(doc_id_lists, key=len)
+    result = []
+    pointers = [0] * len(doc_id_lists)
+    for doc_id in doc_id_lists[0]:
+        for i in range(1, len(doc_id_lists)):
+            pointers[i] = gallop(doc_id_lists[i], doc_id, pointers[i])
+            if pointers[i] == len(doc_id_lists[i]):
+                return result
+            if doc_id_lists[i][pointers[i]] != doc_id:
+                break
+        else:
+            result.append(doc_id)
+    return result
+
 
+def difference_doc_ids(doc_ids, excluded):
+    """Keeps the sorted doc ids that are not in the sorted excluded array, galloping through it."""
+    result = []
+    i = 0
+    for doc_id in doc_ids:
+        i = gallop(excluded, doc_id, i)
+        if i == len(excluded) or excluded[i] != doc_id:
+            result.append(doc_id)
+    return result
 
-class RankedRetrieval:
-    matching_terms = []
 
+def union_doc_ids(doc_id_lists):
+    """Merges sorted doc id arrays into one sorted list without duplicates."""
+    return [doc_id for doc_id, _ in groupby(heapq.merge(*doc_id_lists))]
+
+
+class RankedRetrieval:
     def __init__(self, phase3_instance):
         self.phase3 = phase3_instance
 
     def rank_documents(self, query):
-        RankedRetrieval.matching_terms = []
+        """
+            Ranks every document containing a query term.
+
+            Args:
+                query (str): Query text, may contain wildcard terms.
+
+            Returns:
+                tuple: (doc_id, score) pairs sorted by descending score, and the terms wildcards expanded to.
+        """
+
+        expansions = []
         query_terms = query.split()
         doc_scores = defaultdict(float)
 
         for term in query_terms:
             if '*' in term:  # Handle wildcard term
                 matching_terms = self.expand_wildcard(term)
-                RankedRetrieval.matching_terms.extend(matching_terms)
+                expansions.extend(matching_terms)
                 for m_term in matching_terms:
-                    self.update_doc_scores(True, m_term, doc_scores)
+                    self.update_doc_scores(m_term, doc_scores)
             else:
-                self.update_doc_scores(False, term, doc_scores)
+                self.update_doc_scores(term, doc_scores)
 
         ranked_docs = sorted(doc_scores.items(), key=lambda item: item[1], reverse=True)
-        return ranked_docs
+        return ranked_docs, expansions
+
+    def top_k_documents(self, query, k):
+        """
+            Ranks documents for the query and keeps only the best k, using MaxScore pruning.
+
+            Query terms are ordered by their score upper bound. Once the k-th best score exceeds the summed bounds
+            of the cheapest terms, those terms stop producing candidates and are only probed for documents found
+            through the remaining (essential) terms, so low-scoring documents are never fully scored.
+
+            Args:
+                query (str): Query text, may contain wildcard terms.
+                k (int): Number of documents to return.
+
+            Returns:
+                tuple: (doc_id, score) pairs sorted by descending score, and the terms wildcards expanded to.
+        """
+
+        expansions = []
+        query_weights = Counter()
+
+        for term in query.split():
+            if '*' in term:  # Handle wildcard term
+                matching_terms = self.expand_wildcard(term)
+                expansions.extend(matching_terms)
+                query_weights.update(matching_terms)
+            else:
+                query_weights[term] += 1
+
+        if k <= 0:
+            return [], expansions
+
+        lists = []
+        for term, weight in query_weights.items():
+            upper_bound = weight * self.phase3.max_score(term)
+            postings = self.phase3.positional_index.get(term)
+            if postings and upper_bound > 0:
+                lists.append((upper_bound, term, weight, postings.doc_ids))
+        lists.sort(key=lambda item: item[0])
+
+        # bounds[i] is the best score terms 0..i can add together
+        bounds = []
+        for upper_bound, _, _, _ in lists:
+            bounds.append(upper_bound + (bounds[-1] if bounds else 0))
+
+        heap = []
+        threshold = 0
+        first_essential = 0
+        pointers = [0] * len(lists)
+
+        while first_essential < len(lists):
+            candidates = [lists[i][3][pointers[i]] for i in range(first_essential, len(lists))
+                          if pointers[i] < len(lists[i][3])]
+            if not candidates:
+                break
+            doc_id = min(candidates)
+
+            score = 0
+            for i in range(first_essential, len(lists)):
+                postings = lists[i][3]
+                if pointers[i] < len(postings) and postings[pointers[i]] == doc_id:
+                    score += lists[i][2] * self.phase3.tf_idf(lists[i][1], doc_id)
+                    pointers[i] += 1
+
+            for i in range(first_essential - 1, -1, -1):
+                if len(heap) == k and score + bounds[i] <= threshold:
+                    break
+                score += lists[i][2] * self.phase3.tf_idf(lists[i][1], doc_id)
+            else:
+                if len(heap) < k:
+                    heapq.heappush(heap, (score, doc_id))
+                elif score > threshold:
+                    heapq.heapreplace(heap, (score, doc_id))
+                else:
+                    continue
+
+                if len(heap) == k:
+                    threshold = heap[0][0]
+                    while first_essential < len(lists) and bounds[first_essential] <= threshold:
+                        first_essential += 1
+
+        return [(doc_id, score) for score, doc_id in sorted(heap, reverse=True)], expansions
 
     def expand_wildcard(self, term):
-        wildcards = self.phase3.wildcard_index.keys()
+        if term.count('*') == 1:
+            return self.expand_single_wildcard(term)
+        return self.expand_kgram_wildcard(term)
 
-        pre, post = term.split("*")
-        terms = []
-        if pre and post:
-            for text in wildcards:
-                if text.startswith(pre) and text.endswith(post):
-                    terms.append(text)
+    def expand_kgram_wildcard(self, term):
+        """
+            Expands a term with any number of '*' by intersecting the k-gram index entries of its fixed pieces, then
+            checking the candidates against the whole pattern.
 
-        elif pre:
-            for text in wildcards:
-                if text.startswith(pre):
-                    terms.append(text)
+            Args:
+                term (str): Wildcard term.
 
+            Returns:
+                list: Sorted matching vocabulary terms.
+        """
+
+        pattern = re.compile('.*'.join(re.escape(piece) for piece in term.split('*')))
+        grams = pattern_kgrams(term)
+
+        if grams:
+            term_sets = sorted((self.phase3.wildcard_index.get(gram, set()) for gram in grams), key=len)
+            candidates = term_sets[0].intersection(*term_sets[1:])
         else:
-            for text in wildcards:
-                if text.endswith(post):
-                    terms.append(text)
+            candidates = self.phase3.non_positional_index.keys()
 
-        return terms
-        # return self.phase3.wildcard_index[term.replace("*", "")]
+        return sorted(text for text in candidates if pattern.fullmatch(text))
 
-    def update_doc_scores(self, is_wildcard, term, doc_scores):
-        search_from = self.phase3.wildcard_index if is_wildcard else self.phase3.non_positional_index
+    def expand_single_wildcard(self, term):
+        """
+            Expands a pre*, *post or pre*post term with binary searches over the sorted vocabularies.
 
-        for doc_id in search_from[term]:
-            # print(doc_id, self.phase3.positional_index[term][str(doc_id)])
-            # doc_scores[str(doc_id)] += compute_tf_idf(term, self.phase3.positional_index[term][str(doc_id)],
+            Args:
+                term (str): Wildcard term with exactly one '*'.
 
-            try:
-                doc_scores[str(doc_id)] += compute_tf_idf(term, self.get_doc_content(str(doc_id)),
-                                                          self.phase3.positional_index)
-            except ZeroDivisionError:
-                pass
+            Returns:
+                list: Sorted matching vocabulary terms.
+        """
 
-    def get_doc_content(self, doc_id):
-        doc_content = []
-        for term, postings in self.phase3.positional_index.items():
-            if str(doc_id) in postings.keys() or int(doc_id) in postings.keys():
-                doc_content.extend([term] * len(postings[str(doc_id)]))
-        return doc_content
+        pre, post = term.split('*')
+
+        if pre:
+            prefix_matches = self.prefix_range(self.phase3.vocabulary, pre)
+        if post:
+            suffix_matches = [text[::-1] for text in self.prefix_range(self.phase3.reversed_vocabulary, post[::-1])]
+
+        if pre and post:
+            matches = set(prefix_matches).intersection(suffix_matches)
+            return sorted(text for text in matches if len(text) >= len(pre) + len(post))
+        elif pre:
+            return prefix_matches
+        elif post:
+            return sorted(suffix_matches)
+        return list(self.phase3.vocabulary)
+
+    @staticmethod
+    def prefix_range(sorted_terms, prefix):
+        """Returns the slice of a sorted term list that starts with the prefix."""
+        if isinstance(sorted_terms, MergedTerms):
+            # Several segments' vocabularies, each searched on its own
+            return sorted_terms.prefix_range(prefix)
+        start = bisect_left(sorted_terms, prefix)
+        end = bisect_left(sorted_terms, prefix + chr(sys.maxunicode), start)
+        return sorted_terms[start:end]
+
+    def update_doc_scores(self, term, doc_scores):
+        for doc_id in self.phase3.non_positional_index.get(term, ()):
+            doc_scores[doc_id] += self.phase3.tf_idf(term, doc_id)
 
 
 class PhraseSearch:
@@ -94,64 +280,337 @@ class PhraseSearch:
 
     def match_phrases(self, query):
         phrases = self.extract_phrases(query)
-        matching_docs = self.find_matching_docs(phrases)
-        ranked_docs = self.rank_phrase_documents(query, matching_docs)
+        phrase_frequencies = [self.phrase_frequencies(phrase) for phrase in phrases]
+        matching_docs = self.find_matching_docs(phrase_frequencies)
+        ranked_docs = self.rank_phrase_documents(query, phrase_frequencies, matching_docs)
         return ranked_docs
 
     def extract_phrases(self, query):
-        import re
-        phrases = re.findall(r'"([^"]*)"', query)
+        phrases = [phrase for phrase in re.findall(r'"([^"]*)"', query) if phrase.split()]
         return phrases
 
-    def find_matching_docs(self, phrases):
-        doc_sets = [set(self.phase3.non_positional_index[term]) for phrase in phrases for term in phrase.split()]
-        if not doc_sets:
+    def find_matching_docs(self, phrase_frequencies):
+        if not phrase_frequencies:
             return set()
-        matching_docs = set.intersection(*doc_sets)
-        return matching_docs
+        # Probe the other phrases for the documents of the rarest one instead of copying every phrase's documents
+        rarest, *others = sorted(phrase_frequencies, key=len)
+        return {doc_id for doc_id in rarest if all(doc_id in frequencies for frequencies in others)}
+
+    def phrase_frequencies(self, phrase):
+        """
+            Counts how often the phrase occurs in each document, by intersecting the words' sorted position lists.
+
+            Args:
+                phrase (str): Phrase to match, its words may contain wildcards.
 
-    def rank_phrase_documents(self, query, matching_docs):
-        query_terms = query.replace('"', '').split()
+            Returns:
+                dict: Maps doc_id to the number of occurrences of the phrase.
+        """
+
+        term_postings = [self.term_postings(term) for term in phrase.split()]
+        if not all(term_postings):
+            return {}
+
+        # Walk the rarest word's doc ids so most documents drop out early
+        doc_ids = intersect_doc_ids([postings.doc_ids for postings in term_postings])
+
+        frequencies = {}
+        for doc_id in doc_ids:
+            starts = term_postings[0][doc_id]
+            for offset, postings in enumerate(term_postings[1:], start=1):
+                starts = intersect_positions(starts, postings[doc_id], offset)
+                if not starts:
+                    break
+            if starts:
+                frequencies[doc_id] = len(starts)
+        return frequencies
+
+    def term_postings(self, term):
+        """Returns doc_id -> sorted positions for a term, merging the positions of every term a wildcard matches."""
+        if '*' not in term:
+            return self.phase3.positional_index.get(term, PostingsList())
+
+        merged = defaultdict(list)
+        for m_term in self.phase3.ranked_retrieval.expand_wildcard(term):
+            for doc_id, positions in self.phase3.positional_index.get(m_term, {}).items():
+                merged[doc_id].append(positions)
+        return PostingsList.from_dict({doc_id: heapq.merge(*positions) for doc_id, positions in merged.items()})
+
+    def rank_phrase_documents(self, query, phrase_frequencies, matching_docs):
+        loose_terms = re.sub(r'"[^"]*"', ' ', query).split()
         doc_scores = defaultdict(float)
 
         for doc_id in matching_docs:
-            doc_content = self.get_doc_content(str(doc_id))
-            for term in query_terms:
-                doc_scores[str(doc_id)] += compute_tf_idf(term, str(doc_content), self.phase3.positional_index)
+            doc_length = self.phase3.doc_lengths.get(doc_id, 0)
+            if not doc_length:
+                continue
+            for frequencies in phrase_frequencies:
+                doc_scores[doc_id] += compute_tf_idf(frequencies[doc_id], doc_length, len(frequencies),
+                                                     self.phase3.num_docs)
+            for term in loose_terms:
+                doc_scores[doc_id] += self.phase3.tf_idf(term, doc_id)
 
         ranked_docs = sorted(doc_scores.items(), key=lambda item: item[1], reverse=True)
         return ranked_docs
 
-    def get_doc_content(self, doc_id):
-        doc_content = []
-        for term, postings in self.phase3.positional_index.items():
-            if str(doc_id) in postings.keys() or int(doc_id) in postings.keys():
-                doc_content.extend([term] * len(postings[str(doc_id)]))
-        return doc_content
+
+class BooleanRetrieval:
+    """
+        Boolean retrieval over the non-positional index.
+
+        Queries combine terms with AND, OR, NOT and parentheses. NOT binds tightest, then AND, then OR, and terms
+        next to each other are ANDed. A term may contain wildcards, it then matches any of its expansions.
+    """
+
+    OPERATORS = {'AND', 'OR', 'NOT'}
+
+    def __init__(self, phase3_instance):
+        self.phase3 = phase3_instance
+
+    def parse(self, query):
+        """
+            Parses a query into a tree of ('term', term), ('not', node), ('and', nodes) and ('or', nodes).
+
+            Args:
+                query (str): Boolean query.
+
+            Returns:
+                tuple: Root of the tree.
+
+            Raises:
+                ValueError: If the query is empty or malformed.
+        """
+
+        tokens = re.findall(r'[()]|[^\s()]+', query)
+        if not tokens:
+            raise ValueError("Empty query")
+
+        position = 0
+
+        def peek():
+            return tokens[position] if position < len(tokens) else None
+
+        def take():
+            nonlocal position
+            position += 1
+            return tokens[position - 1]
+
+        def parse_or():
+            nodes = [parse_and()]
+            while peek() == 'OR':
+                take()
+                nodes.append(parse_and())
+            return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+        def parse_and():
+            nodes = [parse_not()]
+            while peek() is not None and peek() not in {'OR', ')'}:
+                if peek() == 'AND':
+                    take()
+                nodes.append(parse_not())
+            return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+        def parse_not():
+            if peek() == 'NOT':
+                take()
+                return 'not', parse_not()
+            return parse_atom()
+
+        def parse_atom():
+            token = peek()
+            if token is None or token in self.OPERATORS or token == ')':
+                raise ValueError(f"Expected a term or '(' at '{token or 'end of query'}'")
+            take()
+            if token != '(':
+                return 'term', token
+            node = parse_or()
+            if peek() != ')':
+                raise ValueError("Missing ')'")
+            take()
+            return node
+
+        tree = parse_or()
+        if peek() is not None:
+            raise ValueError(f"Unexpected '{peek()}'")
+        return tree
+
+    def terms(self, node):
+        """Returns the terms of a query tree, without wildcards expanded."""
+        if node[0] == 'term':
+            return [node[1]]
+        if node[0] == 'not':
+            return self.terms(node[1])
+        return [term for child in node[1] for term in self.terms(child)]
+
+    def positive_terms(self, node):
+        """Returns the terms a matching document may contain, the ones not under a NOT."""
+        if node[0] == 'term':
+            return [node[1]]
+        if node[0] == 'not':
+            return []
+        return [term for child in node[1] for term in self.positive_terms(child)]
+
+    def expand(self, term):
+        if '*' in term:
+            return self.phase3.ranked_retrieval.expand_wildcard(term)
+        return [term]
+
+    def cost(self, node):
+        """Estimates how many documents a node matches from document frequencies, without reading postings."""
+        kind = node[0]
+        if kind == 'term':
+            return sum(self.phase3.doc_freq.get(term, 0) for term in self.expand(node[1]))
+        if kind == 'not':
+            return max(self.phase3.num_docs - self.cost(node[1]), 0)
+        costs = [self.cost(child) for child in node[1]]
+        if kind == 'or':
+            return min(sum(costs), self.phase3.num_docs)
+        positive = [cost for child, cost in zip(node[1], costs) if child[0] != 'not']
+        return min(positive) if positive else self.phase3.num_docs
+
+    def evaluate(self, node):
+        """
+            Returns the sorted ids of the documents matching a query tree.
+
+            Operands of an AND are evaluated rarest first, each one only intersected with what is left, so a
+            selective conjunction gallops through the longer postings instead of reading them. NOT operands of an
+            AND are subtracted from the result rather than complemented.
+        """
+
+        kind = node[0]
+        if kind == 'term':
+            postings = [self.phase3.non_positional_index.get(term) for term in self.expand(node[1])]
+            postings = [p.doc_ids for p in postings if p]
+            return postings[0] if len(postings) == 1 else union_doc_ids(postings)
+        if kind == 'or':
+            return union_doc_ids([self.evaluate(child) for child in node[1]])
+        if kind == 'not':
+            return difference_doc_ids(self.all_doc_ids(), self.evaluate(node[1]))
+
+        positive = sorted((child for child in node[1] if child[0] != 'not'), key=self.cost)
+        negative = sorted((child[1] for child in node[1] if child[0] == 'not'), key=self.cost, reverse=True)
+
+        result = self.evaluate(positive[0]) if positive else self.all_doc_ids()
+        for child in positive[1:]:
+            if not result:
+                return []
+            result = intersect_doc_ids([result, self.evaluate(child)])
+        for child in negative:
+            if not result:
+                return []
+            result = difference_doc_ids(result, self.evaluate(child))
+        return result
+
+    def all_doc_ids(self):
+        return sorted(self.phase3.doc_lengths)
+
+    def search(self, query, k=None):
+        """
+            Finds the documents matching a Boolean query and ranks them by the tf-idf of its terms outside NOTs.
+
+            Args:
+                query (str): Boolean query.
+                k (int, optional): Number of documents to return. Defaults to every matching document.
+
+            Returns:
+                tuple: (doc_id, score) pairs sorted by descending score, and the terms wildcards expanded to.
+        """
+
+        tree = self.parse(query)
+        terms = [m_term for term in self.positive_terms(tree) for m_term in self.expand(term)]
+        expansions = sorted({m_term for term in self.terms(tree) if '*' in term for m_term in self.expand(term)})
+
+        scores = [(doc_id, sum(self.phase3.tf_idf(term, doc_id) for term in terms))
+                  for doc_id in self.evaluate(tree)]
+        if k:
+            return heapq.nlargest(k, scores, key=lambda item: item[1]), expansions
+        return sorted(scores, key=lambda item: item[1], reverse=True), expansions
 
 
 class Phase3:
     doc_id = 0
 
-    def __init__(self):
+    def __init__(self, cache_size=1024, cache_ttl=300):
+        """
+            Initializes an empty index.
+
+            Args:
+                cache_size (int, optional): Number of query results kept, 0 disables the cache. Defaults to 1024.
+                cache_ttl (float, optional): Seconds a cached result stays valid. Defaults to 300.
+        """
+
+        self.result_cache = ResultCache(cache_size, cache_ttl)
         self.file_name = dict()
-        self.non_positional_index = defaultdict(set)
-        self.positional_index = defaultdict(lambda: defaultdict(list))
+        self._open_compact(CompactIndex())
         self.wildcard_index = defaultdict(set)
+        self.doc_lengths = dict()
+        self.vocabulary = []
+        self.reversed_vocabulary = []
+        self.segment = None
+        self.generation = 0
         self.state = [0, "Not Started Yet!", '']
 
         self.ranked_retrieval = RankedRetrieval(self)
         self.phrase_search = PhraseSearch(self)
+        self.boolean_retrieval = BooleanRetrieval(self)
 
-    def ranked_search(self, query):
-        return self.ranked_retrieval.rank_documents(query)
+    def ranked_search(self, query, k=None):
+        """Returns the ranked (doc_id, score) pairs of a query, the best k if given, and its wildcard expansions."""
+        if k:
+            return self._cached('ranked', query, k, lambda: self.ranked_retrieval.top_k_documents(query, k))
+        return self._cached('ranked', query, k, lambda: self.ranked_retrieval.rank_documents(query))
 
     def exact_phrase_search(self, query):
-        return self.phrase_search.match_phrases(query)
+        return self._cached('phrase', query, None, lambda: (self.phrase_search.match_phrases(query), []))[0]
+
+    def boolean_search(self, query, k=None):
+        """Returns the (doc_id, score) pairs matching a Boolean query and its wildcard expansions."""
+        return self._cached('boolean', query, k, lambda: self.boolean_retrieval.search(query, k))
+
+    def _cached(self, mode, query, k, search):
+        """
+            Returns the results of a search from the result cache, running it on a miss.
+
+            Entries are keyed by the query with its whitespace normalized, the mode, k and the generation of the
+            index, and the cache is emptied whenever the index is replaced or modified.
+
+            Args:
+                search (callable): Runs the search, returning its results and the terms wildcards expanded to.
+
+            Returns:
+                tuple: Results and wildcard expansions, as lists.
+        """
+
+        key = (' '.join(query.split()), mode, k, self.generation)
+        cached = self.result_cache.get(key)
+        if cached is None:
+            results, expansions = search()
+            cached = (tuple(results), tuple(expansions))
+            self.result_cache.put(key, cached)
+        return list(cached[0]), list(cached[1])
+
+    @property
+    def num_docs(self):
+        return len(self.doc_lengths)
+
+    def term_frequency(self, term, doc_id):
+        postings = self.positional_index.get(term)
+        return postings.frequency(doc_id) if postings else 0
+
+    def tf_idf(self, term, doc_id):
+        doc_length = self.doc_lengths.get(doc_id, 0)
+        if not doc_length:
+            return 0
+        return compute_tf_idf(self.term_frequency(term, doc_id), doc_length, self.doc_freq.get(term, 0),
+                              self.num_docs)
+
+    def max_score(self, term):
+        """Upper bound of the tf-idf score the term can give any single document."""
+        return self.max_tf.get(term, 0) * compute_idf(self.doc_freq.get(term, 0), self.num_docs)
 
     @staticmethod
     def next_doc_id():
-        Phase3.doc_id = str(int(Phase3.doc_id) + 1)
+        Phase3.doc_id += 1
         return Phase3.doc_id
 
     def state_updater(self, done: int, process_length: int, section: str, directory: str = ''):
@@ -168,210 +627,234 @@ class Phase3:
         self.state = [round((done / process_length) * 100, 3), section, directory]
 
     def add_document(self, doc_id, text, **kwargs):
+        self._materialize()
+        self.result_cache.invalidate()
         words = text.split()
+        positions = defaultdict(list)
         for pos, word in enumerate(words):
-            if kwargs['non-positional']:
-                self.non_positional_index[word].add(str(doc_id))
-            if kwargs['positional']:
-                self.positional_index[word][str(doc_id)].append(pos)
+            positions[word].append(pos)
+
+        # One postings list per term serves both indexes, documents indexed without positions get empty ones
+        doc_id = int(doc_id)
+        for word, word_positions in positions.items():
+            if word not in self.index.term_ids:
+                self._add_to_vocabulary(word)
+            self.index.add(word, doc_id, word_positions if kwargs['positional'] else (),
+                           len(word_positions) / len(words))
             if kwargs['wildcard']:
-                self._add_to_wildcard_index(word, str(doc_id))
-
-    def _remove_from_index(self, word, doc_id, pos):
-        if doc_id in self.non_positional_index[word]:
-            self.non_positional_index[word].remove(str(doc_id))
-            if not self.non_positional_index[word]:
-                del self.non_positional_index[word]
-        if doc_id in self.positional_index[word]:
-            self.positional_index[word][str(doc_id)].remove(pos)
-            if not self.positional_index[word][str(doc_id)]:
-                del self.positional_index[word][str(doc_id)]
-            if not self.positional_index[word]:
-                del self.positional_index[word]
-        self._remove_from_wildcard_index(word, str(doc_id))
-
-    def _add_to_wildcard_index(self, word, doc_id):
-        for i in range(len(word)):
-            for j in range(i + 1, len(word) + 1):
-                self.wildcard_index[word[i:j]].add(str(doc_id))
-
-    def _remove_from_wildcard_index(self, word, doc_id):
-        for i in range(len(word)):
-            for j in range(i + 1, len(word) + 1):
-                if doc_id in self.wildcard_index[word[i:j]]:
-                    self.wildcard_index[word[i:j]].remove(str(doc_id))
-                    if not self.wildcard_index[word[i:j]]:
-                        del self.wildcard_index[word[i:j]]
+                self._add_to_wildcard_index(word)
+        self.doc_lengths[doc_id] = len(words)
+
+    def _build_statistics(self):
+        self.doc_lengths = defaultdict(int)
+        for postings in self.index.postings:
+            for doc_id in postings:
+                self.doc_lengths[doc_id] += postings.frequency(doc_id)
+        self.doc_lengths = dict(self.doc_lengths)
+        for term_id, postings in enumerate(self.index.postings):
+            self.index.max_tf_values[term_id] = max((postings.frequency(doc_id) / self.doc_lengths[doc_id]
+                                                     for doc_id in postings if self.doc_lengths[doc_id]), default=0)
+
+    def _add_to_vocabulary(self, word):
+        insort(self.vocabulary, word)
+        insort(self.reversed_vocabulary, word[::-1])
+
+    def _build_vocabulary(self):
+        self.vocabulary = sorted(self.index.terms)
+        self.reversed_vocabulary = sorted(word[::-1] for word in self.index.terms)
+
+    def _add_to_wildcard_index(self, word):
+        for gram in kgrams(word):
+            self.wildcard_index[gram].add(word)
+
+    def _build_wildcard_index(self):
+        self.wildcard_index = defaultdict(set)
+        for word in self.index.terms:
+            self._add_to_wildcard_index(word)
 
     def save_index(self):
-        with open("index.file", "wb") as file:
-            pickle.dump({
-                "file_names": {str(k): v for k, v in self.file_name.items()},
-                "non_positional_index": {str(k): list(v) for k, v in self.non_positional_index.items()},
-                "positional_index": {str(k): {str(dk): dv for dk, dv in v.items()} for k, v in
-                                     self.positional_index.items()},
-                "wildcard_index": {str(k): list(v) for k, v in self.wildcard_index.items()}
-            }, file)
         try:
-            with open('index.json', 'w', encoding='utf8') as file:
-                json.dump(
-                    #     {
-                    #     "file_names": {str(k): v for k, v in self.file_name.items()},
-                    #     "non_positional_index": {k: list(v) for k, v in self.non_positional_index.items()},
-                    #     "positional_index": {k: {dk: dv for dk, dv in v.items()} for k, v in self.positional_index.items()},
-                    #     "wildcard_index": {k: list(v) for k, v in self.wildcard_index.items()}
-                    # }
-                    {
-                        "file_names": {str(k): v for k, v in self.file_name.items()},
-                        "non_positional_index": {str(k): list(v) for k, v in self.non_positional_index.items()},
-                        "positional_index": {str(k): {str(dk): dv for dk, dv in v.items()} for k, v in
-                                             self.positional_index.items()},
-                        "wildcard_index": {str(k): list(v) for k, v in self.wildcard_index.items()}
-                    }, file, ensure_ascii=False)
+            self.generation += 1
+            write_segment(INDEX_SEGMENT, self.non_positional_index, self.positional_index, self.file_name,
+                          self.doc_lengths, self.generation)
+            get_index_log().reset(self.generation)
         except IOError as e:
-            print(f"Error saving index to 'index.json': {e}")
+            print(f"Error saving index to '{INDEX_SEGMENT}': {e}")
 
     def load_index(self):
-        # with open("index.file", "rb") as file:
-        #     data = pickle.load(file)
+        """
+            Loads the segments listed in the manifest, or the pickled index written by earlier versions when there
+            are none.
+
+            Raises:
+                IOError, ValueError: The manifest or a segment exists but cannot be opened. The pickle is then not
+                    used, as it would silently serve an old index.
+        """
+
+        if os.path.exists(INDEX_MANIFEST) or os.path.exists(INDEX_SEGMENT):
+            # The base segment plus any delta segments and tombstones written since
+            self._open_segment(get_index_log().open())
+            return
+
         try:
-            # with open('index.json', 'r', encoding="utf8") as file:
-            #     data = json.load(file)
             with open("index.file", "rb") as file:
-                data = pickle.load(file)
-                self.file_name = {str(k): v for k, v in data["file_names"].items()}
-                self.non_positional_index = defaultdict(set,
-                                                        {str(k): set(v) for k, v in
-                                                         data["non_positional_index"].items()})
-                self.positional_index = defaultdict(lambda: defaultdict(list), {str(k): defaultdict(list, v) for k, v in
-                                                                                data["positional_index"].items()})
-                self.wildcard_index = defaultdict(set, {str(k): set(v) for k, v in data["wildcard_index"].items()})
+                self._load_data(pickle.load(file))
         except IOError as e:
-            print(f"Error loading index from 'index.json': {e}")
+            print(f"Error loading index from 'index.file': {e}")
+
+    def _open_segment(self, segment):
+        """Serves queries straight from a memory-mapped segment, without decoding it."""
+        self.result_cache.invalidate()
+        self.segment = segment
+        self.generation = segment.generation
+        self.file_name = segment.file_names
+        self.non_positional_index = segment.non_positional_index
+        self.positional_index = segment.positional_index
+        self.wildcard_index = segment.wildcard_index
+        self.doc_lengths = segment.doc_lengths
+        self.doc_freq = segment.doc_freq
+        self.max_tf = segment.max_tf
+        self.vocabulary = segment.terms
+        self.reversed_vocabulary = segment.reversed_terms
+
+    def _open_compact(self, index):
+        """Serves queries from an in-memory CompactIndex, which add_document can modify."""
+        self.index = index
+        self.non_positional_index = index.non_positional_index
+        self.positional_index = index.positional_index
+        self.doc_freq = index.doc_freq
+        self.max_tf = index.max_tf
+
+    def _materialize(self):
+        """Decodes a memory-mapped segment into a CompactIndex, so the index can be modified."""
+        if self.segment is not None:
+            self._load_data(self.segment.to_dict())
+
+    def _load_data(self, data):
+        self.result_cache.invalidate()
+        self.segment = None
+        # Doc ids are ints, pickled indexes stored them as strings
+        self.file_name = {int(k): v for k, v in data["file_names"].items()}
+        self._open_compact(CompactIndex.from_dict(data["non_positional_index"], data["positional_index"]))
+
+        self._build_vocabulary()
+
+        # Older indexes stored every substring of every word instead of k-grams, rebuild those. Either way the sets
+        # share the term dictionary's strings instead of holding copies.
+        if "kgram_index" in data:
+            terms = {term: term for term in self.index.terms}
+            self.wildcard_index = defaultdict(set, {str(k): {terms.get(word, word) for word in v}
+                                                    for k, v in data["kgram_index"].items()})
+        else:
+            self._build_wildcard_index()
+
+        # Indexes written by Phase2 carry no statistics, so derive them once here
+        if all(key in data for key in ["doc_lengths", "max_tf"]):
+            self.doc_lengths = {int(k): v for k, v in data["doc_lengths"].items()}
+            for term, value in data["max_tf"].items():
+                if term in self.index.term_ids:
+                    self.index.max_tf_values[self.index.term_ids[term]] = value
+        else:
+            self._build_statistics()
 
 
-class Evaluation:
-    def __init__(self):
-        pass
+class IndexHolder:
+    """
+        Shares one loaded index between requests and reloads it only when the index on disk changes.
 
-    @staticmethod
-    def precision(retrieved, relevant):
-        true_positives = len(set(retrieved).intersection(set(relevant)))
-        return true_positives / len(retrieved) if retrieved else 0
+        A reload builds a new Phase3 object and swaps it in, so queries that already got the old one finish on it. A
+        reload that fails keeps the old one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phase3 = None
+        self.signature = None
 
     @staticmethod
-    def recall(retrieved, relevant):
-        true_positives = len(set(retrieved).intersection(set(relevant)))
-        return true_positives / len(relevant) if relevant else 0
-
-    def f_measure(self, retrieved, relevant):
-        precision = self.precision(retrieved, relevant)
-        recall = self.recall(retrieved, relevant)
-        if precision + recall == 0:
-            return 0
-        return (2 * (precision * recall)) / (precision + recall)
-
-    def average_precision(self, retrieved, relevant):
-        hits = 0
-        sum_precisions = 0
-        for i, doc_id in enumerate(retrieved):
-            if str(doc_id) in relevant:
-                hits += 1
-                sum_precisions += hits / (i + 1)
-        return sum_precisions / len(relevant) if relevant else 0
-
-    def mean_average_precision(self, queries_results, relevant_docs):
-        avg_precisions = []
-        for query in queries_results:
-            retrieved = [str(i) for i in queries_results[query]]
-            relevant = [str(i) for i in relevant_docs.get(query, [])]
-            avg_precisions.append(self.average_precision(retrieved, relevant))
-        return sum(avg_precisions) / len(avg_precisions) if avg_precisions else 0
-
-
-def part1(phase3, phrase_query):
-    ranked_results_return = []
-    phrase_results_return = []
+    def disk_signature():
+        """Identifies the index on disk. Saving always replaces the manifest or the file, so any save changes this."""
+        for path in [INDEX_MANIFEST, INDEX_SEGMENT, "index.file"]:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            return path, stat.st_ino, stat.st_mtime_ns, stat.st_size
+        return None
+
+    def get(self):
+        """Returns the current index, loading it first if it changed on disk."""
+        signature = self.disk_signature()
+        if self.phase3 is None or signature != self.signature:
+            with self.lock:
+                if self.phase3 is None or signature != self.signature:
+                    phase3 = Phase3()
+                    try:
+                        phase3.load_index()
+                    except (IOError, ValueError) as e:
+                        # Keep serving the previous index and its signature, so the next request tries again
+                        print(f"Error loading index: {e}")
+                        if self.phase3 is None:
+                            self.phase3 = Phase3()
+                        return self.phase3
+                    self.phase3, self.signature = phase3, signature
+        return self.phase3
+
+
+def format_results(phase3, results):
+    """Turns (doc_id, score) pairs into the result entries the search API shows."""
+    return [{
+        'rank': rank,
+        'file_name': phase3.file_name[doc_id].split('\\')[-1],
+        'path': phase3.file_name[doc_id],
+        'score': score,
+        'doc_id': str(doc_id)
+    } for rank, (doc_id, score) in enumerate(results, start=1)]
+
+
+def part1(phase3, phrase_query, k=None, boolean=False):
+    if boolean:
+        # Boolean queries have no phrase counterpart, their results take the ranked column
+        phase3.state_updater(1, 2, "Boolean Search...!")
+        boolean_results, matching_terms = phase3.boolean_search(phrase_query, k)
+        phase3.state_updater(2, 2, "Done!")
+        return format_results(phase3, boolean_results), [], matching_terms
 
     phase3.state_updater(1, 3, "Ranking...!")
-    ranked_results = phase3.ranked_search(phrase_query.replace("\"", ""))
-
-    x = 1
-    for doc_id, score in ranked_results:
-        ranked_results_return.append({
-            'rank': x,
-            'file_name': phase3.file_name[str(doc_id)].split('\\')[-1],
-            'path': phase3.file_name[str(doc_id)],
-            'score': score,
-            'doc_id': str(doc_id)
-        })
-        x += 1
+    ranked_results, matching_terms = phase3.ranked_search(phrase_query.replace("\"", ""), k)
+    ranked_results_return = format_results(phase3, ranked_results)
 
     # Perform an exact phrase search
     phase3.state_updater(2, 3, "Exact Ranking...!")
-    phrase_results = phase3.exact_phrase_search(phrase_query if '"' in phrase_query else f'"{phrase_query}"')
-
-    x = 1
-    for doc_id, score in phrase_results:
-        phrase_results_return.append({
-            'rank': x,
-            'file_name': phase3.file_name[str(doc_id)].split('\\')[-1],
-            'path': phase3.file_name[str(doc_id)],
-            'score': score,
-            'doc_id': str(doc_id)
-        })
-        x += 1
+    phrase_results = phase3.exact_phrase_search(phrase_query if '"' in phrase_query else f'"{phrase_query}"')[:k]
+    phrase_results_return = format_results(phase3, phrase_results)
 
     phase3.state_updater(3, 3, "Done!")
 
-    return ranked_results_return, phrase_results_return, RankedRetrieval.matching_terms
-
-
-def part2(phase3, queries):
-    evaluation = Evaluation()
-
-    phase3.load_index()
-    res_return = {}
-
-    queries_results_ranked = {}
-    queries_results_phrase = {}
-
-    phase3.state_updater(1, 4, "Getting ready...")
-    for query in queries:
-        ranked_results = phase3.ranked_search(query)  # [:5]  # max 5 retrieved docs
-        phrase_results = phase3.exact_phrase_search(f'"{query}"')  # [:5]  # max 5 retrieved docs
-        queries_results_ranked[query] = [str(doc_id) for doc_id, _ in ranked_results]
-        queries_results_phrase[query] = [str(doc_id) for doc_id, _ in phrase_results]
-
-    phase3.state_updater(2, 4, "Measure ranked...")
-    f_measure_ranks = []
-    for i in range(0, len(queries.keys())):
-        f_measure_ranks.append(
-            evaluation.f_measure(queries_results_ranked[list(queries.keys())[i]], queries[list(queries.keys())[i]]))
-
-    f_measure_ranked = max(f_measure_ranks)  # sum(f_measure_ranks) / len(f_measure_ranks)
-    map_ranked = evaluation.mean_average_precision(queries_results_ranked, queries)
+    return ranked_results_return, phrase_results_return, matching_terms
 
-    res_return['ranked'] = {
-        'f_measure': f_measure_ranked,
-        'map': map_ranked
-    }
 
-    phase3.state_updater(3, 4, "Measure phrase...")
-    f_measure_ranks = []
-    for i in range(0, len(queries.keys())):
-        f_measure_ranks.append(
-            evaluation.f_measure(queries_results_phrase[list(queries.keys())[i]], queries[list(queries.keys())[i]]))
+def part2(phase3, queries, k=10, workers=None, output_directory=None):
+    """
+        Evaluates ranked and exact phrase search on queries with known relevant documents.
 
-    f_measure_phrase = max(f_measure_ranks)  # sum(f_measure_ranks) / len(f_measure_ranks)
-    map_phrase = evaluation.mean_average_precision(queries_results_phrase, queries)
+        Args:
+            phase3 (Phase3): Loaded index.
+            queries (dict): query -> ids of its relevant documents.
+            k (int, optional): Cutoff of P@k and nDCG@k. Defaults to 10.
+            workers (int, optional): Number of workers running the queries. Defaults to the number of CPUs.
+            output_directory (str, optional): Where to write TREC qrels and run files. Defaults to writing nothing.
 
-    res_return['phrase'] = {
-        'f_measure': f_measure_phrase,
-        'map': map_phrase
-    }
+        Returns:
+            dict: 'ranked' and 'phrase' metrics (f_measure, map, precision_at_k, r_precision, ndcg_at_k), and the
+                'seconds' the queries took to run.
+    """
 
-    phase3.state_updater(4, 4, "Done!")
+    # Ids come from the API as strings, the index uses ints
+    qrels = {query: {int(doc_id) if str(doc_id).isdigit() else doc_id: 1 for doc_id in relevant}
+             for query, relevant in queries.items()}
+    res_return = evaluate(phase3, qrels, k, workers, output_directory)
+    phase3.state_updater(1, 1, "Done!")
 
     return res_return
 
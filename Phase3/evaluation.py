@@ -0,0 +1,311 @@
+"""
+    Batch evaluation of Phase3.
+
+    A query set runs over a pool of workers against one loaded, read-only index. When the index is served from
+    memory-mapped segments, the workers are spawned processes that map the same segment files, so they share the
+    page cache and decode nothing up front. They are never forked, as evaluations run on a thread of the job runner
+    and a fork would copy whatever locks the other threads hold. An index held in memory is searched by threads of
+    this process. The runs are then scored with P@k, R-precision, nDCG@k, MAP and the best
+    F-measure, using set lookups for relevance. Runs and relevance judgements can be written and read as TREC run and
+    qrels files.
+
+    Run as a script from the directory of the index, with a topics file of "qid<TAB>query" lines and a qrels file:
+        python -m Phase3.evaluation topics.tsv qrels.txt --k 10 --workers 4 --output evaluation
+"""
+
+import argparse
+import math
+import multiprocessing
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+MODES = ('ranked', 'phrase')
+RUN_DEPTH = 1000
+
+# Index searched by the workers of the running batch, one batch at a time. Worker processes open their own.
+_shared_index = None
+_batch_lock = threading.Lock()
+
+
+def _init_worker(segment, cache_size, cache_ttl):
+    """
+        Serves the index from its segments in a spawned worker process.
+
+        Args:
+            segment (Segment or SegmentSet): Segments of the parent's index, mapped again from their files when they
+                are unpickled here.
+            cache_size (int): Size of the worker's result cache.
+            cache_ttl (float): Lifetime of its cached results.
+    """
+
+    global _shared_index
+    from .Phases import Phase3
+
+    _shared_index = Phase3(cache_size, cache_ttl)
+    _shared_index._open_segment(segment)
+
+
+def _search_chunk(queries):
+    """Runs a chunk of queries in both modes against the shared index, in a worker."""
+    return [([(doc_id, score) for doc_id, score in _shared_index.ranked_search(query)[0]],
+             [(doc_id, score) for doc_id, score in _shared_index.exact_phrase_search(f'"{query}"')])
+            for query in queries]
+
+
+def run_queries(phase3, queries, workers=None, progress=None):
+    """
+        Runs queries through ranked and exact phrase search over a pool of workers.
+
+        Args:
+            phase3 (Phase3): Loaded index, only read by the workers.
+            queries (list): Queries to run.
+            workers (int, optional): Number of workers. Defaults to the number of CPUs.
+            progress (callable, optional): Called with (done, total) as chunks of queries finish.
+
+        Returns:
+            dict: mode -> {query: [(doc_id, score), ...]}, for the modes in MODES.
+    """
+
+    global _shared_index
+
+    queries = list(dict.fromkeys(queries))
+    workers = max(1, min(workers or os.cpu_count() or 1, len(queries)))
+    # A few chunks per worker keeps the pool busy when queries differ in cost
+    chunk_size = max(1, -(-len(queries) // (workers * 4)))
+    chunks = [queries[i:i + chunk_size] for i in range(0, len(queries), chunk_size)]
+
+    runs = {mode: {} for mode in MODES}
+
+    def run_chunks(executor, chunks):
+        with executor:
+            for chunk, results in zip(chunks, executor.map(_search_chunk, chunks)):
+                for query, (ranked, phrase) in zip(chunk, results):
+                    runs['ranked'][query] = ranked
+                    runs['phrase'][query] = phrase
+                if progress:
+                    progress(len(runs['ranked']), len(queries))
+
+    with _batch_lock:
+        _shared_index = phase3
+        try:
+            if workers > 1 and phase3.segment is not None:
+                try:
+                    run_chunks(ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                                   initializer=_init_worker,
+                                                   initargs=(phase3.segment, phase3.result_cache.maxsize,
+                                                             phase3.result_cache.ttl)), chunks)
+                except BrokenProcessPool as e:
+                    # A merge removed a segment file before the workers mapped it, this process still has it mapped
+                    print(f"Error starting evaluation workers, searching in threads: {e}")
+                    run_chunks(ThreadPoolExecutor(max_workers=workers),
+                               [chunk for chunk in chunks if chunk[0] not in runs['ranked']])
+            else:
+                run_chunks(ThreadPoolExecutor(max_workers=workers), chunks)
+        finally:
+            _shared_index = None
+    return runs
+
+
+def precision_at_k(retrieved, relevant, k):
+    """Fraction of the first k retrieved documents that are relevant."""
+    return sum(1 for doc_id in retrieved[:k] if doc_id in relevant) / k if k else 0
+
+
+def r_precision(retrieved, relevant):
+    """Precision at the number of relevant documents."""
+    return precision_at_k(retrieved, relevant, len(relevant))
+
+
+def average_precision(retrieved, relevant):
+    """Mean of the precisions at the ranks of the relevant documents retrieved, over all relevant documents."""
+    hits = 0
+    sum_precisions = 0
+    for rank, doc_id in enumerate(retrieved, start=1):
+        if doc_id in relevant:
+            hits += 1
+            sum_precisions += hits / rank
+    return sum_precisions / len(relevant) if relevant else 0
+
+
+def ndcg_at_k(retrieved, relevant, k):
+    """
+        Normalized discounted cumulative gain of the first k retrieved documents.
+
+        Args:
+            retrieved (list): Retrieved doc ids, best first.
+            relevant (dict): Relevant doc id -> relevance grade.
+            k (int): Cutoff.
+
+        Returns:
+            float: DCG of the run over DCG of the ideal ranking of the judged documents.
+    """
+
+    dcg = sum(relevant.get(doc_id, 0) / math.log2(rank + 1) for rank, doc_id in enumerate(retrieved[:k], start=1))
+    ideal = sum(grade / math.log2(rank + 1)
+                for rank, grade in enumerate(sorted(relevant.values(), reverse=True)[:k], start=1))
+    return dcg / ideal if ideal else 0
+
+
+def f_measure(retrieved, relevant):
+    """Harmonic mean of the precision and recall of all retrieved documents."""
+    true_positives = sum(1 for doc_id in retrieved if doc_id in relevant)
+    if not true_positives:
+        return 0
+    precision = true_positives / len(retrieved)
+    recall = true_positives / len(relevant)
+    return 2 * precision * recall / (precision + recall)
+
+
+def evaluate_run(run, qrels, k=10):
+    """
+        Scores a run against relevance judgements.
+
+        Args:
+            run (dict): query -> [(doc_id, score), ...], best first.
+            qrels (dict): query -> {doc_id: grade}, doc ids as in the run. Documents with grade 0 are not relevant.
+            k (int, optional): Cutoff of P@k and nDCG@k. Defaults to 10.
+
+        Returns:
+            dict: Means over the judged queries of the metrics, and the best F-measure of a single query, as part2
+                always reported it.
+    """
+
+    scores = defaultdict(list)
+    for query, judgements in qrels.items():
+        retrieved = [doc_id for doc_id, _ in run.get(query, ())]
+        relevant = {doc_id for doc_id, grade in judgements.items() if grade > 0}
+        scores['f_measure'].append(f_measure(retrieved, relevant))
+        scores['map'].append(average_precision(retrieved, relevant))
+        scores['precision_at_k'].append(precision_at_k(retrieved, relevant, k))
+        scores['r_precision'].append(r_precision(retrieved, relevant))
+        scores['ndcg_at_k'].append(ndcg_at_k(retrieved, judgements, k))
+
+    result = {metric: sum(values) / len(values) for metric, values in scores.items()}
+    result['f_measure'] = max(scores['f_measure'], default=0)
+    result['k'] = k
+    result['queries'] = len(qrels)
+    return result
+
+
+def write_run(path, run, query_ids, tag='phase3', depth=RUN_DEPTH):
+    """
+        Writes a run as a TREC run file of "qid Q0 docno rank score tag" lines.
+
+        Args:
+            path (str): Path of the file.
+            run (dict): query -> [(doc_id, score), ...], best first.
+            query_ids (dict): query -> qid.
+            tag (str, optional): Name of the run. Defaults to 'phase3'.
+            depth (int, optional): Results written per query. Defaults to RUN_DEPTH.
+    """
+
+    with open(path, 'w', encoding='utf-8') as file:
+        for query, qid in query_ids.items():
+            for rank, (doc_id, score) in enumerate(run.get(query, ())[:depth], start=1):
+                file.write(f'{qid} Q0 {doc_id} {rank} {score:.6f} {tag}\n')
+
+
+def write_qrels(path, qrels, query_ids):
+    """Writes relevance judgements (query -> {doc_id: grade}) as a TREC qrels file of "qid 0 docno grade" lines."""
+    with open(path, 'w', encoding='utf-8') as file:
+        for query, qid in query_ids.items():
+            for doc_id, grade in qrels.get(query, {}).items():
+                file.write(f'{qid} 0 {doc_id} {grade}\n')
+
+
+def read_qrels(path):
+    """Reads a TREC qrels file into qid -> {docno: grade}, doc numbers as ints when they are numeric."""
+    qrels = defaultdict(dict)
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) == 4:
+                qrels[fields[0]][int(fields[2]) if fields[2].isdigit() else fields[2]] = int(fields[3])
+    return dict(qrels)
+
+
+def read_topics(path):
+    """Reads a topics file of "qid<TAB>query" lines into qid -> query."""
+    topics = {}
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            qid, _, query = line.rstrip('\n').partition('\t')
+            if query.strip():
+                topics[qid.strip()] = query.strip()
+    return topics
+
+
+def evaluate(phase3, queries, k=10, workers=None, output_directory=None, query_ids=None):
+    """
+        Runs and scores a query set in ranked and exact phrase mode.
+
+        Args:
+            phase3 (Phase3): Loaded index.
+            queries (dict): query -> {doc_id: grade} of its relevant documents.
+            k (int, optional): Cutoff of P@k and nDCG@k. Defaults to 10.
+            workers (int, optional): Number of workers. Defaults to the number of CPUs.
+            output_directory (str, optional): Where to write qrels.txt and a run.<mode>.txt per mode. Defaults to
+                writing nothing.
+            query_ids (dict, optional): query -> qid used in the files. Defaults to numbering the queries from 1.
+
+        Returns:
+            dict: mode -> metrics from evaluate_run, plus 'seconds' the queries took to run.
+    """
+
+    phase3.state_updater(0, len(queries), "Searching...")
+    start = time.perf_counter()
+    runs = run_queries(phase3, list(queries), workers,
+                       lambda done, total: phase3.state_updater(done, total, "Searching..."))
+    seconds = time.perf_counter() - start
+
+    phase3.state_updater(len(queries), len(queries), "Measuring...")
+    results = {mode: evaluate_run(runs[mode], queries, k) for mode in MODES}
+    results['seconds'] = seconds
+
+    if output_directory:
+        query_ids = query_ids or {query: str(qid) for qid, query in enumerate(queries, start=1)}
+        try:
+            os.makedirs(output_directory, exist_ok=True)
+            write_qrels(os.path.join(output_directory, 'qrels.txt'), queries, query_ids)
+            for mode in MODES:
+                write_run(os.path.join(output_directory, f'run.{mode}.txt'), runs[mode], query_ids, tag=mode)
+        except IOError as e:
+            print(f"Error writing evaluation files to '{output_directory}': {e}")
+    return results
+
+
+def main():
+    from .Phases import Phase3
+
+    parser = argparse.ArgumentParser(description='Evaluates the index in the current directory on a query set.')
+    parser.add_argument('topics', help='File of "qid<TAB>query" lines.')
+    parser.add_argument('qrels', help='TREC qrels file.')
+    parser.add_argument('--k', type=int, default=10, help='Cutoff of P@k and nDCG@k.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of workers, defaults to the CPUs.')
+    parser.add_argument('--output', default=None, help='Directory to write the TREC run files to.')
+    args = parser.parse_args()
+
+    topics = read_topics(args.topics)
+    judgements = read_qrels(args.qrels)
+    # Like trec_eval, only judged topics are run and scored
+    queries = {query: judgements[qid] for qid, query in topics.items() if qid in judgements}
+
+    phase3 = Phase3()
+    phase3.load_index()
+    results = evaluate(phase3, queries, args.k, args.workers, args.output,
+                       {query: qid for qid, query in topics.items()})
+
+    print(f"{len(queries)} queries in {results['seconds']:.2f}s")
+    for mode in MODES:
+        metrics = results[mode]
+        print(f"{mode:>7}: MAP {metrics['map']:.4f}  P@{args.k} {metrics['precision_at_k']:.4f}  "
+              f"R-prec {metrics['r_precision']:.4f}  nDCG@{args.k} {metrics['ndcg_at_k']:.4f}")
+
+
+if __name__ == '__main__':
+    main()
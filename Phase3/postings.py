@@ -0,0 +1,169 @@
+"""
+    Compact in-memory index for Phase3.
+
+    Terms get dense integer ids in sorted order, or in the order they are first added after that. Per-term data is
+    kept in lists and arrays indexed by term id, and the postings of a term are a PostingsList: sorted arrays of
+    unsigned ints instead of dicts and sets of boxed doc ids and lists of boxed positions. Doc ids are ints everywhere,
+    the file name mapping turns them back into files at the API boundary.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+
+
+class PostingsList(Mapping):
+    """doc_id -> positions of one term, stored as sorted doc ids, where each doc's positions start, and positions."""
+
+    __slots__ = ('doc_ids', 'starts', 'positions')
+
+    def __init__(self):
+        self.doc_ids = array('I')
+        self.starts = array('I', [0])
+        self.positions = array('I')
+
+    @classmethod
+    def from_dict(cls, postings):
+        """Builds a postings list from doc_id -> positions."""
+        result = cls()
+        for doc_id in sorted(postings):
+            result.doc_ids.append(doc_id)
+            result.positions.extend(sorted(postings[doc_id]))
+            result.starts.append(len(result.positions))
+        return result
+
+    def _slot(self, doc_id):
+        i = bisect_left(self.doc_ids, doc_id)
+        return i if i < len(self.doc_ids) and self.doc_ids[i] == doc_id else -1
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        return iter(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        return self._slot(doc_id) >= 0
+
+    def __getitem__(self, doc_id):
+        i = self._slot(doc_id)
+        if i < 0:
+            raise KeyError(doc_id)
+        return self.positions[self.starts[i]:self.starts[i + 1]]
+
+    def frequency(self, doc_id):
+        i = self._slot(doc_id)
+        return 0 if i < 0 else self.starts[i + 1] - self.starts[i]
+
+    def add(self, doc_id, positions):
+        """
+            Adds the sorted positions of a document, after the ones it already has.
+
+            Args:
+                doc_id (int): Id of the document.
+                positions (list): Sorted positions, empty for a posting without positions.
+        """
+
+        i = bisect_left(self.doc_ids, doc_id)
+        if i == len(self.doc_ids):
+            # Documents are usually added in id order, which only appends
+            self.doc_ids.append(doc_id)
+            self.positions.extend(positions)
+            self.starts.append(len(self.positions))
+            return
+
+        end = self.starts[i + 1] if self.doc_ids[i] == doc_id else self.starts[i]
+        if self.doc_ids[i] != doc_id:
+            self.doc_ids.insert(i, doc_id)
+            self.starts.insert(i + 1, end)
+        self.positions[end:end] = array('I', positions)
+        for j in range(i + 1, len(self.starts)):
+            self.starts[j] += len(positions)
+
+
+class TermView(Mapping):
+    """Read-only mapping over the term dictionary, with values produced by a per-term-id function."""
+
+    def __init__(self, index, value):
+        self.index = index
+        self.value = value
+
+    def __len__(self):
+        return len(self.index.terms)
+
+    def __iter__(self):
+        return iter(self.index.terms)
+
+    def __getitem__(self, term):
+        result = self.value(self.index.term_ids[term])
+        if result is None:
+            raise KeyError(term)
+        return result
+
+    def __contains__(self, term):
+        return term in self.index.term_ids
+
+
+class CompactIndex:
+    """Term dictionary and array-backed postings, exposing the same mappings as a segment."""
+
+    def __init__(self):
+        self.term_ids = {}
+        self.terms = []
+        self.postings = []
+        self.max_tf_values = array('d')
+
+        self.non_positional_index = TermView(self, lambda term_id: self.postings[term_id] or None)
+        # Terms indexed without positions are left out of the positional view, as in a segment
+        self.positional_index = TermView(self, lambda term_id: self.postings[term_id]
+                                         if self.postings[term_id].positions else None)
+        self.doc_freq = TermView(self, lambda term_id: len(self.postings[term_id]) or None)
+        self.max_tf = TermView(self, lambda term_id: self.max_tf_values[term_id])
+
+    @classmethod
+    def from_dict(cls, non_positional_index, positional_index):
+        """
+            Builds the index from the dictionaries of a pickled index or Segment.to_dict.
+
+            Args:
+                non_positional_index (dict): term -> doc ids.
+                positional_index (dict): term -> {doc_id: positions}.
+
+            Returns:
+                CompactIndex: The index, term ids following the sorted order of the terms.
+        """
+
+        index = cls()
+        for term in sorted(set(non_positional_index) | set(positional_index)):
+            postings = {int(doc_id): () for doc_id in non_positional_index.get(term, ())}
+            postings.update((int(doc_id), positions) for doc_id, positions in positional_index.get(term, {}).items())
+            index.term_ids[term] = len(index.terms)
+            index.terms.append(term)
+            index.postings.append(PostingsList.from_dict(postings))
+            index.max_tf_values.append(0)
+        return index
+
+    def term_id(self, term):
+        """Returns the id of a term, giving it the next id if it is new."""
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = self.term_ids[term] = len(self.terms)
+            self.terms.append(term)
+            self.postings.append(PostingsList())
+            self.max_tf_values.append(0)
+        return term_id
+
+    def add(self, term, doc_id, positions, tf=0.0):
+        """
+            Adds a term's positions in a document.
+
+            Args:
+                term (str): Term.
+                doc_id (int): Id of the document.
+                positions (list): Sorted positions, empty to index the document without positions.
+                tf (float, optional): Term frequency in the document, raises the term's max_tf. Defaults to 0.
+        """
+
+        term_id = self.term_id(term)
+        self.postings[term_id].add(doc_id, positions)
+        self.max_tf_values[term_id] = max(self.max_tf_values[term_id], tf)
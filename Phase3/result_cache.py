@@ -0,0 +1,73 @@
+"""
+    Bounded cache of query results, evicting the least recently used entry when full and expiring entries after a
+    time to live.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    def __init__(self, maxsize=1024, ttl=300):
+        """
+            Initializes an empty cache.
+
+            Args:
+                maxsize (int, optional): Maximum number of entries. Defaults to 1024.
+                ttl (float, optional): Seconds an entry stays valid, None to keep entries until they are evicted.
+                    Defaults to 300.
+        """
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns the value of a live entry and marks it recently used, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        """Adds an entry, evicting the least recently used ones beyond maxsize."""
+        if not self.maxsize:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        """Drops every entry, keeping the counters."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+            Returns the counters of the cache.
+
+            Returns:
+                dict: hits, misses, hit_rate, evictions, size, maxsize and ttl.
+        """
+
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'evictions': self.evictions, 'size': len(self.entries), 'maxsize': self.maxsize, 'ttl': self.ttl}
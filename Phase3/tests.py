@@ -1,3 +1,440 @@
+import math
+import os
+import pickle
+import random
+import shutil
+import tempfile
+from fnmatch import fnmatchcase
+
 from django.test import TestCase
 
-# Create your tests here.
+from Phase2.index_log import get_index_log
+from Phase2.segment import INDEX_SEGMENT
+from .Phases import IndexHolder, Phase3
+from .evaluation import (average_precision, evaluate_run, f_measure, ndcg_at_k, precision_at_k, r_precision,
+                         read_qrels, run_queries, write_qrels, write_run)
+
+OPTIONS = {'non-positional': True, 'positional': True, 'wildcard': True}
+WORDS = [f'{prefix}{suffix}' for prefix in ['ab', 'ba', 'ka', 'sh'] for suffix in ['an', 'ar', 'id', 'on', 'ush']]
+
+
+def random_texts(count, seed=0, length=30):
+    """Returns doc_id -> text of count documents, their words drawn with Zipf probabilities from WORDS."""
+    rng = random.Random(seed)
+    weights = [1 / rank for rank in range(1, len(WORDS) + 1)]
+    return {doc_id: ' '.join(rng.choices(WORDS, weights, k=rng.randint(1, length))) for doc_id in range(1, count + 1)}
+
+
+def build_index(texts, **kwargs):
+    """Indexes texts in a new Phase3 through add_document."""
+    phase3 = Phase3(**kwargs)
+    for doc_id, text in texts.items():
+        phase3.file_name[doc_id] = f'{doc_id}.txt'
+        phase3.add_document(doc_id, text, **OPTIONS)
+    return phase3
+
+
+class TopKTests(TestCase):
+    """Compares MaxScore top-k retrieval with ranking every document."""
+
+    def setUp(self):
+        self.phase3 = build_index(random_texts(300))
+        self.retrieval = self.phase3.ranked_retrieval
+
+    def assert_top_k(self, query, k):
+        ranking, expansions = self.retrieval.rank_documents(query)
+        # Terms in every document have no weight, documents that only contain those are not retrieved
+        ranking = [(doc_id, score) for doc_id, score in ranking if score > 0]
+        top, top_expansions = self.retrieval.top_k_documents(query, k)
+
+        self.assertEqual(top_expansions, expansions)
+        self.assertEqual(len(top), min(k, len(ranking)))
+        # Ties may be broken either way, but the scores must be the best ones and belong to their documents
+        self.assertEqual([round(score, 9) for _, score in top], [round(score, 9) for _, score in ranking[:k]])
+        scores = dict(ranking)
+        for doc_id, score in top:
+            self.assertAlmostEqual(score, scores[doc_id])
+
+    def test_matches_full_ranking(self):
+        rng = random.Random(1)
+        for _ in range(100):
+            query = ' '.join(rng.choices(WORDS, k=rng.randint(1, 5)))
+            for k in (1, 3, 10, 50, 1000):
+                with self.subTest(query=query, k=k):
+                    self.assert_top_k(query, k)
+
+    def test_wildcards(self):
+        for query in ['ab*', '*ar', 'k*n sharid', 'sh*sh abon']:
+            for k in (1, 5, 20):
+                with self.subTest(query=query, k=k):
+                    self.assert_top_k(query, k)
+
+    def test_unknown_terms(self):
+        self.assertEqual(self.retrieval.top_k_documents('missing', 10), ([], []))
+        self.assert_top_k('missing abar', 5)
+
+    def test_non_positive_k(self):
+        for k in (0, -1):
+            self.assertEqual(self.retrieval.top_k_documents('abar kaid', k)[0], [])
+
+
+class WildcardTests(TestCase):
+    """Compares wildcard expansion with scanning the whole vocabulary."""
+
+    WORDS = ['a', 'ab', 'aba', 'abba', 'abcba', 'abc', 'ac', 'axbyc', 'ba', 'bca', 'cab', 'pre', 'prefix', 'post',
+             'prepost', 'preost', 'prost', 'repost']
+
+    def setUp(self):
+        rng = random.Random(5)
+        words = self.WORDS + [''.join(rng.choices('abc', k=rng.randint(1, 7))) for _ in range(300)]
+        self.vocabulary = set(words)
+        self.retrieval = build_index({doc_id: ' '.join(words[i:i + 10]) for doc_id, i in
+                                      enumerate(range(0, len(words), 10), start=1)}).ranked_retrieval
+
+    def assert_expansion(self, pattern):
+        expected = sorted(word for word in self.vocabulary if fnmatchcase(word, pattern))
+        with self.subTest(pattern=pattern):
+            self.assertEqual(self.retrieval.expand_wildcard(pattern), expected)
+            self.assertEqual(self.retrieval.expand_kgram_wildcard(pattern), expected)
+            if pattern.count('*') == 1:
+                self.assertEqual(self.retrieval.expand_single_wildcard(pattern), expected)
+
+    def test_patterns(self):
+        # Overlapping ends like ab*ba must not match aba
+        for pattern in ['pre*', '*post', 'pre*post', 'pre*ost', 'ab*ba', 'a*b*c', 'a*', '*a', 'a*a', '*b*', 'x*',
+                        '*x', 'p*o*t', 'a**c', '*', '**']:
+            self.assert_expansion(pattern)
+
+    def test_random_patterns(self):
+        rng = random.Random(6)
+        for _ in range(300):
+            pieces = [''.join(rng.choices('abc', k=rng.randint(0, 3))) for _ in range(rng.randint(2, 4))]
+            self.assert_expansion('*'.join(pieces))
+
+
+def count_phrase(texts, phrase):
+    """Counts the occurrences of a phrase in every text by comparing every window of words, '*' matching any end."""
+    words = phrase.split()
+
+    def matches(word, pattern):
+        if '*' not in pattern:
+            return word == pattern
+        start, end = pattern.split('*')
+        return len(word) >= len(start) + len(end) and word.startswith(start) and word.endswith(end)
+
+    counts = {}
+    for doc_id, text in texts.items():
+        tokens = text.split()
+        count = sum(all(matches(token, pattern) for token, pattern in zip(tokens[i:i + len(words)], words))
+                    for i in range(len(tokens) - len(words) + 1))
+        if count:
+            counts[doc_id] = count
+    return counts
+
+
+class PhraseSearchTests(TestCase):
+    """Compares positional phrase matching with scanning the texts."""
+
+    def setUp(self):
+        self.texts = random_texts(200, seed=2)
+        self.phase3 = build_index(self.texts)
+        self.rng = random.Random(3)
+
+    def sample_phrase(self, length):
+        """A phrase that occurs in some document."""
+        tokens = self.texts[self.rng.randint(1, len(self.texts))].split()
+        start = self.rng.randrange(max(1, len(tokens) - length + 1))
+        return ' '.join(tokens[start:start + length])
+
+    def test_phrase_frequencies(self):
+        phrases = [self.sample_phrase(self.rng.randint(1, 4)) for _ in range(100)]
+        phrases += [' '.join(self.rng.choices(WORDS, k=3)) for _ in range(50)]
+        for phrase in phrases:
+            with self.subTest(phrase=phrase):
+                self.assertEqual(self.phase3.phrase_search.phrase_frequencies(phrase), count_phrase(self.texts, phrase))
+
+    def test_repeated_words(self):
+        texts = {1: 'abar abar abar', 2: 'abar kaid abar abar', 3: 'kaid abar'}
+        phase3 = build_index(texts)
+        self.assertEqual(phase3.phrase_search.phrase_frequencies('abar abar'), {1: 2, 2: 1})
+
+    def test_wildcard_words(self):
+        for phrase in ['ab* kaid', 'sh*n *ar', 'abar *sh']:
+            with self.subTest(phrase=phrase):
+                self.assertEqual(self.phase3.phrase_search.phrase_frequencies(phrase), count_phrase(self.texts, phrase))
+
+    def test_match_phrases(self):
+        for _ in range(30):
+            first, second = self.sample_phrase(2), self.sample_phrase(2)
+            expected = count_phrase(self.texts, first).keys() & count_phrase(self.texts, second).keys()
+            with self.subTest(first=first, second=second):
+                results = self.phase3.exact_phrase_search(f'"{first}" "{second}"')
+                self.assertEqual({doc_id for doc_id, _ in results}, expected)
+                self.assertEqual([score for _, score in results], sorted((score for _, score in results), reverse=True))
+
+    def test_no_phrase(self):
+        self.assertEqual(self.phase3.exact_phrase_search('abar kaid'), [])
+        self.assertEqual(self.phase3.exact_phrase_search('"missing abar"'), [])
+
+
+class IndexDirectoryMixin:
+    """Runs a test in a temporary directory, where Phase3 saves and loads its index."""
+
+    def setUp(self):
+        super().setUp()
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp(prefix='phase3-test-')
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        super().tearDown()
+
+
+def random_query(rng, depth=0):
+    """Returns a random Boolean query and a function giving the set of words a document needs to match it."""
+    kind = rng.choice(['term', 'term', 'not', 'and', 'or'] if depth < 3 else ['term'])
+    if kind == 'term':
+        word = rng.choice(WORDS + ['ab*', '*on'])
+        if '*' in word:
+            start, end = word.split('*')
+            return word, lambda words: any(w.startswith(start) and w.endswith(end) for w in words)
+        return word, lambda words: word in words
+    if kind == 'not':
+        query, match = random_query(rng, depth + 1)
+        return f'NOT {query}', lambda words: not match(words)
+    children = [random_query(rng, depth + 1) for _ in range(rng.randint(2, 3))]
+    # AND is implied between neighbouring terms, write it out only some of the time
+    separator = ' OR ' if kind == 'or' else rng.choice([' AND ', ' '])
+    query = f"({separator.join(query for query, _ in children)})"
+    if kind == 'or':
+        return query, lambda words: any(match(words) for _, match in children)
+    return query, lambda words: all(match(words) for _, match in children)
+
+
+class BooleanRetrievalTests(IndexDirectoryMixin, TestCase):
+    """Checks the Boolean parser and planner against evaluating queries document by document."""
+
+    def setUp(self):
+        super().setUp()
+        self.texts = random_texts(150, seed=4, length=12)
+        self.phase3 = build_index(self.texts)
+
+    def expected(self, texts, match):
+        return sorted(doc_id for doc_id, text in texts.items() if match(set(text.split())))
+
+    def test_parse(self):
+        parse = self.phase3.boolean_retrieval.parse
+        self.assertEqual(parse('a b OR NOT c'),
+                         ('or', [('and', [('term', 'a'), ('term', 'b')]), ('not', ('term', 'c'))]))
+        self.assertEqual(parse('a AND (b OR c)'), ('and', [('term', 'a'), ('or', [('term', 'b'), ('term', 'c')])]))
+        self.assertEqual(parse('NOT NOT a'), ('not', ('not', ('term', 'a'))))
+
+    def test_malformed(self):
+        for query in ['', '   ', 'a AND', '(a', 'a )', 'OR a', 'a OR', 'NOT', '()']:
+            with self.subTest(query=query), self.assertRaises(ValueError):
+                self.phase3.boolean_retrieval.parse(query)
+
+    def test_random_queries(self):
+        rng = random.Random(5)
+        for _ in range(300):
+            query, match = random_query(rng)
+            with self.subTest(query=query):
+                results, _ = self.phase3.boolean_retrieval.search(query)
+                self.assertEqual(sorted(doc_id for doc_id, _ in results), self.expected(self.texts, match))
+
+    def test_ranking_and_k(self):
+        results, expansions = self.phase3.boolean_search('ab* AND NOT kaid')
+        self.assertEqual(expansions, sorted(word for word in WORDS if word.startswith('ab')))
+        self.assertEqual([score for _, score in results], sorted((score for _, score in results), reverse=True))
+        top, _ = self.phase3.boolean_search('ab* AND NOT kaid', 5)
+        self.assertEqual([round(score, 9) for _, score in top], [round(score, 9) for _, score in results[:5]])
+
+    def test_not_skips_deleted_documents(self):
+        self.phase3.save_index()
+        deleted = random.Random(6).sample(sorted(self.texts), 30)
+        for doc_id in deleted:
+            get_index_log().delete(doc_id)
+        live_texts = {doc_id: text for doc_id, text in self.texts.items() if doc_id not in deleted}
+
+        loaded = Phase3()
+        loaded.load_index()
+        rng = random.Random(7)
+        queries = [('NOT abar', lambda words: 'abar' not in words),
+                   ('NOT (abar OR kaid)', lambda words: not {'abar', 'kaid'} & words)]
+        queries += [random_query(rng) for _ in range(100)]
+        for query, match in queries:
+            with self.subTest(query=query):
+                results, _ = loaded.boolean_search(query)
+                self.assertEqual(sorted(doc_id for doc_id, _ in results), self.expected(live_texts, match))
+
+
+class ResultCacheTests(IndexDirectoryMixin, TestCase):
+    """Checks that cached results are reused for the same index and dropped when it changes."""
+
+    def setUp(self):
+        super().setUp()
+        self.texts = random_texts(50, seed=8)
+        self.phase3 = build_index(self.texts)
+
+    def test_hit(self):
+        results = self.phase3.ranked_search('abar  ab*', 5)
+        self.assertEqual(self.phase3.ranked_search(' abar ab* ', 5), results)
+        self.assertEqual(self.phase3.result_cache.hits, 1)
+        # Different modes and k are different entries
+        self.phase3.ranked_search('abar ab*')
+        self.phase3.boolean_search('abar ab*', 5)
+        self.assertEqual(self.phase3.result_cache.hits, 1)
+
+    def test_hit_returns_expansions(self):
+        results, expansions = self.phase3.ranked_search('sh*', 3)
+        self.assertTrue(expansions)
+        self.assertEqual(self.phase3.ranked_search('sh*', 3), (results, expansions))
+        self.assertEqual(self.phase3.boolean_search('sh*')[1], expansions)
+        self.assertEqual(self.phase3.boolean_search('sh*')[1], expansions)
+        self.assertEqual(self.phase3.result_cache.hits, 2)
+
+    def test_add_document_invalidates(self):
+        self.assertEqual(self.phase3.exact_phrase_search('"kaid kaid kaid kaid"'), [])
+        self.phase3.file_name[51] = '51.txt'
+        self.phase3.add_document(51, 'kaid kaid kaid kaid', **OPTIONS)
+        self.assertEqual([doc_id for doc_id, _ in self.phase3.exact_phrase_search('"kaid kaid kaid kaid"')], [51])
+
+    def test_generation_change(self):
+        self.phase3.ranked_search('abar', 5)
+        self.phase3.generation += 1
+        self.phase3.ranked_search('abar', 5)
+        self.assertEqual(self.phase3.result_cache.hits, 0)
+        self.assertEqual(self.phase3.result_cache.misses, 2)
+
+    def test_index_holder_reloads(self):
+        self.phase3.save_index()
+        holder = IndexHolder()
+        current = holder.get()
+        self.assertIs(holder.get(), current)
+        results, _ = current.ranked_search('abar')
+        self.assertTrue(results)
+
+        deleted = results[0][0]
+        get_index_log().delete(deleted)
+        reloaded = holder.get()
+        self.assertIsNot(reloaded, current)
+        self.assertGreater(reloaded.generation, current.generation)
+        self.assertNotIn(deleted, [doc_id for doc_id, _ in reloaded.ranked_search('abar')[0]])
+
+    def test_index_holder_keeps_index_when_reload_fails(self):
+        self.phase3.save_index()
+        holder = IndexHolder()
+        current = holder.get()
+        # An index written by earlier versions must not be served instead of the segments
+        with open('index.file', 'wb') as file:
+            pickle.dump({'file_names': {'1': 'old.txt'}, 'non_positional_index': {'old': ['1']},
+                         'positional_index': {'old': {'1': [0]}}}, file)
+        with open('broken.seg', 'wb') as file:
+            file.write(b'not a segment')
+        os.replace('broken.seg', INDEX_SEGMENT)
+        get_index_log().delete(1)
+
+        with self.assertRaises(IOError):
+            Phase3().load_index()
+        self.assertIs(holder.get(), current)
+        self.assertIs(holder.get(), current)
+
+        self.phase3.save_index()
+        reloaded = holder.get()
+        self.assertIsNot(reloaded, current)
+        self.assertEqual(len(reloaded.doc_lengths), len(self.texts))
+
+
+class RunQueriesTests(IndexDirectoryMixin, TestCase):
+    """Runs query sets over worker processes and threads."""
+
+    def setUp(self):
+        super().setUp()
+        self.texts = random_texts(150, seed=7)
+        build_index(self.texts).save_index()
+        rng = random.Random(8)
+        self.queries = [' '.join(rng.choices(WORDS, k=rng.randint(1, 3))) for _ in range(40)] + ['ab* kaid']
+
+    def assert_same_runs(self):
+        phase3 = Phase3()
+        phase3.load_index()
+        # Worker processes reopen the segments by path, a single worker searches in this process
+        processes = run_queries(phase3, self.queries, workers=2)
+        self.assertEqual(processes, run_queries(phase3, self.queries, workers=1))
+        self.assertEqual(set(processes['ranked']), set(self.queries))
+        return processes
+
+    def test_segment(self):
+        self.assert_same_runs()
+
+    def test_segment_set(self):
+        get_index_log().delete(1)
+        runs = self.assert_same_runs()
+        self.assertFalse(any(doc_id == 1 for results in runs['ranked'].values() for doc_id, _ in results))
+
+
+class MetricTests(TestCase):
+    """Checks the evaluation metrics on small hand-computed runs."""
+
+    RETRIEVED = [1, 2, 3, 4]
+    RELEVANT = {2: 3, 4: 1, 9: 2}
+
+    def test_precision(self):
+        relevant = set(self.RELEVANT)
+        self.assertEqual(precision_at_k(self.RETRIEVED, relevant, 2), 1 / 2)
+        # Fewer than k retrieved, the missing ranks count as not relevant
+        self.assertEqual(precision_at_k(self.RETRIEVED, relevant, 10), 2 / 10)
+        self.assertEqual(precision_at_k(self.RETRIEVED, relevant, 0), 0)
+        self.assertEqual(r_precision(self.RETRIEVED, relevant), 1 / 3)
+        self.assertEqual(r_precision(self.RETRIEVED, set()), 0)
+
+    def test_average_precision(self):
+        self.assertAlmostEqual(average_precision(self.RETRIEVED, set(self.RELEVANT)), (1 / 2 + 2 / 4) / 3)
+        self.assertEqual(average_precision([2, 4, 9], set(self.RELEVANT)), 1)
+        self.assertEqual(average_precision(self.RETRIEVED, set()), 0)
+        self.assertEqual(average_precision([], set(self.RELEVANT)), 0)
+
+    def test_ndcg(self):
+        ideal = 3 + 2 / math.log2(3) + 1 / 2
+        self.assertAlmostEqual(ndcg_at_k(self.RETRIEVED, self.RELEVANT, 3), (3 / math.log2(3)) / ideal)
+        self.assertAlmostEqual(ndcg_at_k(self.RETRIEVED, self.RELEVANT, 10),
+                               (3 / math.log2(3) + 1 / math.log2(5)) / ideal)
+        # The ideal ranking only has k places too
+        self.assertAlmostEqual(ndcg_at_k([4], self.RELEVANT, 1), 1 / 3)
+        self.assertAlmostEqual(ndcg_at_k([2, 9, 4], self.RELEVANT, 3), 1)
+        self.assertEqual(ndcg_at_k(self.RETRIEVED, {}, 3), 0)
+        self.assertEqual(ndcg_at_k([], self.RELEVANT, 3), 0)
+
+    def test_f_measure(self):
+        precision, recall = 2 / 4, 2 / 3
+        self.assertAlmostEqual(f_measure(self.RETRIEVED, set(self.RELEVANT)),
+                               2 * precision * recall / (precision + recall))
+        self.assertEqual(f_measure(self.RETRIEVED, set()), 0)
+
+    def test_evaluate_run(self):
+        run = {'first': [(doc_id, 1 / doc_id) for doc_id in self.RETRIEVED]}
+        # Grade 0 judgements are not relevant, a judged query missing from the run scores 0
+        qrels = {'first': {**self.RELEVANT, 1: 0}, 'second': {5: 1}}
+        result = evaluate_run(run, qrels, k=2)
+        self.assertEqual((result['k'], result['queries']), (2, 2))
+        self.assertAlmostEqual(result['precision_at_k'], (1 / 2 + 0) / 2)
+        self.assertAlmostEqual(result['map'], ((1 / 2 + 2 / 4) / 3 + 0) / 2)
+        self.assertAlmostEqual(result['f_measure'], f_measure(self.RETRIEVED, set(self.RELEVANT)))
+
+    def test_trec_files(self):
+        directory = tempfile.mkdtemp(prefix='evaluation-test-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        query_ids = {'first query': 'q1', 'second query': 'q2'}
+        qrels = {'first query': {2: 3, 4: 1, 'doc-x': 0}, 'second query': {7: 1}}
+
+        path = os.path.join(directory, 'qrels.txt')
+        write_qrels(path, qrels, query_ids)
+        self.assertEqual(read_qrels(path), {query_ids[query]: judgements for query, judgements in qrels.items()})
+
+        path = os.path.join(directory, 'run.txt')
+        write_run(path, {'first query': [(4, 2.5), (2, 1.25), (3, 0.5)], 'second query': []}, query_ids, tag='t',
+                  depth=2)
+        with open(path, encoding='utf-8') as file:
+            self.assertEqual(file.read().splitlines(), ['q1 Q0 4 1 2.500000 t', 'q1 Q0 2 2 1.250000 t'])
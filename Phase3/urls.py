@@ -12,4 +12,5 @@ urlpatterns = [
     path('progress/', views.progress, name='progress'),
     path('search_retrieve_api', views.search_retrieve_api, name='search_retrieve_api'),
     path('measure_system_api', views.measure_system_api, name='measure_system_api'),
+    path('cache_stats_api', views.cache_stats_api, name='cache_stats_api'),
 ]
@@ -1,15 +1,21 @@
-from .Phases import Phase3, part1, part2
+import copy
 
+from .Phases import IndexHolder, part1, part2
+from .result_cache import ResultCache
+
+from django.conf import settings
 from django.shortcuts import render
 from django.http import JsonResponse
 from rest_framework.decorators import api_view
 
-# Creating an instance of Phase1 class
-phase_object = Phase3()
-phase_object.load_index()
+from core.jobs import job_runner
+
+# Loads the index once and reloads it only when it changes on disk
+index_holder = IndexHolder()
+index_holder.get()
 
 
-def set_initial_state():
+def set_initial_state(phase_object):
     """Sets the initial state for phase object."""
     phase_object.state = [0, "Starting...", '']
 
@@ -31,24 +37,42 @@ def measure_system_page(request):
 
 @api_view(['GET'])
 def progress(request):
-    """API endpoint for progress."""
-    return JsonResponse({'progress': phase_object.state[0], 'state': get_progress_state()})
+    """API endpoint for progress, of a job if its id is given."""
+    job_id = request.GET.get('job')
+    if job_id:
+        job = job_runner.progress(job_id)
+        if job is None:
+            return JsonResponse({'status': 'error', 'message': 'Can\'t find this job!'}, status=404)
+        return JsonResponse(job)
+    return JsonResponse({'progress': index_holder.phase3.state[0], 'state': get_progress_state()})
 
 
 def get_progress_state():
     """Gets progress state."""
-    state = phase_object.state
+    state = index_holder.phase3.state
     return f'{state[2]}/{state[1]}' if state[2] else state[1]
 
 
 @api_view(['POST'])
 def search_retrieve_api(request):
     input_query = request.data.get('inputQuery')
-
-    phase_object.load_index()
-    set_initial_state()
-
-    ranked_results, phrase_results, matching_terms = part1(phase_object, input_query)
+    top_k = request.data.get('topK')
+    boolean = request.data.get('boolean') == 'true'
+
+    try:
+        top_k = int(top_k) if top_k else None
+        if top_k is not None and top_k < 1:
+            raise ValueError
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': f'Invalid topK: {top_k}, it must be a positive integer.'})
+
+    phase_object = index_holder.get()
+    set_initial_state(phase_object)
+
+    try:
+        ranked_results, phrase_results, matching_terms = part1(phase_object, input_query, top_k, boolean)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': f'Invalid query: {e}'})
     ranked_results = [
         f'{i["rank"]}. [{i["doc_id"]}] <a href="file://{i["path"]}">{i["file_name"]}</a> [{i["score"]:.8f}]' for
         i in ranked_results]
@@ -62,10 +86,19 @@ def search_retrieve_api(request):
                          'ranked_results_values': ranked_str, 'ranked_results_length': len(ranked_results),
                          'phrase_results_values': phrase_str, 'phrase_results_length': len(phrase_results),
                          'matching_terms_values': "<br>".join(matching_terms),
-                         'matching_terms_length': len(matching_terms)
+                         'matching_terms_length': len(matching_terms),
+                         'cache': phase_object.result_cache.stats()
                          })
 
 
+@api_view(['GET'])
+def cache_stats_api(request):
+    """API endpoint for the hit and miss counters of the current index's result cache."""
+    phase_object = index_holder.get()
+    return JsonResponse({'status': 'success', 'generation': phase_object.generation,
+                         'cache': phase_object.result_cache.stats()})
+
+
 @api_view(['POST'])
 def measure_system_api(request):
     input_query = request.data.get('inputQuery')
@@ -73,15 +106,25 @@ def measure_system_api(request):
     input_response = request.data.get('inputResponse')
     input_response = [i.strip().split("-") for i in input_response.split(",")]
 
-    phase_object.load_index()
-    set_initial_state()
-
     input_queries = dict(zip(input_query, input_response))
 
-    res_returns = part2(phase_object, input_queries)
-    ranked_str = f"F-Measure: {res_returns['ranked']['f_measure']}<br><br>MAP: {res_returns['ranked']['map']}"
-    phrase_str = f"F-Measure: {res_returns['phrase']['f_measure']}<br><br>MAP: {res_returns['phrase']['map']}"
+    # The job shares the loaded index but reports its own progress. Every query runs once, so it skips the result
+    # cache rather than filling the live index's with its entries.
+    phase_object = copy.copy(index_holder.get())
+    phase_object.result_cache = ResultCache(maxsize=0)
+    job_id = job_runner.submit('measure_system', phase_object, measure_system_job, input_queries)
+    return JsonResponse({'status': 'success', 'job_id': job_id})
 
-    return JsonResponse({'status': 'success',
-                         'ranked_results_values': ranked_str, 'phrase_results_values': phrase_str,
-                         })
+
+def measure_system_job(phase_object, input_queries):
+    """Evaluates the system as a background job, writing TREC qrels and run files to settings.EVALUATION_DIR."""
+    res_returns = part2(phase_object, input_queries, output_directory=settings.EVALUATION_DIR)
+
+    def metrics_str(metrics):
+        return (f"F-Measure: {metrics['f_measure']}<br><br>MAP: {metrics['map']}<br><br>"
+                f"P@{metrics['k']}: {metrics['precision_at_k']}<br><br>R-Precision: {metrics['r_precision']}<br><br>"
+                f"nDCG@{metrics['k']}: {metrics['ndcg_at_k']}")
+
+    return {'ranked_results_values': metrics_str(res_returns['ranked']),
+            'phrase_results_values': metrics_str(res_returns['phrase']),
+            'seconds': res_returns['seconds']}
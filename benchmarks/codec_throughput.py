@@ -0,0 +1,96 @@
+"""
+    Measures encode and decode throughput (integers/sec) of the codecs in Phase2.compression on the postings of the
+    saved index, next to the list-based encoders Phase2 used before.
+
+    Run from the project root:
+        python -m benchmarks.codec_throughput --repeat 3
+"""
+
+import argparse
+import os
+import pickle
+from time import perf_counter
+
+from Phase2.compression import CODECS, to_gaps
+from Phase2.segment import INDEX_SEGMENT, Segment
+
+
+def legacy_variable_byte_encode(numbers):
+    """The original Phase2.variable_byte_encode."""
+    bytes_stream = []
+    for number in numbers:
+        byte_segments = []
+        while True:
+            byte_segments.insert(0, number % 128)
+            if number < 128:
+                break
+            number //= 128
+        byte_segments[-1] += 128
+        bytes_stream.extend(byte_segments)
+    return bytes_stream
+
+
+def legacy_gamma_encode(number):
+    """The original Phase2.gamma_encode."""
+    if number == 0:
+        return '0'
+    binary = bin(number)[2:]
+    offset = binary[1:]
+    return '1' * len(offset) + '0' + offset
+
+
+def legacy_gamma_encode_list(numbers):
+    """The original Phase2.gamma_encode_list."""
+    return ''.join(legacy_gamma_encode(number) for number in numbers)
+
+
+def load_postings():
+    """Returns every doc id list and every positions list of the saved index, as d-gaps."""
+    if os.path.exists(INDEX_SEGMENT):
+        data = Segment(INDEX_SEGMENT).to_dict()
+    else:
+        with open("index.file", "rb") as file:
+            data = pickle.load(file)
+
+    lists = [to_gaps(sorted(int(doc_id) for doc_id in docs)) for docs in data["non_positional_index"].values()]
+    for postings in data["positional_index"].values():
+        lists.extend(to_gaps(positions) for positions in postings.values())
+    return lists
+
+
+def throughput(function, lists, total, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        for numbers in lists:
+            function(numbers)
+        best = min(best, perf_counter() - start)
+    return total / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3, help='Timing rounds, the best one is reported.')
+    args = parser.parse_args()
+
+    lists = load_postings()
+    total = sum(len(numbers) for numbers in lists)
+    print(f"{len(lists)} postings lists, {total} integers")
+    print(f"{'codec':<28}{'encode ints/s':>16}{'decode ints/s':>16}{'bytes':>12}")
+
+    legacy = [("legacy variable byte", legacy_variable_byte_encode, lambda numbers: len(numbers)),
+              ("legacy gamma (str bits)", legacy_gamma_encode_list, lambda bits: (len(bits) + 7) // 8)]
+    for name, function, size in legacy:
+        encoded_size = sum(size(function(numbers)) for numbers in lists)
+        print(f"{name:<28}{throughput(function, lists, total, args.repeat):>16,.0f}{'-':>16}{encoded_size:>12,}")
+
+    for name, (encode, decode) in CODECS.items():
+        encoded = [(encode(numbers), len(numbers)) for numbers in lists]
+        encode_rate = throughput(encode, lists, total, args.repeat)
+        decode_rate = throughput(lambda item: decode(item[0], 0, None, item[1]), encoded, total, args.repeat)
+        encoded_size = sum(len(data) for data, _ in encoded)
+        print(f"{name:<28}{encode_rate:>16,.0f}{decode_rate:>16,.0f}{encoded_size:>12,}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+    Measures Phase2 indexing throughput and index size, on the files of Phase2/Inputs and on synthetic scale-ups.
+
+    Every corpus is indexed with Phase2.build_index in a fresh process, so the peak RSS reported is that build's,
+    worker processes included. The report gives docs/sec and postings/sec of the build, and bytes per posting of the
+    non-positional, positional and wildcard indexes. Sizes are given in memory, walked with get_memory_size, and as
+    d-gaps encoded with each compression method, along with the size of the whole segment per method. Postings are
+    (term, doc) pairs for the non-positional index, positions for the positional one and (k-gram, term) pairs for the
+    wildcard one. Wildcard indexes are rebuilt from the terms on load and are never encoded.
+
+    Run from the project root:
+        python -m benchmarks.indexing_throughput --synthetic 1000 10000 --workers 4 --json /tmp/indexing.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+from Phase2.Phases import Phase2
+from Phase2.compression import CODECS, to_gaps
+from Phase2.segment import write_segment
+from Phase2.spimi import peak_rss
+from .synthetic_corpus import ZipfCorpus, load_vocabulary, write_corpus
+
+INDEXES = ('non_positional', 'positional', 'wildcard')
+
+
+def list_documents(directory):
+    """Returns (doc_id, path) pairs for the files under a directory, in sorted order."""
+    paths = sorted(os.path.join(root, file) for root, _, files in os.walk(directory) for file in files)
+    return list(enumerate(paths, start=1))
+
+
+def benchmark_build(documents, workers):
+    """
+        Indexes documents and measures the build and the size of the result, run in a fresh process.
+
+        Args:
+            documents (list): (doc_id, path) pairs.
+            workers (int): Worker processes of build_index.
+
+        Returns:
+            dict: Build time, peak RSS, per index its postings, bytes in memory and encoded bytes per codec, and the
+                segment bytes per codec.
+    """
+
+    phase2 = Phase2()
+    phase2.file_name = dict(documents)
+    start = perf_counter()
+    phase2.build_index(documents, workers, **{'non-positional': True, 'positional': True, 'wildcard': True})
+    seconds = perf_counter() - start
+    rss = peak_rss(children=True)
+
+    indexes = {
+        'non_positional': phase2.non_positional_index,
+        'positional': phase2.positional_index,
+        'wildcard': phase2.wildcard_index,
+    }
+    postings = {
+        'non_positional': sum(len(doc_ids) for doc_ids in phase2.non_positional_index.values()),
+        'positional': sum(len(positions) for postings in phase2.positional_index.values()
+                          for positions in postings.values()),
+        'wildcard': sum(len(words) for words in phase2.wildcard_index.values()),
+    }
+
+    start = perf_counter()
+    memory = {name: phase2.get_memory_size(index) for name, index in indexes.items()}
+    memory_seconds = perf_counter() - start
+
+    doc_gaps = [to_gaps(sorted(doc_ids)) for doc_ids in phase2.non_positional_index.values()]
+    position_gaps = [to_gaps(positions) for postings in phase2.positional_index.values()
+                     for positions in postings.values()]
+    encoded = {'non_positional': {}, 'positional': {}}
+    segment = {}
+    for codec, (encode, _) in CODECS.items():
+        encoded['non_positional'][codec] = sum(len(encode(gaps)) for gaps in doc_gaps)
+        encoded['positional'][codec] = sum(len(encode(gaps)) for gaps in position_gaps)
+        segment[codec] = len(write_segment(None, phase2.non_positional_index, phase2.positional_index,
+                                           phase2.file_name, codec=codec))
+
+    return {'documents': len(documents), 'terms': len(phase2.non_positional_index), 'seconds': seconds,
+            'peak_rss': rss, 'postings': postings, 'memory': memory, 'memory_seconds': memory_seconds,
+            'encoded': encoded, 'segment': segment}
+
+
+def run_isolated(documents, workers):
+    """Runs benchmark_build in a new interpreter, so its peak RSS does not include earlier builds."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(benchmark_build, documents, workers).result()
+
+
+def report(name, result):
+    """Prints the results of one corpus."""
+    postings = result['postings']
+    rss = f"{result['peak_rss'] / 2 ** 20:.1f} MiB" if result['peak_rss'] else 'unknown'
+    print(f"\n{name}: {result['documents']} documents, {result['terms']} terms")
+    print(f"  build {result['seconds']:.2f} s, {result['documents'] / result['seconds']:,.1f} docs/sec, "
+          f"{postings['non_positional'] / result['seconds']:,.0f} postings/sec, "
+          f"{postings['positional'] / result['seconds']:,.0f} positions/sec, peak RSS {rss}")
+    print(f"  get_memory_size took {result['memory_seconds']:.2f} s")
+    print(f"  {'index':<16}{'postings':>12}{'memory B/p':>12}" + ''.join(f'{codec + " B/p":>18}' for codec in CODECS))
+    for index in INDEXES:
+        count = postings[index] or 1
+        encoded = result['encoded'].get(index, {})
+        print(f"  {index:<16}{postings[index]:>12,}{result['memory'][index] / count:>12.2f}" +
+              ''.join(f"{encoded[codec] / count:>18.3f}" if codec in encoded else f"{'-':>18}" for codec in CODECS))
+    print(f"  {'segment bytes':<40}" + ''.join(f"{result['segment'][codec]:>18,}" for codec in CODECS))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', default='Phase2/Inputs', help='Directory of text files to index.')
+    parser.add_argument('--synthetic', type=int, nargs='*', default=[],
+                        help='Sizes in documents of synthetic corpora to index as well.')
+    parser.add_argument('--length', type=int, default=None,
+                        help='Mean number of words of synthetic documents. Defaults to that of the input files.')
+    parser.add_argument('--exponent', type=float, default=1.0, help='Zipf exponent of synthetic corpora.')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, defaults to the CPUs.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default=None, help='File to write the results to, as JSON.')
+    args = parser.parse_args()
+
+    workers = args.workers or os.cpu_count() or 1
+    results = {}
+
+    documents = list_documents(args.input)
+    results[args.input] = run_isolated(documents, workers)
+    report(args.input, results[args.input])
+
+    if args.synthetic:
+        input_result = results[args.input]
+        length = args.length or max(1, input_result['postings']['positional'] // max(1, input_result['documents']))
+        corpus = ZipfCorpus(load_vocabulary(), args.exponent, length, args.seed)
+        for count in args.synthetic:
+            with tempfile.TemporaryDirectory() as directory:
+                name = f'synthetic-{count}'
+                results[name] = run_isolated(write_corpus(corpus, count, directory), workers)
+                report(name, results[name])
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
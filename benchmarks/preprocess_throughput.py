@@ -0,0 +1,44 @@
+"""
+    Measures the throughput of the Phase1 batch preprocessing pipeline, in documents per second, over the files of
+    Phase1/Inputs. Nothing is written to disk.
+
+    Run from the project root:
+        python -m benchmarks.preprocess_throughput --tokenize --remove-stopwords --lemmatize
+"""
+
+import argparse
+import os
+from time import perf_counter
+
+from Phase1.Phases import Phase1
+
+STEPS = ['normalize', 'tokenize', 'token_spacing', 'remove_stopwords', 'lemmatize', 'stem', 'remove_punctuations']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', default='Phase1/Inputs', help='Directory of sub-directories of text files.')
+    parser.add_argument('--limit', type=int, default=None, help='Only preprocess the first LIMIT files.')
+    for step in STEPS:
+        parser.add_argument(f"--{step.replace('_', '-')}", action='store_true', help=f'Enable the {step} step.')
+    args = parser.parse_args()
+
+    options = {step: getattr(args, step) for step in STEPS}
+    paths = [os.path.join(args.input, directory, file)
+             for directory in sorted(os.listdir(args.input))
+             for file in sorted(os.listdir(os.path.join(args.input, directory)))][:args.limit]
+
+    phase1 = Phase1()
+    documents = [Phase1.read_document(path) for path in paths]
+
+    start = perf_counter()
+    tokens = sum(len(result.split()) for result in phase1.preprocess_documents(documents, **options))
+    elapsed = perf_counter() - start
+
+    enabled = ', '.join(step for step in STEPS if options[step]) or 'split only'
+    print(f"{len(documents)} documents, {tokens} tokens out, steps: {enabled}")
+    print(f"{elapsed:.2f} s, {len(documents) / elapsed:.1f} docs/sec")
+
+
+if __name__ == '__main__':
+    main()
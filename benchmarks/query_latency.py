@@ -0,0 +1,182 @@
+"""
+    Measures p50/p95/p99 query latency of Phase3 on a synthetic Zipf corpus, for term, wildcard, phrase and ranked
+    queries, and fails when a percentile regresses past a stored baseline.
+
+    The corpus is generated from the vocabulary of the saved index and indexed through Phase3.add_document. The result
+    cache is turned off, so every query runs. Baselines are kept per corpus configuration in
+    benchmarks/baselines/query_latency.json and depend on the machine; record them again with --update-baseline on the
+    machine that checks them.
+
+    Run from the project root:
+        python -m benchmarks.query_latency --documents 1000 --queries 200
+        python -m benchmarks.query_latency --documents 100000 --update-baseline
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+from time import perf_counter
+
+from Phase3.Phases import Phase3
+from .synthetic_corpus import ZipfCorpus, load_vocabulary
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baselines', 'query_latency.json')
+PERCENTILES = (50, 95, 99)
+KINDS = ('term', 'wildcard', 'phrase', 'ranked')
+
+
+def build_index(corpus, count):
+    """
+        Indexes count documents of a corpus through Phase3.add_document.
+
+        Returns:
+            tuple: The Phase3 object, with the result cache off, and a sample of the indexed texts for phrase queries.
+    """
+
+    phase3 = Phase3(cache_size=0)
+    options = {'non-positional': True, 'positional': True, 'wildcard': True}
+    sample = []
+    for doc_id, text in corpus.documents(count):
+        phase3.file_name[doc_id] = f'synthetic/{doc_id}.txt'
+        phase3.add_document(doc_id, text, **options)
+        if len(sample) < 1000:
+            sample.append(text)
+    return phase3, sample
+
+
+def make_queries(phase3, corpus, texts, count, seed):
+    """
+        Generates count queries of each kind.
+
+        Term and ranked queries draw their terms with the corpus's Zipf probabilities, so frequent terms with long
+        postings are queried as often as they occur. Wildcard patterns keep a prefix, a suffix or both ends of an
+        indexed term. Phrases are two or three consecutive words of an indexed document.
+
+        Returns:
+            dict: kind -> list of queries.
+    """
+
+    rng = random.Random(seed)
+    words = [word for word in phase3.vocabulary if len(word) >= 3]
+    queries = {kind: [] for kind in KINDS}
+    for i in range(count):
+        queries['term'].append(corpus.terms(1, rng)[0])
+        queries['ranked'].append(' '.join(corpus.terms(rng.randint(2, 4), rng)))
+
+        word = rng.choice(words)
+        queries['wildcard'].append([word[:2] + '*', '*' + word[-2:], word[:1] + '*' + word[-1:]][i % 3])
+
+        text = rng.choice(texts).split()
+        length = rng.randint(2, 3)
+        start = rng.randrange(max(1, len(text) - length + 1))
+        queries['phrase'].append(f'"{" ".join(text[start:start + length])}"')
+    return queries
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of a sorted list."""
+    return sorted_values[max(0, -(-len(sorted_values) * p // 100) - 1)]
+
+
+def measure(search, queries, repeat):
+    """Returns the p50/p95/p99 latency in milliseconds of running every query repeat times."""
+    latencies = []
+    for _ in range(repeat):
+        for query in queries:
+            start = perf_counter()
+            search(query)
+            latencies.append((perf_counter() - start) * 1000)
+    latencies.sort()
+    return {f'p{p}': percentile(latencies, p) for p in PERCENTILES}
+
+
+def find_regressions(results, baseline, tolerance, slack):
+    """
+        Compares results with a baseline.
+
+        Args:
+            results (dict): kind -> percentile -> milliseconds.
+            baseline (dict): The same, as recorded.
+            tolerance (float): Allowed relative slowdown.
+            slack (float): Allowed absolute slowdown in milliseconds, so timer noise on sub-millisecond queries does
+                not count.
+
+        Returns:
+            list: Descriptions of the percentiles slower than the baseline allows.
+    """
+
+    regressions = []
+    for kind, percentiles in baseline.items():
+        for name, recorded in percentiles.items():
+            measured = results.get(kind, {}).get(name)
+            if measured is not None and measured > recorded * (1 + tolerance) + slack:
+                regressions.append(f"{kind} {name}: {measured:.3f} ms, baseline {recorded:.3f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, default=1000, help='Number of synthetic documents, 10^3 to 10^6.')
+    parser.add_argument('--length', type=int, default=200, help='Mean number of words per document.')
+    parser.add_argument('--exponent', type=float, default=1.0, help='Zipf exponent of the term distribution.')
+    parser.add_argument('--queries', type=int, default=200, help='Number of queries of each kind.')
+    parser.add_argument('--repeat', type=int, default=3, help='Times every query runs.')
+    parser.add_argument('--top-k', type=int, default=10, help='Results of term, wildcard and ranked queries.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE, help='JSON file of recorded baselines.')
+    parser.add_argument('--update-baseline', action='store_true', help='Record the results as the baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown.')
+    parser.add_argument('--slack', type=float, default=0.05, help='Allowed absolute slowdown in milliseconds.')
+    args = parser.parse_args()
+
+    corpus = ZipfCorpus(load_vocabulary(), args.exponent, args.length, args.seed)
+    start = perf_counter()
+    phase3, texts = build_index(corpus, args.documents)
+    elapsed = perf_counter() - start
+    print(f"{args.documents} documents, {len(phase3.vocabulary)} terms, indexed in {elapsed:.2f} s "
+          f"({args.documents / elapsed:.1f} docs/sec)")
+
+    queries = make_queries(phase3, corpus, texts, args.queries, args.seed)
+    searches = {
+        'term': lambda query: phase3.ranked_search(query, args.top_k),
+        'wildcard': lambda query: phase3.ranked_search(query, args.top_k),
+        'phrase': phase3.exact_phrase_search,
+        'ranked': lambda query: phase3.ranked_search(query, args.top_k),
+    }
+    results = {kind: measure(searches[kind], queries[kind], args.repeat) for kind in KINDS}
+
+    print(f"{'kind':<10}" + ''.join(f"{f'p{p} ms':>12}" for p in PERCENTILES))
+    for kind in KINDS:
+        print(f"{kind:<10}" + ''.join(f"{results[kind][f'p{p}']:>12.3f}" for p in PERCENTILES))
+
+    # Latencies are only comparable on the same corpus and query set
+    key = f"documents={args.documents},length={args.length},exponent={args.exponent},queries={args.queries}," \
+          f"top_k={args.top_k},seed={args.seed}"
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            baselines = json.load(file)
+
+    if args.update_baseline:
+        baselines[key] = {kind: {name: round(value, 4) for name, value in percentiles.items()}
+                          for kind, percentiles in results.items()}
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+        print(f"Baseline recorded for {key}")
+    elif key not in baselines:
+        print(f"No baseline for {key}, record one with --update-baseline")
+    else:
+        regressions = find_regressions(results, baselines[key], args.tolerance, args.slack)
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+    Generates synthetic corpora for the benchmarks, from the vocabulary of the saved index.
+
+    Terms are ranked by their document frequency in the index and drawn with Zipf probabilities, the term of rank r
+    with weight 1 / r ** exponent, so a few terms are in most documents and most terms are rare, as in real text.
+    Document lengths are uniform around a mean. A seed makes a corpus reproducible.
+
+    Run from the project root to write a corpus as text files, laid out like the Inputs directories:
+        python -m benchmarks.synthetic_corpus --documents 10000 --output /tmp/corpus
+"""
+
+import argparse
+import os
+import pickle
+import random
+from itertools import accumulate
+
+from Phase2.segment import INDEX_SEGMENT, Segment
+
+
+def load_vocabulary(path='index.file'):
+    """
+        Returns the terms of the saved index, most frequent first.
+
+        Args:
+            path (str, optional): Pickled index to read when there is no index segment. Defaults to 'index.file'.
+
+        Returns:
+            list: Terms sorted by descending document frequency, then alphabetically.
+    """
+
+    if os.path.exists(INDEX_SEGMENT):
+        segment = Segment(INDEX_SEGMENT)
+        doc_freq = {term: segment.doc_freq[term] for term in segment.terms}
+    else:
+        with open(path, "rb") as file:
+            doc_freq = {term: len(doc_ids) for term, doc_ids in pickle.load(file)["non_positional_index"].items()}
+    return sorted(doc_freq, key=lambda term: (-doc_freq[term], term))
+
+
+class ZipfCorpus:
+    def __init__(self, vocabulary, exponent=1.0, mean_length=200, seed=0):
+        """
+            Initializes a generator of documents.
+
+            Args:
+                vocabulary (list): Terms, most frequent first.
+                exponent (float, optional): Zipf exponent. Defaults to 1.0.
+                mean_length (int, optional): Mean number of words of a document. Defaults to 200.
+                seed (int, optional): Seed of the random generator. Defaults to 0.
+        """
+
+        self.vocabulary = vocabulary
+        self.mean_length = mean_length
+        self.seed = seed
+        self.cum_weights = list(accumulate(1 / rank ** exponent for rank in range(1, len(vocabulary) + 1)))
+
+    def terms(self, count, rng):
+        """Draws count terms with Zipf probabilities."""
+        return rng.choices(self.vocabulary, cum_weights=self.cum_weights, k=count)
+
+    def documents(self, count):
+        """
+            Yields count documents, the same ones for the same seed.
+
+            Yields:
+                tuple: (doc_id, text), doc ids counting from 1.
+        """
+
+        rng = random.Random(self.seed)
+        low, high = max(1, self.mean_length // 2), max(1, self.mean_length * 3 // 2)
+        for doc_id in range(1, count + 1):
+            yield doc_id, ' '.join(self.terms(rng.randint(low, high), rng))
+
+
+def write_corpus(corpus, count, directory, files_per_directory=1000):
+    """
+        Writes count documents of a corpus as text files, in sub-directories of files_per_directory files.
+
+        Returns:
+            list: (doc_id, path) pairs of the written files.
+    """
+
+    documents = []
+    for doc_id, text in corpus.documents(count):
+        sub_directory = os.path.join(directory, f'{(doc_id - 1) // files_per_directory:04d}')
+        os.makedirs(sub_directory, exist_ok=True)
+        path = os.path.join(sub_directory, f'{doc_id}.txt')
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(text)
+        documents.append((doc_id, path))
+    return documents
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, default=1000, help='Number of documents to generate.')
+    parser.add_argument('--length', type=int, default=200, help='Mean number of words per document.')
+    parser.add_argument('--exponent', type=float, default=1.0, help='Zipf exponent of the term distribution.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', required=True, help='Directory to write the documents to.')
+    args = parser.parse_args()
+
+    corpus = ZipfCorpus(load_vocabulary(), args.exponent, args.length, args.seed)
+    documents = write_corpus(corpus, args.documents, args.output)
+    print(f"{len(documents)} documents written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
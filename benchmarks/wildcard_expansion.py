@@ -0,0 +1,93 @@
+"""
+    Compares wildcard expansion latency of the original all-substrings scan, the k-gram index and the
+    sorted-vocabulary (bisect) lookup on the saved index.
+
+    Run from the project root:
+        python -m benchmarks.wildcard_expansion --patterns 200 --repeat 5
+"""
+
+import argparse
+import random
+from time import perf_counter
+
+from Phase3.Phases import Phase3
+
+
+def legacy_substring_keys(vocabulary):
+    """Rebuilds the keys of the original wildcard index, which held every substring of every word."""
+    keys = set()
+    for word in vocabulary:
+        for i in range(len(word)):
+            for j in range(i + 1, len(word) + 1):
+                keys.add(word[i:j])
+    return list(keys)
+
+
+def legacy_expand_wildcard(wildcards, term):
+    """The original expand_wildcard: a linear startswith/endswith scan over every substring key."""
+    pre, post = term.split("*")
+    if pre and post:
+        return [text for text in wildcards if text.startswith(pre) and text.endswith(post)]
+    elif pre:
+        return [text for text in wildcards if text.startswith(pre)]
+    return [text for text in wildcards if text.endswith(post)]
+
+
+def make_patterns(vocabulary, count, seed):
+    """Builds a mix of pre*, *post and pre*post patterns from random vocabulary words."""
+    rng = random.Random(seed)
+    words = [word for word in vocabulary if len(word) >= 3]
+    patterns = []
+    for i in range(count):
+        word = rng.choice(words)
+        kind = i % 3
+        if kind == 0:
+            patterns.append(word[:2] + '*')
+        elif kind == 1:
+            patterns.append('*' + word[-2:])
+        else:
+            patterns.append(word[:1] + '*' + word[-1:])
+    return patterns
+
+
+def time_per_pattern(expand, patterns, repeat):
+    """Returns the mean latency per pattern in milliseconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        for pattern in patterns:
+            expand(pattern)
+        best = min(best, perf_counter() - start)
+    return best / len(patterns) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--patterns', type=int, default=200, help='Number of wildcard patterns to expand.')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing rounds, the best one is reported.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    phase3 = Phase3()
+    phase3.load_index()
+    ranked_retrieval = phase3.ranked_retrieval
+    wildcards = legacy_substring_keys(phase3.vocabulary)
+    patterns = make_patterns(phase3.vocabulary, args.patterns, args.seed)
+
+    print(f"Vocabulary: {len(phase3.vocabulary)} terms, legacy wildcard keys: {len(wildcards)}, "
+          f"k-grams: {len(phase3.wildcard_index)}")
+
+    results = [
+        ("all-substrings scan", time_per_pattern(lambda p: legacy_expand_wildcard(wildcards, p), patterns,
+                                                 args.repeat)),
+        ("k-gram index", time_per_pattern(ranked_retrieval.expand_kgram_wildcard, patterns, args.repeat)),
+        ("sorted vocabulary", time_per_pattern(ranked_retrieval.expand_wildcard, patterns, args.repeat)),
+    ]
+
+    baseline = results[0][1]
+    for name, latency in results:
+        print(f"{name:<22} {latency:10.4f} ms/pattern  {baseline / latency:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+    Background jobs for the long-running APIs.
+
+    An API submits a function and gets a job id back right away. The function runs on a thread pool with its own
+    phase object, usually a shallow copy of the shared one, so its progress list is not overwritten by other
+    requests. While a job runs its progress is read live from that object. Status, final progress, result and error
+    are kept in the Job table of db.sqlite3.
+"""
+
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections
+
+from .models import Job
+
+
+def format_state(state: list) -> str:
+    """Formats a phase object state the way the progress APIs show it."""
+    return f'{state[2]}/{state[1]}' if state[2] else state[1]
+
+
+class JobRunner:
+    def __init__(self, max_workers: int = 2) -> None:
+        """
+            Initializes the runner.
+
+            Args:
+                max_workers (int, optional): Number of jobs that run at the same time. Defaults to 2.
+        """
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.running = dict()
+        self.lock = threading.Lock()
+        self.recovered = False
+
+    def _recover(self) -> None:
+        # Jobs left queued or running by a previous server process will never finish
+        if not self.recovered:
+            self.recovered = True
+            Job.objects.filter(status__in=[Job.QUEUED, Job.RUNNING]).update(status=Job.FAILED,
+                                                                            error='Interrupted by a restart.')
+
+    def submit(self, kind: str, phase, function, *args, **kwargs) -> str:
+        """
+            Starts a job.
+
+            Args:
+                kind (str): Name of the kind of job, e.g. 'preprocess_files'.
+                phase: Object whose state list is the progress of the job, passed to function as first argument.
+                function (Callable): Work to do, called as function(phase, *args, **kwargs). What it returns must be
+                    JSON serializable and is stored as the result of the job.
+
+            Returns:
+                str: Id of the job.
+        """
+
+        self._recover()
+        job = Job.objects.create(kind=kind, state="Queued...")
+        job_id = str(job.pk)
+        phase.state = [0, "Queued...", '']
+
+        with self.lock:
+            self.running[job_id] = phase
+        self.executor.submit(self._run, job_id, phase, function, args, kwargs)
+        return job_id
+
+    def _run(self, job_id, phase, function, args, kwargs):
+        try:
+            Job.objects.filter(pk=job_id).update(status=Job.RUNNING, state="Starting...")
+            phase.state = [0, "Starting...", '']
+            try:
+                result = function(phase, *args, **kwargs)
+            except Exception as e:
+                traceback.print_exc()
+                Job.objects.filter(pk=job_id).update(status=Job.FAILED, progress=phase.state[0],
+                                                     state=format_state(phase.state)[:255], error=str(e))
+            else:
+                Job.objects.filter(pk=job_id).update(status=Job.DONE, progress=phase.state[0],
+                                                     state=format_state(phase.state)[:255], result=result)
+        finally:
+            with self.lock:
+                self.running.pop(job_id, None)
+            close_old_connections()
+
+    def progress(self, job_id: str):
+        """
+            Returns the progress of a job.
+
+            Args:
+                job_id (str): Id returned by submit.
+
+            Returns:
+                dict: job_id, status, progress, state, result and error of the job, None if there is no such job.
+        """
+
+        with self.lock:
+            phase = self.running.get(job_id)
+
+        try:
+            job = Job.objects.filter(pk=job_id).first()
+        except ValidationError:
+            return None
+        if job is None:
+            return None
+
+        if phase is not None and job.status == Job.RUNNING:
+            progress, state = phase.state[0], format_state(phase.state)
+        else:
+            progress, state = job.progress, job.state
+
+        return {'job_id': job_id, 'status': job.status, 'progress': progress, 'state': state,
+                'result': job.result, 'error': job.error}
+
+
+# Shared by every app, so the number of jobs running at once is bounded for the whole server
+job_runner = JobRunner()